@@ -1,39 +1,283 @@
+import http.client
+import socket
+import ssl
 import sys
+import threading
 import time
+from contextlib import contextmanager
 
-
+import httplib2
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from httplib2 import Http
 from oauth2client import file, client, tools
 
+import scheduler
 from custom_exceptions import FileNotUDSError
-from file_parts import UDSFile
+from file_parts import UDSFile, is_unfinished
+from stats import Stats, call_name
+
+# Most calls Drive accepts in one batch request
+BATCH_LIMIT = 100
+
+# Most connections the transport keeps open at once, see Transport
+POOL_SIZE = 10
+
+# Connections share one SSL context through a private httplib2 helper, checked
+# against httplib2 0.18 and 0.32. Without it plain Http objects are pooled.
+SHARED_SSL_CONTEXT = hasattr(httplib2, '_build_ssl_context')
+
+
+class Transport(object):
+    """Authorised, keep-alive HTTP shared by every GoogleAPI in the process
+
+    httplib2 is not thread-safe, so each call checks an authorised Http out
+    of a bounded pool for as long as it runs. Idle Http objects keep their
+    connections open, so workers reuse warm connections instead of paying
+    for a TLS handshake on every part. New connections share one SSL context
+    and resume earlier TLS sessions where the server allows it.
+
+    The transport behaves as an Http itself, so it can be handed to the
+    discovery build and to media uploads and downloads. Every request goes
+    through its Scheduler, which paces, limits and retries them.
+
+    Args:
+        credentials: oauth2client credentials to authorise requests with
+        size (int): most connections open at once
+        socket_buffer (int): send and receive buffer in bytes for new
+            connections, None for the system default
+        stats (Stats): where every round trip is recorded
+    """
+
+    def __init__(self, credentials, size=POOL_SIZE, socket_buffer=None, stats=None):
+        self.credentials = credentials
+        self.stats = stats or Stats()
+        self.scheduler = scheduler.Scheduler(size, stats=self.stats)
+        self.socket_buffer = socket_buffer
+        self.ssl_context = httplib2._build_ssl_context(False, httplib2.CA_CERTS) if SHARED_SSL_CONTEXT else None
+        self.tls_sessions = {}
+        self._idle = []
+        self._in_use = 0
+        self._available = threading.Condition()
+        self.size = size
+        self._service = None
+        self._service_lock = threading.Lock()
+        self._connection_type = type('PooledHTTPSConnection', (_PooledHTTPSConnection,), {'transport': self})
+
+    @property
+    def size(self):
+        return self._size
+
+    @size.setter
+    def size(self, size):
+        with self._available:
+            self._size = size
+            self.scheduler.max_concurrency = size
+            self._available.notify_all()
+
+    @classmethod
+    def shared(cls):
+        """The transport of this process, authorising the user the first time"""
+        global _shared_transport
+        with _shared_lock:
+            if _shared_transport is None:
+                _shared_transport = cls(load_credentials())
+            return _shared_transport
+
+    @property
+    def service(self):
+        """Drive v3 service, built once"""
+        with self._service_lock:
+            if self._service is None:
+                self._service = build('drive', 'v3', http=self)
+            return self._service
+
+    @contextmanager
+    def connection(self):
+        """Check an authorised Http out of the pool, waiting while all are busy"""
+        with self._available:
+            while self._in_use >= self._size:
+                self._available.wait()
+            self._in_use += 1
+            # The most recently used Http is the likeliest to still be connected
+            pooled = self._idle.pop() if self._idle else None
+
+        try:
+            if pooled is None:
+                pooled = self.credentials.authorize(
+                    _PooledHttp(self._connection_type) if self.ssl_context is not None else Http())
+            yield pooled
+        finally:
+            with self._available:
+                self._idle.append(pooled)
+                self._in_use -= 1
+                self._available.notify()
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        name = call_name(method, uri)
+
+        def send():
+            with self.connection() as pooled:
+                start = time.perf_counter()
+                response, content = pooled.request(uri, method, body, headers, *args, **kwargs)
+            self.stats.add_call(name, response.status, time.perf_counter() - start,
+                                sent=len(body or b''), received=len(content or b''))
+            return response, content
+
+        return self.scheduler.call(send)
+
+    def close(self):
+        with self._available:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            pooled.close()
+
+
+_shared_transport = None
+_shared_lock = threading.Lock()
+
+
+class _PooledHttp(Http):
+    """Http that opens HTTPS connections through the pool's connection type"""
+
+    def __init__(self, connection_type):
+        super().__init__()
+        self._connection_type = connection_type
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+                connection_type=None):
+        if connection_type is None and uri.startswith("https:"):
+            connection_type = self._connection_type
+        return super().request(uri, method, body, headers, redirections, connection_type)
+
+
+class _PooledHTTPSConnection(httplib2.HTTPSConnectionWithTimeout):
+    """HTTPS connection tuned by its transport
+
+    A subclass bound to each Transport is made, so connections can find
+    the shared SSL context, TLS sessions and socket settings.
+    """
+    transport = None
+
+    def __init__(self, host, port=None, key_file=None, cert_file=None, timeout=None, proxy_info=None,
+                 ca_certs=None, disable_ssl_certificate_validation=False, key_password=None, **kwargs):
+        # httplib2 would build an SSL context for every connection, so its
+        # constructor is skipped for the transport's one. Sessions can only
+        # be resumed from the context that made them.
+        http.client.HTTPSConnection.__init__(
+            self, host, port=port, timeout=timeout,
+            context=_SessionResumingContext(self.transport.ssl_context, self.transport.tls_sessions))
+        self.disable_ssl_certificate_validation = disable_ssl_certificate_validation
+        self.ca_certs = ca_certs or httplib2.CA_CERTS
+        self.proxy_info = proxy_info
+        if proxy_info and not isinstance(proxy_info, httplib2.ProxyInfo):
+            self.proxy_info = proxy_info("https")
+        self.key_file = key_file
+        self.cert_file = cert_file
+        self.key_password = key_password
+
+    def connect(self):
+        """Connect with the transport's socket buffers
+
+        The buffers are set before connecting, since TCP settles the window
+        scaling they allow for in its handshake. Connections through a proxy
+        are left to httplib2.
+        """
+        proxied = self.proxy_info and self.proxy_info.isgood() and self.proxy_info.applies_to(self.host)
+        if not self.transport.socket_buffer or proxied:
+            return super().connect()
+
+        error = None
+        for family, socktype, proto, _, address in socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM):
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.transport.socket_buffer)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.transport.socket_buffer)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if httplib2.has_timeout(self.timeout):
+                    sock.settimeout(self.timeout)
+                sock.connect(address)
+                self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+                return
+            except (ssl.SSLError, ssl.CertificateError, socket.timeout, socket.gaierror):
+                sock.close()
+                raise
+            except socket.error as e:
+                sock.close()
+                error = e
+        raise error
+
+    def close(self):
+        # TLS 1.3 hands out its session ticket after the handshake, so the
+        # session is kept once the connection has been used
+        session = getattr(self.sock, 'session', None)
+        if session is not None:
+            self.transport.tls_sessions[self.host] = session
+        super().close()
+
+
+class _SessionResumingContext(object):
+    """SSL context wrapper that offers the last session with each host"""
+
+    def __init__(self, context, sessions):
+        self._context = context
+        self._sessions = sessions
+
+    def wrap_socket(self, sock, server_hostname=None, **kwargs):
+        ssl_sock = self._context.wrap_socket(sock, server_hostname=server_hostname,
+                                             session=self._sessions.get(server_hostname), **kwargs)
+        if ssl_sock.session is not None:
+            self._sessions[server_hostname] = ssl_sock.session
+        return ssl_sock
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+
+def load_credentials():
+    """Load the user's OAuth credentials, running the consent flow if needed"""
+    SCOPES = ["https://www.googleapis.com/auth/drive"]
+    store = file.Storage('credentials.json')
+    credentials = store.get()
+    if not credentials or credentials.invalid:
+        try:
+            flow = client.flow_from_clientsecrets(GoogleAPI.CLIENT_SECRET, SCOPES)
+            credentials = tools.run_flow(flow, store)
+        except ConnectionRefusedError:
+            print("{!s} Make sure you've saved your OAuth credentials as {!s}".format(
+                  GoogleAPI.ERROR_OUTPUT, GoogleAPI.CLIENT_SECRET))
+            sys.exit(
+                "If you've already done that, then run uds.py without any arguments first.")
+    return credentials
 
 
 class GoogleAPI:
+    """Drive v3 client
+
+    Every client shares the process's Transport unless given one, so
+    clients are cheap to create and safe to use from several threads.
+
+    Args:
+        transport (Transport): transport to send requests through
+        service: Drive v3 service to use as it is, such as a fake for
+            benchmarks, instead of one built on the transport
+        stats (Stats): where to record work, the transport's by default
+    """
     ERROR_OUTPUT = "[ERROR]"
     CLIENT_SECRET = 'client_secret.json'
 
-    def __init__(self):
-        self.reauth()
+    def __init__(self, transport=None, service=None, stats=None):
+        self.transport = transport
+        self.service = service
+        if service is None:
+            self.reauth()
+        self.stats = stats or (self.transport.stats if self.transport is not None else Stats())
 
     def reauth(self):
         # Set up the Drive v3 API
-        SCOPES = ["https://www.googleapis.com/auth/drive"]
-        store = file.Storage('credentials.json')
-        credentials = store.get()
-        if not credentials or credentials.invalid:
-            try:
-                flow = client.flow_from_clientsecrets(GoogleAPI.CLIENT_SECRET, SCOPES)
-                credentials = tools.run_flow(flow, store)
-            except ConnectionRefusedError:
-                print("{!s} Make sure you've saved your OAuth credentials as {!s}".format(
-                      GoogleAPI.ERROR_OUTPUT, GoogleAPI.CLIENT_SECRET))
-                sys.exit(
-                    "If you've already done that, then run uds.py without any arguments first.")
-
-        self.service = build('drive', 'v3', http=credentials.authorize(Http()))
+        if self.transport is None:
+            self.transport = Transport.shared()
+        self.service = self.transport.service
         return self.service
 
     def get_base_folder(self):
@@ -78,11 +322,12 @@ class GoogleAPI:
 
         return root_folder
 
-    def create_media_folder(self, media):
+    def create_media_folder(self, media, properties=None):
         """Create a UDS media folder
 
         Args:
             media (UDSFile): the file to create for
+            properties (dict, optional): extra properties to store on the folder
         """
 
         file_metadata = {
@@ -97,53 +342,111 @@ class GoogleAPI:
             },
             'parents': media.parents
         }
+        file_metadata['properties'].update(properties or {})
 
         file = self.service.files().create(body=file_metadata,
                                            fields='id').execute()
 
         return file
 
-    def list_files(self, query=None):
+    def find_media_folders(self, name, size_numeric):
+        """Find the UDS media folders stored for a file
+
+        Args:
+            name (str): name of the file
+            size_numeric (int): size of the file in bytes
+
+        Returns:
+            list: the matching folders, with their properties
+        """
+        q = ("properties has {key='uds' and value='true'} and "
+             "properties has {key='size_numeric' and value='%d'} and "
+             "name = '%s' and trashed=false") % (size_numeric, escape_query(name))
+
+        return self.service.files().list(
+            q=q,
+            pageSize=100,
+            fields="nextPageToken, files(id, name, properties)").execute().get('files', [])
+
+    def list_files(self, query=None, fields="id, name, properties"):
         """List all UDS files
 
         Search the user's drive for all UDS files. Optionally, give a query parameter to
-        return only files matching that.
+        return only files matching that. Every page of results is followed, and
+        files are yielded as each page arrives. Files whose push has not
+        finished yet are left out.
 
         Args:
             query (str): Search for this query
+            fields (str): file fields to ask Drive for, only what the caller reads
 
-        Returns:
-            list: containing files matching the search
+        Yields:
+            UDSFile: each file matching the search
+        """
+        for page in self.list_file_pages(query, fields):
+            for f in page:
+                if not is_unfinished(f.get('properties', {})):
+                    yield uds_file(f)
+
+    def list_file_pages(self, query=None, fields="id, name, properties"):
+        """List all UDS files a page at a time, see list_files
+
+        Yields:
+            list: the raw metadata of each file in a page of results
         """
         q = "properties has {key='uds' and value='true'} and trashed=false"
 
         if query is not None:
-            q += " and name contains '%s'" % query
+            q += " and name contains '%s'" % escape_query(query)
 
-        # Call the Drive v3 API
-        results = self.service.files().list(
-            q=q,
-            pageSize=1000,
-            fields="nextPageToken, files(id, name, properties, mimeType)").execute()
-
-        items = results.get('files', [])
-
-        files = []
-        for f in items:
-            props = f.get("properties", {})
-            files.append(UDSFile(
-                name=f.get("name"),
-                base64=None,
-                mime=f.get("mimeType"),
-                size=props.get("size"),
-                size_numeric=props.get("size_numeric"),
-                encoded_size=props.get("encoded_size"),
-                id=f.get("id"),
-                shared=props.get("shared"),
-                md5=f.get("md5Checksum")
-            ))
-
-        return files
+        token = None
+        while True:
+            # Call the Drive v3 API
+            results = self.service.files().list(
+                q=q,
+                pageSize=1000,
+                pageToken=token,
+                fields="nextPageToken, files(%s)" % fields).execute()
+
+            yield results.get('files', [])
+
+            token = results.get('nextPageToken')
+            if token is None:
+                break
+
+    def get_start_page_token(self):
+        """Get the token for changes made from now on"""
+        return self.service.changes().getStartPageToken().execute()['startPageToken']
+
+    def list_changes(self, token):
+        """List the changes to UDS files since a changes feed token
+
+        Args:
+            token (str): token from get_start_page_token or a previous call
+
+        Returns:
+            tuple: a list of (file ID, removed, UDSFile or None) for each change,
+            and the token to pass next time
+        """
+        changes = []
+
+        while True:
+            page = self.service.changes().list(
+                pageToken=token,
+                pageSize=1000,
+                fields="nextPageToken, newStartPageToken, "
+                       "changes(fileId, removed, file(id, name, mimeType, trashed, properties))").execute()
+
+            for change in page.get('changes', []):
+                f = change.get('file') or {}
+                # Files still being pushed are left out until their push finishes
+                properties = f.get('properties', {})
+                is_uds = properties.get('uds') == 'true' and not f.get('trashed') and not is_unfinished(properties)
+                changes.append((change['fileId'], change.get('removed', False), uds_file(f) if is_uds else None))
+
+            if 'newStartPageToken' in page:
+                return changes, page['newStartPageToken']
+            token = page['nextPageToken']
 
     def recursive_list_folder(self, parent_id, token=None):
         """Recursively list a folder
@@ -155,23 +458,106 @@ class GoogleAPI:
             parent_id (str): ID of the root node to list from
             token (str, optional): Token to use for starting page
         """
-        all_parts = []
+        return self.list_folders([parent_id], token)[parent_id]
 
-        while True:
-            page_of_files = self.service.files().list(
+    def list_folders(self, parent_ids, token=None):
+        """List the contents of many folders at once
+
+        The first page of every folder goes out in the same batch, and only
+        folders with more pages left take part in the next round trip.
+
+        Args:
+            parent_ids (list): IDs of the folders to list
+            token (str, optional): Token to use for starting page
+
+        Returns:
+            dict: each folder ID mapped to a list of its children
+
+        Raises:
+            HttpError: if any of the folders could not be listed
+        """
+        children = {parent_id: [] for parent_id in parent_ids}
+        pending = {parent_id: token for parent_id in parent_ids}
+
+        while pending:
+            ids = list(pending)
+            pages = self.execute_batch([self.service.files().list(
                 q="parents in {!r}".format(parent_id),
-                pageSize=100,
-                pageToken=token,
-                fields="nextPageToken, files(id, name, properties)").execute()
+                pageSize=1000,
+                pageToken=pending[parent_id],
+                fields="nextPageToken, files(id, name, properties, version)") for parent_id in ids])
 
-            all_parts += page_of_files.get("files", [])
+            pending = {}
+            for parent_id, (page, error) in zip(ids, pages):
+                if error is not None:
+                    raise error
+                children[parent_id] += page.get("files", [])
+                if page.get("nextPageToken") is not None:
+                    pending[parent_id] = page["nextPageToken"]
 
-            token = page_of_files.get("nextPageToken")
+        return children
 
-            if token is None:
-                break
+    def execute_batch(self, requests):
+        """Send requests as multi-call HTTP batches
+
+        Up to BATCH_LIMIT requests share each round trip. A request that
+        fails does not stop the others.
+
+        Args:
+            requests (list): API requests, not yet executed
+
+        Returns:
+            list: a (response, error) tuple for each request, in the same order,
+            where error is the HttpError it failed with, or None
+        """
+        results = [None] * len(requests)
+
+        def collect(request_id, response, exception):
+            results[int(request_id)] = (response, exception)
+
+        for start in range(0, len(requests), BATCH_LIMIT):
+            batch = self.service.new_batch_http_request(callback=collect)
+            for i in range(start, min(start + BATCH_LIMIT, len(requests))):
+                batch.add(requests[i], request_id=str(i))
+            batch.execute()
+
+        return results
+
+    def get_files(self, ids, fields="id, name, properties"):
+        """Get the metadata of many files with batched requests
+
+        Returns:
+            list: a (metadata, error) tuple for each ID, see execute_batch
+        """
+        return self.execute_batch([self.service.files().get(fileId=id, fields=fields) for id in ids])
+
+    def delete_files(self, ids):
+        """Delete many UDS files with batched requests
+
+        As with delete_file, every file is checked to be a UDS one first.
+
+        Args:
+            ids (list): IDs of the files
+
+        Returns:
+            dict: each ID mapped to None if it was deleted, or else the error
+            it failed with, a FileNotUDSError if it is not a UDS file
+        """
+        outcome = {}
+        deletable = []
+        for id, (info, error) in zip(ids, self.get_files(ids, fields="id, properties")):
+            if error is not None:
+                outcome[id] = error
+            elif not info.get("properties", {}).get("uds"):
+                outcome[id] = FileNotUDSError()
+            else:
+                deletable.append(id)
+
+        deleted = self.execute_batch([self.service.files().delete(fileId=id) for id in deletable])
+        for id, (_, error) in zip(deletable, deleted):
+            outcome[id] = error
 
-        return all_parts
+        return outcome
 
     def delete_file(self, id):
         """Delete a UDS file
@@ -202,6 +588,30 @@ class GoogleAPI:
     def export_media(self, _id):
         return self.service.files().export_media(fileId=_id, mimeType='text/plain')
 
+    def download_range(self, id, start, end):
+        """Download part of a file's content with a Range request
+
+        Args:
+            id (str): ID of the file
+            start (int): offset of the first byte
+            end (int): offset just past the last byte
+
+        Returns:
+            bytes: the content in that range
+        """
+        request = self.service.files().get_media(fileId=id)
+        headers = dict(request.headers, range="bytes=%d-%d" % (start, end - 1))
+        response, content = request.http.request(request.uri, method="GET", headers=headers)
+        if response.status >= 300:
+            raise HttpError(response, content, uri=request.uri)
+        return content
+
+    def trash_file(self, id):
+        """Move a file to the trash, where it can still be restored from"""
+        return self.service.files().update(fileId=id,
+                                           body={'trashed': True},
+                                           fields='id').execute()
+
     def upload_single_file(self, media_file, file_metadata):
         """Uploads a single file to the Drive
 
@@ -209,19 +619,40 @@ class GoogleAPI:
             media_file (MediaBody): The file to upload
             file_metadata (dict): metadata for the file
         """
-        while True:
-            try:
-                _file = self.service.files().create(body=file_metadata,
-                                                    media_body=media_file,
-                                                    fields='id').execute()
-                break
-            except HttpError as e:
-                print('Failed to upload chunk {}. Retrying... '
-                      .format(file_metadata.get("properties", {}).get("part")))
-                time.sleep(1)
+        # Throttling and transient failures are retried by the transport
+        _file = self.service.files().create(body=file_metadata,
+                                            media_body=media_file,
+                                            fields='id').execute()
 
         return _file, file_metadata
 
+    def copy_file(self, id, file_metadata):
+        """Copy a file on the Drive side
+
+        Args:
+            id (str): ID of the file to copy
+            file_metadata (dict): metadata for the copy
+
+        Returns:
+            dict: the new file
+        """
+        return self.service.files().copy(fileId=id,
+                                         body=file_metadata,
+                                         fields='id').execute()
+
+    def update_properties(self, id, properties):
+        """Set custom properties on a file
+
+        Properties not named are left as they are.
+
+        Args:
+            id (str): ID of the file
+            properties (dict): property names and their new values
+        """
+        return self.service.files().update(fileId=id,
+                                           body={'properties': properties},
+                                           fields='id').execute()
+
     def hide_file(self, id):
         """Hide a given file
 
@@ -229,3 +660,24 @@ class GoogleAPI:
         """
         self.service.files().update(fileId=id,
                                     removeParents='root').execute()
+
+
+def escape_query(value):
+    """Escape a string for use inside a quoted Drive query term"""
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def uds_file(f):
+    """Build a UDSFile from the metadata of a media folder"""
+    props = f.get("properties", {})
+    return UDSFile(
+        name=f.get("name"),
+        base64=None,
+        mime=f.get("mimeType"),
+        size=props.get("size"),
+        size_numeric=props.get("size_numeric"),
+        encoded_size=props.get("encoded_size"),
+        id=f.get("id"),
+        shared=props.get("shared"),
+        md5=props.get("md5") or f.get("md5Checksum")
+    )
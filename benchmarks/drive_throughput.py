@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Benchmark codecs and end-to-end pushes and pulls against a fake Drive
+
+Reports, for each codec, how fast parts encode and decode, then for each
+file size, push and pull throughput, API calls per GB, errors injected and
+the peak RSS of the process doing each. Every push and every pull runs in
+a fresh process against the in-process fake in fake_drive.py, so no
+credentials or network are needed, and RSS is not carried over from one to
+the next. Both include the fake Drive's own copy of the file.
+
+Usage:
+    python3 benchmarks/drive_throughput.py [--sizes 1,8,32] [--codec base64]
+        [--latency seconds] [--bandwidth MB/s] [--error-rate 0.01] [--workers n]
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import encoder  # noqa: E402
+import scheduler  # noqa: E402
+from fake_drive import FakeDrive  # noqa: E402
+
+MB = 1024 * 1024
+GB = 1024 * MB
+CODEC_SAMPLE_BYTES = 32 * MB
+# Where a push leaves the fake Drive's files for the pull
+DRIVE_STATE = 'drive.pickle'
+
+
+def codec_rates(name):
+    """Encode and decode MB/s of one codec, per core"""
+    codec = encoder.get_codec(name)
+    chunk_size = codec.chunk_size(1000000)
+    data = os.urandom(CODEC_SAMPLE_BYTES)
+    view = memoryview(data)
+
+    start = time.process_time()
+    encoded = [codec.encode(view[offset:offset + chunk_size]) for offset in range(0, len(data), chunk_size)]
+    encode_time = time.process_time() - start
+
+    start = time.process_time()
+    for text in encoded:
+        decoder = codec.decoder(lambda block: None)
+        decoder.write(text)
+        decoder.close()
+    decode_time = time.process_time() - start
+
+    return len(data) / MB / encode_time, len(data) / MB / decode_time
+
+
+def run_phase(args):
+    """Push or pull one file, printing the results as JSON
+
+    The push leaves the fake Drive's files in the work folder for the pull,
+    which runs in a process of its own so each reports its own peak RSS.
+    """
+    import uds
+    from api import GoogleAPI
+
+    os.chdir(args.workdir)
+    size = int(args.run * MB)
+    uds.CODEC = args.codec
+    uds.MAX_WORKERS_ALLOWED = args.workers
+    drive = FakeDrive(latency=args.latency, bandwidth=args.bandwidth * MB if args.bandwidth else None,
+                      error_rate=args.error_rate,
+                      scheduler=scheduler.Scheduler(args.workers, scheduler.TokenBucket(rate=None)))
+    client = uds.UDS(api=GoogleAPI(service=drive.service()))
+
+    if args.phase == 'push':
+        with open('source.bin', 'wb') as f:
+            f.write(os.urandom(size))
+    else:
+        with open(DRIVE_STATE, 'rb') as f:
+            drive.files = pickle.load(f)
+
+    with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet), contextlib.redirect_stderr(quiet):
+        start = time.perf_counter()
+        if args.phase == 'push':
+            client.do_chunked_upload('source.bin')
+        else:
+            folder = next(f for f in drive.files.values() if f['properties'].get('uds') == 'true')
+            client.build_file(folder['id'])
+        elapsed = time.perf_counter() - start
+
+    result = {
+        'rate': size / MB / elapsed,
+        'calls': drive.api_calls() * GB / size,
+        'errors': drive.errors_injected,
+        'rss': peak_rss(),
+    }
+    if args.phase == 'push':
+        with open(DRIVE_STATE, 'wb') as f:
+            pickle.dump(drive.files, f)
+    else:
+        result['ok'] = md5(os.path.join(uds.get_downloads_folder(), 'source.bin')) == md5('source.bin')
+    print(json.dumps(result))
+
+
+def peak_rss():
+    """Peak RSS of this process in MB
+
+    ru_maxrss is kept across exec on Linux, so it would report the parent
+    benchmark process's peak. The high water mark of the process's own
+    memory is read instead where there is one.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except IOError:
+        pass
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1,8,32', help="File sizes in MB, comma separated")
+    parser.add_argument('--codec', choices=sorted(encoder.CODECS), default=encoder.DEFAULT_CODEC)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds per round trip")
+    parser.add_argument('--bandwidth', type=float, help="MB/s of file content, unlimited by default")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Chance each call fails with a 503")
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--run', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--phase', choices=['push', 'pull'], help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        return run_phase(args)
+
+    print("{:<12} {:>10} {:>10}".format('Codec', 'Encode', 'Decode'))
+    for name in sorted(encoder.CODECS):
+        encode_rate, decode_rate = codec_rates(name)
+        print("{:<12} {:>6.1f}MB/s {:>6.1f}MB/s".format(name, encode_rate, decode_rate))
+
+    print()
+    print("{:>8} {:>11} {:>11} {:>12} {:>12} {:>7} {:>9} {:>9} {:>4}".format(
+        'Size', 'Push', 'Pull', 'Push calls', 'Pull calls', 'Errors', 'Push RSS', 'Pull RSS', 'OK'))
+    for size in args.sizes.split(','):
+        workdir = tempfile.mkdtemp(prefix='uds-bench-')
+        results = {}
+        for phase in ('push', 'pull'):
+            command = [sys.executable, os.path.abspath(__file__), '--run', size, '--phase', phase,
+                       '--workdir', workdir, '--codec', args.codec, '--latency', str(args.latency),
+                       '--error-rate', str(args.error_rate), '--workers', str(args.workers)]
+            if args.bandwidth:
+                command += ['--bandwidth', str(args.bandwidth)]
+            results[phase] = json.loads(subprocess.check_output(command).decode('utf-8').splitlines()[-1])
+        shutil.rmtree(workdir)
+
+        push, pull = results['push'], results['pull']
+        print("{:>6}MB {:>7.1f}MB/s {:>7.1f}MB/s {:>9.0f}/GB {:>9.0f}/GB {:>7} {:>7.1f}MB {:>7.1f}MB {:>4}".format(
+            float(size), push['rate'], pull['rate'], push['calls'], pull['calls'],
+            push['errors'] + pull['errors'], push['rss'], pull['rss'], 'yes' if pull['ok'] else 'NO'))
+
+
+if __name__ == '__main__':
+    main()
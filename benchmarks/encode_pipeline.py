@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Benchmark the per-part read/encode path of a push
+
+Compares the old path (reopen and map the file for every part, copy the
+slice, decode to str, wrap in StringIO) with the mapped, memoryview based
+path used by UDS.upload_chunked_part. Both end by reading the upload body
+the same way googleapiclient does for a non-resumable upload.
+
+Usage:
+    python3 benchmarks/encode_pipeline.py [size_in_mb]
+"""
+import io
+import mmap
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from googleapiclient.http import MediaIoBaseUpload  # noqa: E402
+
+import encoder  # noqa: E402
+import file_parts  # noqa: E402
+
+CHUNK = file_parts.Chunk.CHUNK_READ_LENGTH_BYTES
+
+
+def legacy_path(path, size):
+    for start in range(0, size, CHUNK):
+        with open(path) as fd:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            chunk_bytes = mm[start:start + CHUNK]
+        encoded_chunk = str(encoder.encode(chunk_bytes), 'utf-8')
+        media = MediaIoBaseUpload(io.StringIO(encoded_chunk), mimetype='text/plain')
+        body = media.getbytes(0, media.size())
+        if isinstance(body, str):
+            body.encode('utf-8')
+
+
+def mapped_path(path, size):
+    with file_parts.MappedFile(path) as source:
+        for part in range((size + CHUNK - 1) // CHUNK):
+            chunk = file_parts.Chunk(path, part, size, media=None, parent=None, source=source)
+            view = chunk.read()
+            encoded_chunk = encoder.encode(view)
+            view.release()
+            media = MediaIoBaseUpload(io.BytesIO(encoded_chunk), mimetype='text/plain')
+            media.getbytes(0, media.size())
+
+
+def measure(fn, path, size):
+    start_cpu = time.process_time()
+    fn(path, size)
+    cpu = time.process_time() - start_cpu
+
+    tracemalloc.start()
+    fn(path, size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return size / (1024 * 1024) / cpu, peak
+
+
+def main():
+    size = int(float(sys.argv[1] if len(sys.argv) > 1 else 64) * 1024 * 1024)
+
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        tmp.write(os.urandom(size))
+
+    try:
+        print("{:<8} {:>12} {:>14}".format('Path', 'MB/s/core', 'Peak alloc'))
+        for name, fn in (('legacy', legacy_path), ('mapped', mapped_path)):
+            rate, peak = measure(fn, tmp.name, size)
+            print("{:<8} {:>12.1f} {:>12.1f}MB".format(name, rate, peak / (1024 * 1024)))
+    finally:
+        os.remove(tmp.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+"""In-process fake of the parts of Drive v3 that GoogleAPI uses
+
+Files live in a dict, so pushes and pulls run without credentials or a
+network. Latency, bandwidth, injected errors and a concurrency quota can be
+simulated. When a Scheduler is given, every call goes through it the
+same way Transport sends real requests, so retries and throttling are
+exercised too.
+
+Usage:
+    drive = FakeDrive(latency=0.05, bandwidth=20 * 1024 * 1024)
+    api = GoogleAPI(service=drive.service())
+"""
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+EXPORT_BOM = b'\xef\xbb\xbf'
+
+
+class FakeResponse(dict):
+    """httplib2 style response: headers in the dict, plus a status"""
+
+    def __init__(self, status, headers=None):
+        super().__init__(headers or {})
+        self.status = status
+        self.reason = 'OK' if status < 300 else 'Error'
+
+
+def _error(status, reason=None):
+    errors = [{'reason': reason}] if reason else []
+    return FakeResponse(status), json.dumps({'error': {'code': status, 'errors': errors}}).encode('utf-8')
+
+
+class FakeDrive(object):
+    """Drive state and the simulated network in front of it
+
+    Args:
+        latency (float): seconds each round trip takes
+        bandwidth (float): bytes per second for file content, None for no limit
+        error_rate (float): fraction of calls that fail with error_status.
+            Failures are spread evenly rather than drawn at random, so a run
+            of n calls always sees n * error_rate of them, rounded, however
+            short it is.
+        error_status (int): status of injected errors
+        max_concurrent (int): calls beyond this many at once get a 429
+        scheduler (Scheduler): sends calls, as Transport does
+        stats (Stats): records every round trip, as Transport does
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, error_status=503, max_concurrent=None,
+                 scheduler=None, stats=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_concurrent = max_concurrent
+        self.scheduler = scheduler
+        self.stats = stats
+        self.files = {}
+        self.changelog = []
+        self.calls = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count()
+        self.errors_injected = 0
+        # Starts half way, so the count of injected errors is rounded rather than cut short
+        self._error_debt = 0.5
+        self._active = 0
+
+    def service(self):
+        return FakeService(self)
+
+    def new_id(self):
+        return 'id%06d' % next(self._ids)
+
+    def api_calls(self):
+        """Calls made so far, batched calls counted one each"""
+        return sum(count for method, count in self.calls.items() if method != 'batch')
+
+    def send(self, method_id, handler, sent=0):
+        """Make one round trip
+
+        Args:
+            method_id (str): name the call is counted under
+            handler (callable): does the work, returning the result or raising HttpError
+            sent (int): bytes of content uploaded with the call
+
+        Returns:
+            tuple: the response and its content
+        """
+        def attempt():
+            start = time.perf_counter()
+            response, content = self._serve(method_id, handler, sent)
+            if self.stats is not None:
+                self.stats.add_call(method_id, response.status, time.perf_counter() - start, sent=sent,
+                                    received=len(content) if isinstance(content, bytes) else 0)
+            return response, content
+
+        if self.scheduler is not None:
+            return self.scheduler.call(attempt)
+        return attempt()
+
+    def call(self, method_id, handler, sent=0):
+        """Make one round trip, raising HttpError if it fails as googleapiclient does"""
+        response, content = self.send(method_id, handler, sent)
+        if response.status >= 300:
+            raise HttpError(response, content)
+        return content
+
+    def _serve(self, method_id, handler, sent):
+        with self.lock:
+            self.calls[method_id] = self.calls.get(method_id, 0) + 1
+            self._active += 1
+            over_quota = self.max_concurrent is not None and self._active > self.max_concurrent
+            self._error_debt += self.error_rate
+            fail = self._error_debt >= 1
+            if fail:
+                self._error_debt -= 1
+                self.errors_injected += 1
+
+        try:
+            self._wait(sent)
+            if over_quota:
+                return _error(429, 'userRateLimitExceeded')
+            if fail:
+                return _error(self.error_status, 'backendError')
+            try:
+                result = handler()
+            except HttpError as e:
+                return e.resp, e.content
+            if isinstance(result, bytes):
+                self._wait(len(result), latency=False)
+            return FakeResponse(200), result
+        finally:
+            with self.lock:
+                self._active -= 1
+
+    def _wait(self, transferred, latency=True):
+        delay = self.latency if latency else 0.0
+        if self.bandwidth:
+            delay += transferred / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+    def record_change(self, file_id):
+        self.changelog.append(file_id)
+
+    def project(self, f):
+        return {k: v for k, v in f.items() if k != 'content'}
+
+    def get(self, file_id):
+        f = self.files.get(file_id)
+        if f is None:
+            raise HttpError(*_error(404, 'notFound'))
+        return f
+
+
+class FakeRequest(object):
+    """An unexecuted call, as returned by the resource methods"""
+
+    def __init__(self, drive, method_id, handler, sent=0, uri=''):
+        self.drive = drive
+        self.methodId = method_id
+        self.handler = handler
+        self.sent = sent
+        self.uri = uri
+        self.headers = {}
+        self.http = FakeHttp(drive)
+
+    def execute(self, http=None, num_retries=0):
+        return self.drive.call(self.methodId, self.handler, self.sent)
+
+
+class FakeHttp(object):
+    """Serves the content of files to MediaIoBaseDownload"""
+
+    def __init__(self, drive):
+        self.drive = drive
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        kind, file_id = re.match(r'fake://(export|media)/(.*)', uri).groups()
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+
+        def download():
+            content = self.drive.get(file_id)['content']
+            if kind == 'export':
+                # Docs exports carry a BOM and Windows line endings
+                return EXPORT_BOM + content.replace(b'\n', b'\r\n')
+            return content
+
+        response, content = self.drive.send('drive.files.export' if kind == 'export' else 'drive.files.get_media',
+                                            download)
+        if response.status >= 300 or 'range' not in headers:
+            if response.status < 300:
+                response['content-length'] = str(len(content))
+            return response, content
+
+        start, end = (int(value) for value in headers['range'].split('=')[1].split('-'))
+        part = content[start:end + 1]
+        return FakeResponse(206, {'content-range': 'bytes %d-%d/%d' % (start, start + len(part) - 1,
+                                                                       len(content))}), part
+
+
+def _matches(f, q):
+    if q is None:
+        return True
+    for key, value in re.findall(r"properties has \{key='([^']*)' and value='([^']*)'\}", q):
+        if f.get('properties', {}).get(key) != value:
+            return False
+    rest = re.sub(r"properties has \{[^}]*\}", "", q)
+    if 'trashed=false' in rest and f.get('trashed'):
+        return False
+    for name in re.findall(r"name contains '((?:[^'\\]|\\.)*)'", rest):
+        if name.replace("\\'", "'").replace("\\\\", "\\") not in f['name']:
+            return False
+    for name in re.findall(r"name = '((?:[^'\\]|\\.)*)'", rest):
+        if name.replace("\\'", "'").replace("\\\\", "\\") != f['name']:
+            return False
+    for parent_id in re.findall(r"parents in '([^']*)'", rest) + re.findall(r"'([^']*)' in parents", rest):
+        if parent_id not in f.get('parents', []):
+            return False
+    return True
+
+
+def _stringify(properties):
+    # Drive stores every property value as a string
+    return {key: str(value) for key, value in properties.items()}
+
+
+class FakeFiles(object):
+    def __init__(self, drive):
+        self.d = drive
+
+    def create(self, body=None, media_body=None, fields=None):
+        content = b''
+        if media_body is not None:
+            content = media_body.getbytes(0, media_body.size())
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+
+        def run():
+            with self.d.lock:
+                f = dict(body or {})
+                f['id'] = self.d.new_id()
+                f['properties'] = _stringify(f.get('properties', {}))
+                f.setdefault('parents', [])
+                f['content'] = content
+                if not f.get('mimeType', '').startswith('application/vnd.google-apps.'):
+                    # Binary files have a size and checksum, Docs do not
+                    f['size'] = str(len(content))
+                    f['md5Checksum'] = hashlib.md5(content).hexdigest()
+                self.d.files[f['id']] = f
+                self.d.record_change(f['id'])
+            return {'id': f['id']}
+        return FakeRequest(self.d, 'drive.files.create', run, sent=len(content))
+
+    def copy(self, fileId=None, body=None, fields=None):
+        def run():
+            with self.d.lock:
+                f = dict(self.d.get(fileId))
+                f.update(body or {})
+                f['properties'] = _stringify(f.get('properties', {}))
+                f['id'] = self.d.new_id()
+                self.d.files[f['id']] = f
+                self.d.record_change(f['id'])
+            return {'id': f['id']}
+        return FakeRequest(self.d, 'drive.files.copy', run)
+
+    def list(self, q=None, pageSize=100, pageToken=None, fields=None, **kwargs):
+        def run():
+            with self.d.lock:
+                matches = sorted((f for f in self.d.files.values() if _matches(f, q)), key=lambda f: f['id'])
+            start = int(pageToken or 0)
+            page = {'files': [self.d.project(f) for f in matches[start:start + pageSize]]}
+            if start + pageSize < len(matches):
+                page['nextPageToken'] = str(start + pageSize)
+            return page
+        return FakeRequest(self.d, 'drive.files.list', run)
+
+    def get(self, fileId=None, fields=None):
+        return FakeRequest(self.d, 'drive.files.get', lambda: self.d.project(self.d.get(fileId)))
+
+    def update(self, fileId=None, body=None, removeParents=None, addParents=None, fields=None):
+        def run():
+            with self.d.lock:
+                f = self.d.get(fileId)
+                for key, value in (body or {}).items():
+                    if key == 'properties':
+                        f['properties'].update(_stringify(value))
+                    else:
+                        f[key] = value
+                if removeParents:
+                    f['parents'] = [p for p in f['parents'] if p not in removeParents.split(',')]
+                if addParents:
+                    f['parents'] = f['parents'] + addParents.split(',')
+                self.d.record_change(fileId)
+            return {'id': fileId}
+        return FakeRequest(self.d, 'drive.files.update', run)
+
+    def delete(self, fileId=None):
+        def run():
+            with self.d.lock:
+                self.d.get(fileId)
+                todo = [fileId]
+                while todo:
+                    file_id = todo.pop()
+                    self.d.files.pop(file_id, None)
+                    self.d.record_change(file_id)
+                    todo += [k for k, f in self.d.files.items() if file_id in f.get('parents', [])]
+            return b''
+        return FakeRequest(self.d, 'drive.files.delete', run)
+
+    def export_media(self, fileId=None, mimeType=None):
+        return FakeRequest(self.d, 'drive.files.export', None, uri='fake://export/%s' % fileId)
+
+    def get_media(self, fileId=None):
+        return FakeRequest(self.d, 'drive.files.get_media', None, uri='fake://media/%s' % fileId)
+
+
+class FakeChanges(object):
+    def __init__(self, drive):
+        self.d = drive
+
+    def getStartPageToken(self):
+        return FakeRequest(self.d, 'drive.changes.getStartPageToken',
+                           lambda: {'startPageToken': str(len(self.d.changelog))})
+
+    def list(self, pageToken=None, pageSize=100, fields=None, **kwargs):
+        def run():
+            with self.d.lock:
+                start = int(pageToken)
+                changes = []
+                for file_id in self.d.changelog[start:start + pageSize]:
+                    f = self.d.files.get(file_id)
+                    changes.append({'fileId': file_id, 'removed': f is None,
+                                    'file': self.d.project(f) if f is not None else None})
+                page = {'changes': changes}
+                if start + pageSize < len(self.d.changelog):
+                    page['nextPageToken'] = str(start + pageSize)
+                else:
+                    page['newStartPageToken'] = str(len(self.d.changelog))
+            return page
+        return FakeRequest(self.d, 'drive.changes.list', run)
+
+
+class FakeBatch(object):
+    """Runs up to 100 calls in one round trip, reporting each one's outcome"""
+
+    def __init__(self, drive, callback):
+        self.d = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if len(self.requests) >= 100:
+            raise ValueError("Batches hold at most 100 calls")
+        self.requests.append((request, callback or self.callback, request_id))
+
+    def execute(self):
+        def run():
+            outcomes = []
+            for request, _, _ in self.requests:
+                with self.d.lock:
+                    self.d.calls[request.methodId] = self.d.calls.get(request.methodId, 0) + 1
+                try:
+                    outcomes.append((request.handler(), None))
+                except HttpError as e:
+                    outcomes.append((None, e))
+            return outcomes
+
+        for (_, callback, request_id), (response, error) in zip(self.requests, self.d.call('batch', run)):
+            callback(request_id, response, error)
+
+
+class FakeService(object):
+    def __init__(self, drive):
+        self.drive = drive
+
+    def files(self):
+        return FakeFiles(self.drive)
+
+    def changes(self):
+        return FakeChanges(self.drive)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.drive, callback)
@@ -0,0 +1,129 @@
+import sqlite3
+import threading
+
+from file_parts import UDSFile
+from part_index import INDEX_PATH
+
+# Rows read from the catalog at a time while searching
+SEARCH_BATCH = 500
+
+
+class Catalog(object):
+    """Local catalog of the UDS files in Drive
+
+    Files are kept in SQLite, indexed by ID and by name, so name based
+    commands do not have to list the whole of Drive. The catalog is kept up
+    to date from the Drive changes feed, and only falls back to a full
+    listing the first time it is synced.
+
+    Args:
+        path (str): SQLite database to keep the catalog in
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                             "id TEXT PRIMARY KEY, name TEXT NOT NULL, mime TEXT, size TEXT, "
+                             "encoded_size TEXT, size_numeric INTEGER, md5 TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS files_name ON files (name)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    @property
+    def page_token(self):
+        """Changes feed token the catalog is up to date with, None if never synced"""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'page_token'").fetchone()
+        return row[0] if row else None
+
+    def sync(self, api):
+        """Bring the catalog up to date with Drive
+
+        Args:
+            api (GoogleAPI): client to read Drive with
+        """
+        token = self.page_token
+        if token is None:
+            # Take the token first, so nothing that changes during the listing is missed
+            token = api.get_start_page_token()
+            self.replace(api.list_files(fields="id, name, mimeType, properties"), token)
+        else:
+            changes, token = api.list_changes(token)
+            self.apply_changes(changes, token)
+
+    def replace(self, files, token):
+        """Replace the whole catalog with a full listing"""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM files")
+            self._db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (_row(f) for f in files))
+            self._set_token(token)
+
+    def apply_changes(self, changes, token):
+        """Apply entries from the changes feed
+
+        Args:
+            changes (list): changes, each with a fileId, whether it was removed,
+                and the file as a UDSFile, or None if it is not a UDS file
+            token (str): token to resume the feed from next time
+        """
+        with self._lock, self._db:
+            for file_id, removed, f in changes:
+                if removed or f is None:
+                    self._db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+                else:
+                    self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", _row(f))
+            self._set_token(token)
+
+    def _set_token(self, token):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('page_token', ?)", (token,))
+
+    def remove(self, id):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM files WHERE id = ?", (id,))
+
+    def find(self, name):
+        """Find a UDS file by its exact name
+
+        Returns:
+            UDSFile: the most recently catalogued file with that name, or None
+        """
+        with self._lock:
+            row = self._db.execute("SELECT * FROM files WHERE name = ? ORDER BY rowid DESC LIMIT 1",
+                                   (name,)).fetchone()
+        return _file(row) if row else None
+
+    def search(self, part=None):
+        """Find UDS files with part in their name
+
+        Rows are read a batch at a time, so the catalog can be changed while
+        the results are being worked through.
+
+        Args:
+            part (str): text to look for, None or "?" for every file
+
+        Yields:
+            UDSFile: each matching file, ordered by name
+        """
+        match = "" if part is None or part == "?" else str(part)
+        after = ("", "")
+        while True:
+            with self._lock:
+                rows = self._db.execute("SELECT * FROM files WHERE instr(name, ?) > 0 AND (name, id) > (?, ?) "
+                                        "ORDER BY name, id LIMIT ?",
+                                        (match, after[0], after[1], SEARCH_BATCH)).fetchall()
+            for row in rows:
+                yield _file(row)
+            if len(rows) < SEARCH_BATCH:
+                return
+            after = (rows[-1][1], rows[-1][0])
+
+
+def _row(f):
+    return f.id_, f.name, f.mime, f.size, f.encoded_size, f.size_numeric, f.md5
+
+
+def _file(row):
+    id_, name, mime, size, encoded_size, size_numeric, md5 = row
+    return UDSFile(name, None, mime, size, encoded_size, id=id_, size_numeric=size_numeric, md5=md5)
@@ -0,0 +1,177 @@
+import bz2
+import lzma
+import math
+import zlib
+
+# Parts are never made more than this many times larger than a Doc holds,
+# however well the file compresses, so a part still fits in memory. A power
+# of two, like every growth used
+MAX_PART_GROWTH = 16
+
+# A file has to shrink below this fraction of its size to be worth compressing
+MAX_USEFUL_RATIO = 0.9
+
+# Part sizes are planned with this much headroom over the sampled ratio
+SAFETY_MARGIN = 0.8
+
+SAMPLE_COUNT = 8
+SAMPLE_LENGTH = 256 * 1024
+
+
+class Compression(object):
+    """A compressor and level, applied to each part on its own
+
+    Parts are compressed independently so they can still be uploaded,
+    downloaded and resumed in any order.
+
+    Args:
+        algorithm (str): one of ALGORITHMS
+        level (int): compression level, None for the algorithm's default
+    """
+
+    def __init__(self, algorithm, level=None):
+        if algorithm not in ALGORITHMS:
+            raise ValueError("Unknown compression algorithm '{}'".format(algorithm))
+        self.algorithm = algorithm
+        self.level = ALGORITHMS[algorithm]['default'] if level is None else level
+
+    @property
+    def name(self):
+        """Id stored in the media folder properties"""
+        return "{}:{}".format(self.algorithm, self.level)
+
+    def compress(self, data):
+        return ALGORITHMS[self.algorithm]['compress'](data, self.level)
+
+    def decompressor(self):
+        return ALGORITHMS[self.algorithm]['decompressor']()
+
+    def sample_ratio(self, source):
+        """Estimate how well a file compresses from a spread of samples
+
+        Args:
+            source (MappedFile): the mapped file
+
+        Returns:
+            float: compressed size over original size
+        """
+        size = len(source)
+        if size == 0:
+            return 1.0
+
+        stride = max(size // SAMPLE_COUNT, 1)
+        raw = compressed = 0
+        for start in range(0, size, stride)[:SAMPLE_COUNT]:
+            view = source.view(start, start + SAMPLE_LENGTH)
+            raw += len(view)
+            compressed += len(self.compress(view))
+            view.release()
+        return compressed / raw
+
+    def part_size(self, doc_capacity, ratio):
+        """Plan how many raw bytes to put in each part
+
+        Parts are grown so that, once compressed, they still about fill one
+        Doc. A part that compresses worse than the sample suggested spills
+        over into extra Docs rather than failing.
+
+        The growth is rounded down to a power of two, so small differences
+        in the sampled ratio between versions of a file give the same part
+        boundaries, and their parts can still be deduplicated.
+
+        Args:
+            doc_capacity (int): raw bytes the codec fits in one Doc
+            ratio (float): sampled compression ratio
+
+        Returns:
+            int: raw bytes per part
+        """
+        growth = min(MAX_PART_GROWTH, max(1.0, SAFETY_MARGIN / ratio))
+        return doc_capacity * 2 ** int(math.log2(growth))
+
+
+class _ZlibDecompressor(object):
+    """zlib.decompressobj, with the same finishing behaviour as the others"""
+
+    def __init__(self):
+        self._obj = zlib.decompressobj()
+
+    def decompress(self, data):
+        return self._obj.decompress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+ALGORITHMS = {
+    'zlib': {'default': 6, 'compress': lambda data, level: zlib.compress(data, level),
+             'decompressor': _ZlibDecompressor},
+    'bz2': {'default': 9, 'compress': lambda data, level: bz2.compress(data, level),
+            'decompressor': bz2.BZ2Decompressor},
+    'lzma': {'default': 6, 'compress': lambda data, level: lzma.compress(data, preset=level),
+             'decompressor': lzma.LZMADecompressor},
+}
+
+
+def parse(spec):
+    """Parse a compression setting such as 'zlib' or 'lzma:9'
+
+    Returns:
+        Compression: the compression described, or None if spec is empty
+    """
+    if not spec:
+        return None
+
+    algorithm, _, level = spec.partition(':')
+    return Compression(algorithm, int(level) if level else None)
+
+
+def choose(spec, source):
+    """Decide whether compressing a file is worthwhile
+
+    Args:
+        spec (str): compression setting asked for, see parse
+        source (MappedFile): the mapped file
+
+    Returns:
+        tuple: the Compression to use, or None if the file is left as it is,
+        and the sampled compression ratio
+    """
+    compression = parse(spec)
+    if compression is None:
+        return None, 1.0
+
+    ratio = compression.sample_ratio(source)
+    if ratio > MAX_USEFUL_RATIO:
+        return None, 1.0
+    return compression, ratio
+
+
+class DecompressingSink(object):
+    """Sink that decompresses a part before passing it on
+
+    Args:
+        decompressor: object with a decompress method, from Compression.decompressor
+        sink (callable): called with each block of decompressed bytes
+    """
+
+    def __init__(self, decompressor, sink):
+        self.decompressor = decompressor
+        self.sink = sink
+
+    def __call__(self, data):
+        out = self.decompressor.decompress(data)
+        if out:
+            self.sink(out)
+
+    def close(self):
+        flush = getattr(self.decompressor, 'flush', None)
+        if flush is not None:
+            out = flush()
+            if out:
+                self.sink(out)
+
+
+def pieces_needed(length, doc_capacity):
+    """Number of Docs needed to hold a part of length bytes once encoded"""
+    return max(1, math.ceil(length / doc_capacity))
@@ -76,3 +76,39 @@ class NoClientSecretError(Error):
 
     def __str__(self):
         return "{}".format(self.message)
+
+
+class UnknownCodecError(Error):
+    """Raised when a UDS file was encoded with a codec this version does not know
+
+    Attributes:
+        codec    -- the codec id stored on the file.
+        message  -- explanation why exception was raised.
+
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.message = "UDS file was encoded with unknown codec '{}'. " \
+                       "It may have been uploaded by a newer version of UDS.".format(codec)
+
+    def __str__(self):
+        return "{}".format(self.message)
+
+
+class IncompleteFileError(Error):
+    """Raised when a UDS file is read before every part of it is in Drive
+
+    Attributes:
+        name     -- name of the UDS file.
+        message  -- explanation why exception was raised.
+
+    """
+
+    def __init__(self, name, reason):
+        self.name = name
+        self.message = "UDS file '{}' is incomplete, {}. " \
+                       "Push it again to finish it.".format(name, reason)
+
+    def __str__(self):
+        return "{}".format(self.message)
@@ -1,9 +1,47 @@
 import base64
+import binascii
+import codecs
+import math
+import sys
+
+from custom_exceptions import UnknownCodecError
+
+# Text is decoded in blocks of this many characters, so a part never needs
+# more than one block of working memory on top of the downloaded text
+DECODE_BLOCK_LENGTH = 64 * 1024
+
+_BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+_BASE85_ALPHABET = (b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                    b'!#$%&()*+-;<=>?@^_`{|}~')
+# Everything else is dropped before decoding: line breaks, the BOM Docs
+# prepend on export, and padding, which is restored when the stream closes
+_NOT_BASE64 = bytes(sorted(set(range(256)) - set(_BASE64_ALPHABET)))
+_NOT_BASE85 = bytes(sorted(set(range(256)) - set(_BASE85_ALPHABET)))
+
+# Base4096 maps every pair of base64 characters to one CJK ideograph. These
+# are single characters to Docs and survive Unicode normalisation untouched.
+# Padding gets ideographs of its own, so the last pair needs no special case.
+_BASE4096_START = 0x4E00
+_BASE4096_ENCODE = [None] * 65536
+_BASE4096_DECODE = {}
+for _i, _first in enumerate(_BASE64_ALPHABET + b'='):
+    for _j, _second in enumerate(_BASE64_ALPHABET + b'='):
+        _char = chr(_BASE4096_START + _i * 65 + _j)
+        # Pairs are looked up as native 16 bit integers, see encode_base4096
+        _BASE4096_ENCODE[int.from_bytes(bytes([_first, _second]), sys.byteorder)] = _char
+        _BASE4096_DECODE[ord(_char)] = chr(_first) + chr(_second)
 
 
 def encode(chunk):
-    enc = str(base64.encodebytes(chunk), 'utf-8')
-    return enc
+    """Encode a chunk as base64
+
+    Args:
+        chunk (bytes-like): raw data, a memoryview is encoded without copying it first
+
+    Returns:
+        bytes: the encoded chunk, ready to stream to Drive as text/plain
+    """
+    return base64.encodebytes(chunk)
 
 
 def decode(chunk):
@@ -11,3 +49,195 @@ def decode(chunk):
     if missing_padding != 0:
         chunk += b'=' * (4 - missing_padding)
     return base64.decodebytes(chunk)
+
+
+def encode_base64(chunk):
+    """Encode a chunk as base64 on a single line"""
+    return binascii.b2a_base64(chunk, newline=False)
+
+
+def encode_base85(chunk):
+    """Encode a chunk as base85, with no padding on the last group"""
+    return base64.b85encode(chunk)
+
+
+def encode_base4096(chunk):
+    """Encode a chunk as base4096, 12 bits to a character
+
+    Returns:
+        bytes: UTF-8 text, three bytes to a character
+    """
+    # base64 output always has an even length, so it can be read as 16 bit pairs
+    pairs = memoryview(encode_base64(chunk)).cast('H')
+    return ''.join(map(_BASE4096_ENCODE.__getitem__, pairs)).encode('utf-8')
+
+
+class StreamDecoder(object):
+    """Incrementally decode base64 text into a sink
+
+    Behaves as a writable file, so it can be handed to MediaIoBaseDownload.
+    Every complete group of characters is decoded as soon as it arrives
+    and passed on, so neither the encoded nor the decoded part is ever held
+    in full.
+
+    Args:
+        sink (callable): called with each block of decoded bytes
+    """
+    GROUP_LENGTH = 4
+    DISCARD = _NOT_BASE64
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.written = 0
+        self._pending = b''
+
+    def write(self, data):
+        view = memoryview(data)
+        for start in range(0, len(view), DECODE_BLOCK_LENGTH):
+            self._decode_block(bytes(view[start:start + DECODE_BLOCK_LENGTH]).translate(None, self.DISCARD))
+        return len(view)
+
+    def _decode_block(self, block):
+        if self._pending:
+            needed = self.GROUP_LENGTH - len(self._pending)
+            self._pending += block[:needed]
+            block = block[needed:]
+            if len(self._pending) < self.GROUP_LENGTH:
+                return
+            self._emit(self.decode_groups(self._pending))
+            self._pending = b''
+
+        usable = len(block) - len(block) % self.GROUP_LENGTH
+        self._pending = block[usable:]
+        if usable:
+            self._emit(self.decode_groups(memoryview(block)[:usable]))
+
+    def _emit(self, decoded):
+        self.sink(decoded)
+        self.written += len(decoded)
+
+    @staticmethod
+    def decode_groups(data):
+        return binascii.a2b_base64(data)
+
+    @staticmethod
+    def decode_tail(data):
+        return binascii.a2b_base64(data + b'=' * (4 - len(data)))
+
+    def close(self):
+        """Decode whatever is left, restoring any padding that was stripped"""
+        if self._pending:
+            self._emit(self.decode_tail(self._pending))
+            self._pending = b''
+
+
+class Base85StreamDecoder(StreamDecoder):
+    """Incrementally decode base85 text into a sink"""
+    GROUP_LENGTH = 5
+    DISCARD = _NOT_BASE85
+
+    @staticmethod
+    def decode_groups(data):
+        return base64.b85decode(bytes(data))
+
+    @staticmethod
+    def decode_tail(data):
+        return base64.b85decode(data)
+
+
+class Base4096StreamDecoder(object):
+    """Incrementally decode base4096 text into a sink
+
+    The UTF-8 text is turned back into base64 as it arrives, a character
+    split across two writes is held until the rest of it comes in.
+    """
+
+    def __init__(self, sink):
+        self._text = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self._base64 = StreamDecoder(sink)
+
+    @property
+    def written(self):
+        return self._base64.written
+
+    def write(self, data):
+        view = memoryview(data)
+        for start in range(0, len(view), DECODE_BLOCK_LENGTH):
+            self._translate(self._text.decode(view[start:start + DECODE_BLOCK_LENGTH]))
+        return len(view)
+
+    def _translate(self, text):
+        # Anything that is not one of our ideographs is outside ASCII or is
+        # whitespace, so it is dropped by one filter or the other
+        self._base64.write(text.translate(_BASE4096_DECODE).encode('ascii', 'ignore'))
+
+    def close(self):
+        self._translate(self._text.decode(b'', final=True))
+        self._base64.close()
+
+
+class Codec(object):
+    """A way of storing binary data as Doc text
+
+    Data is encoded in fixed groups, so the number of raw bytes that fill a
+    Doc can be worked out exactly from its character limit.
+
+    Args:
+        name (str): id stored in the media folder properties
+        encode (callable): turns a bytes-like chunk into UTF-8 text
+        decoder (callable): builds a streaming decoder given a sink
+        group_bytes (int): raw bytes in each encoded group
+        group_chars (int): characters each group encodes to
+        char_bytes (int): UTF-8 bytes in each character
+    """
+
+    def __init__(self, name, encode, decoder, group_bytes, group_chars, char_bytes=1):
+        self.name = name
+        self.encode = encode
+        self.decoder = decoder
+        self.group_bytes = group_bytes
+        self.group_chars = group_chars
+        self.char_bytes = char_bytes
+
+    def chunk_size(self, max_doc_length):
+        """Plan the raw bytes per part that fill a Doc without going over its limit
+
+        Args:
+            max_doc_length (int): most characters a Doc may hold
+
+        Returns:
+            int: bytes of the original file to store in each part
+        """
+        return max_doc_length // self.group_chars * self.group_bytes
+
+    def encoded_size(self, size):
+        """Bytes of text sent to Drive to store size bytes"""
+        return math.ceil(size / self.group_bytes) * self.group_chars * self.char_bytes
+
+
+CODECS = {codec.name: codec for codec in (
+    # The original layout, base64 broken into lines of 76 characters
+    Codec('base64-mime', encode, StreamDecoder, 57, 77),
+    Codec('base64', encode_base64, StreamDecoder, 3, 4),
+    Codec('base85', encode_base85, Base85StreamDecoder, 4, 5),
+    # Two base64 characters to an ideograph: half the Docs, but each one is
+    # three bytes of UTF-8 on the wire
+    Codec('base4096', encode_base4096, Base4096StreamDecoder, 3, 2, char_bytes=3),
+)}
+
+DEFAULT_CODEC = 'base64'
+
+# Files uploaded before codecs were recorded on their folder
+LEGACY_CODEC = 'base64-mime'
+
+
+def get_codec(name):
+    """Look up a codec by the id stored on a media folder
+
+    Raises:
+        UnknownCodecError: if no codec has that id
+    """
+    try:
+        return CODECS[name or LEGACY_CODEC]
+    except KeyError:
+        raise UnknownCodecError(name)
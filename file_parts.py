@@ -1,4 +1,18 @@
+import collections
+import hashlib
+import io
+import json
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
 class UDSFile(object):
+    # Listings can hold a great many of these, so they carry no __dict__
+    __slots__ = ('name', 'base64', 'mime', 'size', 'size_numeric', 'encoded_size', 'parents', 'id_', 'shared',
+                 'md5')
+
     def __init__(self, name, base64, mime, size, encoded_size, id=None, parents=None, size_numeric=None, shared=False,
                  md5=None):
         self.name = name
@@ -13,19 +27,624 @@ class UDSFile(object):
         self.md5 = md5 or ''
 
 
+class MappedFile(object):
+    """Read-only memory map of a file, shared by every chunk of a push
+
+    The file is mapped once and chunks are handed out as memoryview slices,
+    so reading a part never copies it. Views must be released before the
+    file is closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = open(path, 'rb')
+        self._map = None
+        self._view = memoryview(b'')
+
+        # Empty files cannot be mapped, but they have no chunks to read either
+        if len(self) > 0:
+            self._map = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+
+    def __len__(self):
+        return self._map.size() if self._map is not None else os.fstat(self._fd.fileno()).st_size
+
+    def view(self, start, end):
+        return self._view[start:end]
+
+    def close(self):
+        self._view.release()
+        if self._map is not None:
+            self._map.close()
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class Chunk:
     CHUNK_READ_LENGTH_BYTES = 750000
 
-    def __init__(self, path, part, max_size, media, parent):
+    def __init__(self, path, part, max_size, media, parent, source=None, chunk_size=CHUNK_READ_LENGTH_BYTES):
         self.path = path
+        self.source = source
         self.part = part
-        self.range_start = part * Chunk.CHUNK_READ_LENGTH_BYTES
+        self.range_start = part * chunk_size
         self.media = media
         self.parent = parent
 
-        range_end = ((part + 1) * Chunk.CHUNK_READ_LENGTH_BYTES)
+        range_end = ((part + 1) * chunk_size)
 
         if range_end > max_size:
             self.range_end = max_size
         else:
             self.range_end = range_end
+
+    def read(self):
+        """Get the bytes of this chunk
+
+        Returns:
+            memoryview: a view of the chunk when the file is mapped, otherwise
+            a fresh read of the range from disk
+        """
+        if self.source is not None:
+            return self.source.view(self.range_start, self.range_end)
+
+        with open(self.path, 'rb') as fd:
+            fd.seek(self.range_start)
+            return memoryview(fd.read(self.range_end - self.range_start))
+
+    def blocks(self):
+        """Yield the bytes of this chunk, releasing the view once it has been used"""
+        view = self.read()
+        try:
+            yield view
+        finally:
+            view.release()
+
+
+class RangeChunk(Chunk):
+    """Chunk of a file that is not on local disk, such as one in Drive
+
+    The range is fetched when the chunk is first read, and kept until it
+    has been hashed, so it is only downloaded once. See UDS.convert_file
+    and UDS.push_stream.
+
+    Args:
+        fetch (callable): fetches a byte range, given its start and end
+    """
+
+    def __init__(self, fetch, part, max_size, media, parent, chunk_size):
+        super().__init__(None, part, max_size, media, parent, chunk_size=chunk_size)
+        self.fetch = fetch
+        self._data = None
+
+    def read(self):
+        if self._data is None:
+            self._data = self.fetch(self.range_start, self.range_end)
+        return memoryview(self._data)
+
+    def blocks(self):
+        try:
+            yield from super().blocks()
+        finally:
+            self._data = None
+
+
+class Push(object):
+    """A file on its way up to Drive, see UDS.start_push
+
+    Args:
+        source (MappedFile): the mapped file, None if it is not a local file
+        media (UDSFile): the file being pushed
+        parent (dict): its media folder
+        codec (Codec): how its parts are encoded
+        compressor (Compression): how its parts are compressed, or None
+        total_parts (int): number of parts in the whole file
+    """
+
+    def __init__(self, source, media, parent, codec, compressor, total_parts):
+        self.path = source.path if source is not None else None
+        self.source = source
+        self.media = media
+        self.parent = parent
+        self.codec = codec
+        self.compressor = compressor
+        self.total_parts = total_parts
+        self.hasher = OrderedHasher()
+        # Parts still to upload, and the bytes of those an earlier push already did
+        self.chunks = []
+        self.resumed_bytes = 0
+        # Most parts past the last one hashed that may be uploading, None for no limit
+        self.window = None
+        # MD5 of the whole file if it is known up front, in which case parts are not hashed
+        self.md5 = None
+
+
+class Pull(object):
+    """A file on its way down from Drive, see UDS.start_pull
+
+    Args:
+        folder (dict): its media folder, with its properties
+        parts (dict): part number mapped to its Docs, see group_pieces
+        f (file): the local file, opened for writing
+        part_log (PartLog): record of the parts written so far
+        size (int): bytes in the whole file
+        chunk_size (int): bytes in every part but the last
+        codec (Codec): how its parts are encoded
+        compression (Compression): how its parts are compressed, or None
+    """
+
+    def __init__(self, folder, parts, f, part_log, size, chunk_size, codec, compression):
+        self.folder = folder
+        self.parts = parts
+        self.f = f
+        self.part_log = part_log
+        self.size = size
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self.compression = compression
+        self.write_lock = threading.Lock()
+        self.hasher = OrderedHasher()
+        # Parts still to fetch, and the bytes of those an earlier pull already wrote
+        self.to_fetch = []
+        self.resumed_bytes = 0
+
+    def close(self):
+        """Close the local file, keeping the part log for a later resume"""
+        # Parts a failed pull still held in memory give their reservations back
+        for blocks in self.hasher.drop():
+            if hasattr(blocks, 'release'):
+                blocks.release()
+        self.part_log.close()
+        self.f.close()
+
+
+class OrderedHasher(object):
+    """MD5 of a file whose parts finish in any order
+
+    Parts are added as they finish. A part that arrives before the ones ahead
+    of it waits until they have been hashed, so the digest always matches a
+    straight read of the file.
+
+    Hashing happens outside the lock, by one thread at a time: whichever
+    adds a part that can go next hashes it and any waiting parts that follow
+    it, while parts added meanwhile are only queued.
+    """
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._next = 0
+        self._waiting = {}
+        self._hashing = False
+        self._lock = threading.Lock()
+        self._turn = threading.Condition(self._lock)
+
+    def add(self, part, blocks):
+        """Add a finished part
+
+        Args:
+            part (int): the part number
+            blocks (iterable): the bytes of the part, only iterated when its turn comes
+        """
+        with self._lock:
+            self._waiting[part] = blocks
+            if self._hashing:
+                return
+            self._hashing = True
+
+        try:
+            while True:
+                with self._lock:
+                    ready = []
+                    while self._next + len(ready) in self._waiting:
+                        ready.append(self._waiting.pop(self._next + len(ready)))
+                    if not ready:
+                        self._hashing = False
+                        return
+
+                for part_blocks in ready:
+                    for block in part_blocks:
+                        self._md5.update(block)
+
+                with self._lock:
+                    self._next += len(ready)
+                    self._turn.notify_all()
+        except BaseException:
+            with self._lock:
+                self._hashing = False
+            raise
+
+    def wait_for(self, part, window):
+        """Wait until a part is fewer than window parts past the next one to hash"""
+        with self._turn:
+            while part >= self._next + window:
+                self._turn.wait()
+
+    @property
+    def parts_hashed(self):
+        return self._next
+
+    def drop(self):
+        """Give up on the parts still waiting to be hashed
+
+        Returns:
+            list: the blocks of each of them
+        """
+        with self._lock:
+            dropped = list(self._waiting.values())
+            self._waiting.clear()
+        return dropped
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+def fingerprint(source, chunk_size):
+    """Cheap identity for a file that is too large to hash up front
+
+    Combines the size with the first, middle and last chunk of the file. It
+    is only used to recognise an unfinished push of the same file, the full
+    MD5 still verifies the data on pull.
+
+    Args:
+        source (MappedFile): the mapped file
+        chunk_size (int): number of bytes in each chunk
+
+    Returns:
+        str: hex digest identifying the file
+    """
+    size = len(source)
+    sample = hashlib.md5(str(size).encode())
+    for start in sorted({0, (size // 2) // chunk_size * chunk_size, max(size - chunk_size, 0)}):
+        view = source.view(start, start + chunk_size)
+        sample.update(view)
+        view.release()
+    return sample.hexdigest()
+
+
+def is_unfinished(properties):
+    """Whether a media folder holds a push that never finished
+
+    A push records how it splits the file when it creates the folder, and
+    the MD5 only once every part is up, so a folder with the one but not the
+    other is still missing parts.
+
+    Args:
+        properties (dict): properties of the media folder
+    """
+    return bool(properties.get('fingerprint')) and not properties.get('md5')
+
+
+def group_pieces(items):
+    """Group the part Docs of a UDS file by part number
+
+    A part too large for one Doc is stored as several pieces, each tagged
+    with its index and the number of pieces. Duplicates left behind by a
+    retried upload are dropped, and a part with a piece missing is left out
+    as if it had not been uploaded at all.
+
+    Args:
+        items (list): the Docs in the media folder, with their properties
+
+    Returns:
+        dict: part number mapped to its Docs in piece order
+    """
+    found = {}
+    for item in items:
+        properties = item.get('properties', {})
+        if 'part' not in properties:
+            continue
+        pieces = found.setdefault(int(properties['part']), {})
+        pieces.setdefault(int(properties.get('piece', 0)), item)
+
+    parts = {}
+    for part, pieces in found.items():
+        expected = int(next(iter(pieces.values()))['properties'].get('pieces', 1))
+        if all(piece in pieces for piece in range(expected)):
+            parts[part] = [pieces[piece] for piece in range(expected)]
+    return parts
+
+
+def read_exactly(stream, size):
+    """Read size bytes from a stream, fewer only once it has ended
+
+    Pipes hand back whatever has arrived so far, so one read is not enough.
+    """
+    data = bytearray()
+    while len(data) < size:
+        block = stream.read(size - len(data))
+        if not block:
+            break
+        data += block
+    return bytes(data)
+
+
+def read_blocks(path, start, end, block_size=Chunk.CHUNK_READ_LENGTH_BYTES):
+    """Lazily read a byte range of a local file in blocks"""
+    with open(path, 'rb') as fd:
+        fd.seek(start)
+        while start < end:
+            block = fd.read(min(block_size, end - start))
+            if not block:
+                break
+            start += len(block)
+            yield block
+
+
+class PartLog(object):
+    """Append-only record of the parts of a pull that are safely on disk
+
+    The first line identifies the file being pulled, every following line
+    is the number of a part that has been completely written. Appending a
+    line per part keeps the log cheap to update, and a line cut short by an
+    interruption is simply ignored.
+
+    Args:
+        path (str): where to keep the log
+        header (dict): identity of the pull, a log with another header is stale
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = json.dumps(header, sort_keys=True)
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read the parts already completed
+
+        Returns:
+            set: part numbers recorded, or None if there is no log for this pull
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path) as log:
+            if log.readline().rstrip("\n") != self.header:
+                return None
+            return {int(line) for line in log if line.rstrip("\n").isdigit() and line.endswith("\n")}
+
+    def open(self, fresh):
+        """Open the log for appending, starting a new one if fresh is True"""
+        if not fresh:
+            self._drop_cut_line()
+        self._fd = open(self.path, "w" if fresh else "a")
+        if fresh:
+            self._fd.write(self.header + "\n")
+            self._fd.flush()
+
+    def _drop_cut_line(self):
+        """Remove a last line cut short, so the next part is not appended to it"""
+        with open(self.path, "r+b") as log:
+            data = log.read()
+            if data and not data.endswith(b"\n"):
+                log.truncate(data.rfind(b"\n") + 1)
+
+    def add(self, part):
+        with self._lock:
+            self._fd.write("%d\n" % part)
+            self._fd.flush()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def write_at(f, data, offset, lock):
+    """Write data at a fixed offset of an open file
+
+    Uses a positional write where the platform has one, so workers never
+    share a file position. Elsewhere the seek and write happen under lock.
+
+    Args:
+        f (file): file opened for binary writing
+        data (bytes): data to write
+        offset (int): position in the file to write at
+        lock (threading.Lock): lock guarding the file position
+    """
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(f.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        with lock:
+            f.seek(offset)
+            f.write(data)
+
+
+class PartWriter(object):
+    """Sink that writes successive blocks of one part from its offset onwards
+
+    The blocks written are kept in `blocks` so they can be hashed once the
+    part is complete, without reading them back from disk.
+    """
+
+    def __init__(self, f, offset, lock):
+        self.f = f
+        self.offset = offset
+        self.lock = lock
+        self.blocks = []
+
+    def __call__(self, data):
+        write_at(self.f, data, self.offset, self.lock)
+        self.offset += len(data)
+        self.blocks.append(data)
+
+
+class RangeReader(io.RawIOBase):
+    """Seekable, read-only view of a UDS file that fetches parts on demand
+
+    Parts are fixed size, so any offset maps straight to the one part that
+    holds it. Only the parts covering what is read are fetched. Reading on
+    from one part into the next starts fetching the parts after it in the
+    background, so a sequential read is not held up by a round trip per
+    part, while a seek does not waste fetches on parts that are skipped.
+
+    With a memory budget, every part is fetched under a reservation of
+    part_memory, cut down to the part's size once it is in and given back
+    when the part is dropped. Parts are only read ahead while the budget
+    has room for them.
+
+    Args:
+        fetch (callable): fetches a part, given its number, as bytes
+        size (int): bytes in the whole file
+        chunk_size (int): bytes in every part but the last
+        read_ahead (int): most parts fetched ahead of a sequential read
+        memory (MemoryBudget): budget parts are reserved from, None for none
+        part_memory (int): peak bytes of a part while it is fetched, at least chunk_size
+    """
+
+    def __init__(self, fetch, size, chunk_size, read_ahead=4, memory=None, part_memory=None):
+        super().__init__()
+        self.fetch = fetch
+        self.size = size
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        self.memory = memory
+        self.part_memory = max(part_memory or 0, chunk_size)
+        self._position = 0
+        self._last_part = None
+        # Decoded parts, least recently read first, and fetches in flight
+        self._parts = collections.OrderedDict()
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, read_ahead))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence {}".format(whence))
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        self._checkClosed()
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self._position < self.size:
+            part, start = divmod(self._position, self.chunk_size)
+            data = self._part(part)
+            block = data[start:start + len(view) - filled]
+            if not block:
+                raise IOError("Part {} ends before the file does".format(part))
+            view[filled:filled + len(block)] = block
+            filled += len(block)
+            self._position += len(block)
+        return filled
+
+    def _part(self, part):
+        sequential = self._last_part is not None and part in (self._last_part, self._last_part + 1)
+        self._last_part = part
+
+        # Fetches ahead of where the reader was before a seek are not wanted now
+        for stale in [ahead for ahead in self._pending if not part <= ahead <= part + self.read_ahead]:
+            self._drop_pending(stale)
+
+        if part in self._parts:
+            self._parts.move_to_end(part)
+            data = self._parts[part]
+        else:
+            future = self._pending.pop(part, None)
+            if future is not None:
+                data = future.result()
+            else:
+                self._reserve()
+                data = self._fetch(part)
+            self._parts[part] = data
+
+        # The current part and those read ahead of it are all that is kept
+        while len(self._parts) > self.read_ahead + 1:
+            self._release(self._part_size(self._parts.popitem(last=False)[0]))
+
+        if sequential:
+            last = min(part + self.read_ahead, (self.size - 1) // self.chunk_size)
+            for ahead in range(part + 1, last + 1):
+                if ahead in self._parts or ahead in self._pending:
+                    continue
+                if self.memory is not None and not self.memory.try_reserve(self.part_memory):
+                    break
+                self._pending[ahead] = self._executor.submit(self._fetch, ahead)
+        return data
+
+    def _part_size(self, part):
+        return min(self.chunk_size, self.size - part * self.chunk_size)
+
+    def _fetch(self, part):
+        """Fetch a part reserved with part_memory, keeping only its size reserved once it is in"""
+        try:
+            data = self.fetch(part)
+        except BaseException:
+            self._release(self.part_memory)
+            raise
+        self._release(self.part_memory - self._part_size(part))
+        return data
+
+    def _reserve(self):
+        """Reserve memory to fetch a part that is needed now
+
+        Parts kept from earlier reads are dropped while the budget has no
+        room, and if that is not enough so are the parts being read ahead,
+        so the reader never waits on memory it holds itself.
+        """
+        if self.memory is None or self.memory.try_reserve(self.part_memory):
+            return
+        while self._parts:
+            self._release(self._part_size(self._parts.popitem(last=False)[0]))
+            if self.memory.try_reserve(self.part_memory):
+                return
+        for ahead in list(self._pending):
+            self._drop_pending(ahead)
+        self.memory.reserve(self.part_memory)
+
+    def _drop_pending(self, part):
+        future = self._pending.pop(part)
+        future.cancel()
+        size = self._part_size(part)
+
+        def release(done):
+            # A fetch already running gives its part back once it is done, one that failed already has
+            if done.cancelled():
+                self._release(self.part_memory)
+            elif done.exception() is None:
+                self._release(size)
+
+        future.add_done_callback(release)
+
+    def _release(self, nbytes):
+        if self.memory is not None:
+            self.memory.release(nbytes)
+
+    def close(self):
+        if not self.closed:
+            for part in list(self._pending):
+                self._drop_pending(part)
+            self._executor.shutdown(wait=True)
+            while self._parts:
+                self._release(self._part_size(self._parts.popitem(last=False)[0]))
+        super().close()
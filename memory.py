@@ -0,0 +1,114 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class MemoryBudget(object):
+    """Cap on the memory held by parts in flight, shared by every transfer
+
+    Each part reserves what it will hold at its peak before it starts, and
+    waits while the budget is spent, so new work is held back rather than
+    the process growing without bound. One reservation is always let
+    through when nothing else is held, so a part larger than the whole
+    budget still goes, on its own.
+
+    Args:
+        limit (int): bytes that may be reserved at once, None for no limit
+        stats (Stats): where time spent waiting for memory is recorded
+    """
+
+    def __init__(self, limit, stats=None):
+        self.limit = limit
+        self.stats = stats
+        self.in_use = 0
+        self.peak = 0
+        self._available = threading.Condition()
+
+    def _fits(self, nbytes):
+        return self.limit is None or self.in_use == 0 or self.in_use + nbytes <= self.limit
+
+    def reserve(self, nbytes):
+        """Reserve memory, waiting until the budget has room for it"""
+        with self._available:
+            if not self._fits(nbytes):
+                start = time.perf_counter()
+                while not self._fits(nbytes):
+                    self._available.wait()
+                if self.stats is not None:
+                    self.stats.add_stage('memory', time.perf_counter() - start, nbytes)
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+
+    def try_reserve(self, nbytes):
+        """Reserve memory only if the budget has room for it now
+
+        Unlike reserve, the first reservation is not let through regardless.
+
+        Returns:
+            bool: whether the memory was reserved
+        """
+        with self._available:
+            if self.limit is not None and self.in_use + nbytes > self.limit:
+                return False
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+            return True
+
+    def release(self, nbytes):
+        with self._available:
+            self.in_use -= nbytes
+            self._available.notify_all()
+
+    @contextmanager
+    def hold(self, nbytes):
+        """Reserve memory for the duration of a block"""
+        self.reserve(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+    def window(self, nbytes):
+        """How many parts of nbytes each fit in the budget, at least one"""
+        if self.limit is None:
+            return None
+        return max(1, self.limit // nbytes)
+
+
+class HeldBlocks(object):
+    """Blocks of a part kept in memory under a reservation until they are used
+
+    The reservation is released once the blocks have been iterated, or by
+    release if they never will be.
+
+    Args:
+        budget (MemoryBudget): the budget the blocks were reserved from
+        nbytes (int): bytes reserved
+        blocks (list): the blocks
+    """
+
+    def __init__(self, budget, nbytes, blocks):
+        self.budget = budget
+        self.nbytes = nbytes
+        self.blocks = blocks
+
+    def __iter__(self):
+        try:
+            for block in self.blocks:
+                yield block
+        finally:
+            self.release()
+
+    def release(self):
+        if self.blocks is not None:
+            self.blocks = None
+            self.budget.release(self.nbytes)
+
+
+def part_memory(chunk_size, codec):
+    """Rough peak memory of one part in flight
+
+    The raw part, its encoded text and the request body or response built
+    from that text can all be alive at once.
+    """
+    return chunk_size + 2 * codec.encoded_size(chunk_size)
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import zlib
+
+# Files smaller than this are packed together rather than pushed on their own
+PACK_MEMBER_LIMIT = 1024 * 1024
+
+# A pack is closed once it holds this many bytes or members, so one pack
+# never has to be pulled whole to get at most of its members
+PACK_MAX_BYTES = 64 * 1024 * 1024
+PACK_MAX_MEMBERS = 10000
+# The index has to fit in one Doc whatever the codec, even if it does not compress
+PACK_MAX_INDEX_BYTES = 600000
+# Offset, length, md5 and JSON punctuation of one index entry, besides its name
+INDEX_ENTRY_BYTES = 64
+
+PACK_SUFFIX = ".udspack"
+INDEX_VERSION = 1
+
+
+def is_small(path):
+    """Whether a file is small enough to go in a pack"""
+    return os.path.isfile(path) and os.path.getsize(path) < PACK_MEMBER_LIMIT
+
+
+def plan(members):
+    """Split files into packs
+
+    Args:
+        members (list): (path, name in the pack) for each file
+
+    Returns:
+        list: the members of each pack, sorted by name so that packing the
+        same files again gives the same pack, and an interrupted push of it
+        can be resumed
+    """
+    packs = []
+    current, current_bytes, index_bytes = [], 0, 0
+    for path, name in sorted(members, key=lambda member: member[1]):
+        size = os.path.getsize(path)
+        entry_bytes = len(name.encode('utf-8')) + INDEX_ENTRY_BYTES
+        if current and (current_bytes + size > PACK_MAX_BYTES or len(current) >= PACK_MAX_MEMBERS or
+                        index_bytes + entry_bytes > PACK_MAX_INDEX_BYTES):
+            packs.append(current)
+            current, current_bytes, index_bytes = [], 0, 0
+        current.append((path, name))
+        current_bytes += size
+        index_bytes += entry_bytes
+    if current:
+        packs.append(current)
+    return packs
+
+
+def pack_name(base, number):
+    return "{}.{}{}".format(base, number, PACK_SUFFIX)
+
+
+def unpacked_name(name):
+    """Name of the folder a pack's members are extracted to"""
+    return name[:-len(PACK_SUFFIX)] if name.endswith(PACK_SUFFIX) else name
+
+
+def member_path(folder, name):
+    """Where to extract a member to
+
+    Raises:
+        ValueError: if the name would place the member outside the folder
+    """
+    path = os.path.normpath(os.path.join(folder, name))
+    if os.path.isabs(name) or not path.startswith(os.path.normpath(folder) + os.sep):
+        raise ValueError("Member {} is outside the pack".format(name))
+    return path
+
+
+def write_pack(members, path):
+    """Concatenate files into a pack
+
+    Args:
+        members (list): (path, name in the pack) for each file, in order
+        path (str): where to write the pack
+
+    Returns:
+        list: the index, a [name, offset, length, md5] entry per member
+    """
+    index = []
+    offset = 0
+    with open(path, 'wb') as pack:
+        for member_path, name in members:
+            md5 = hashlib.md5()
+            with open(member_path, 'rb') as f:
+                data = f.read()
+            md5.update(data)
+            pack.write(data)
+            index.append([name, offset, len(data), md5.hexdigest()])
+            offset += len(data)
+    return index
+
+
+def dump_index(index):
+    """Compress an index for storing as a Doc, see load_index"""
+    return zlib.compress(json.dumps({'version': INDEX_VERSION, 'members': index},
+                                    separators=(',', ':')).encode('utf-8'), 9)
+
+
+def load_index(data):
+    """Read an index stored with dump_index
+
+    Returns:
+        list: a [name, offset, length, md5] entry per member, in offset order
+    """
+    return json.loads(zlib.decompress(data).decode('utf-8'))['members']
+
+
+def parts_for(member, chunk_size):
+    """Numbers of the parts a member's bytes are stored in"""
+    _, offset, length, _ = member
+    if length == 0:
+        return range(0)
+    return range(offset // chunk_size, (offset + length - 1) // chunk_size + 1)
+
+
+def member_bytes(member, parts, chunk_size):
+    """Cut a member out of the decoded parts that hold it
+
+    Args:
+        member (list): the member's index entry
+        parts (dict): part number mapped to its decoded bytes, for at least
+            the parts in parts_for(member)
+        chunk_size (int): bytes in every part but the last
+
+    Returns:
+        bytes: the member
+    """
+    _, offset, length, _ = member
+    data = bytearray()
+    for part in parts_for(member, chunk_size):
+        start = max(offset - part * chunk_size, 0)
+        end = min(offset + length - part * chunk_size, chunk_size)
+        data += parts[part][start:end]
+    return bytes(data)
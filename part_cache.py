@@ -0,0 +1,120 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_FOLDER = "cache"
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class PartCache(object):
+    """Decoded parts kept on local disk, so pulling a file again skips Drive
+
+    Parts are keyed on the SHA-256 of their raw bytes where it was recorded
+    at push time, so identical parts of different files share one entry,
+    and are checked against it when read back. Older parts without one are
+    keyed on the IDs and versions of their Docs instead, which change if a
+    Doc is replaced or edited.
+
+    Entries are files in the cache folder, with their size and when they
+    were last used in a SQLite database alongside. Once the cache grows past
+    max_bytes the least recently used entries are evicted. Several processes
+    can share one cache folder.
+
+    Args:
+        folder (str): where to keep the cache
+        max_bytes (int): most bytes of parts to keep
+    """
+
+    def __init__(self, folder=CACHE_FOLDER, max_bytes=DEFAULT_MAX_BYTES):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._db = sqlite3.connect(os.path.join(folder, "cache.db"), timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries "
+                             "(key TEXT PRIMARY KEY, size INTEGER NOT NULL, used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+
+    @staticmethod
+    def key(pieces):
+        """Build the cache key for a part
+
+        Args:
+            pieces (list): the part's Docs in piece order, see file_parts.group_pieces
+        """
+        content_hash = pieces[0].get('properties', {}).get('hash')
+        if content_hash:
+            return "sha256:" + content_hash
+        return "docs:" + ",".join("{}@{}".format(piece['id'], piece.get('version', '')) for piece in pieces)
+
+    def _path(self, key):
+        return os.path.join(self.folder, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get(self, pieces):
+        """Look up a part
+
+        Returns:
+            bytes: the decoded part, or None if it is not cached
+        """
+        key = self.key(pieces)
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+
+        if key.startswith("sha256:") and hashlib.sha256(data).hexdigest() != key[len("sha256:"):]:
+            self._remove(key)
+            return None
+
+        with self._lock, self._db:
+            self._db.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+        return data
+
+    def put(self, pieces, data):
+        """Cache a part, evicting others if the cache is full
+
+        Args:
+            pieces (list): the part's Docs in piece order
+            data (bytes): the decoded part
+        """
+        if len(data) > self.max_bytes:
+            return
+
+        key = self.key(pieces)
+        path = self._path(key)
+        # Written under a name of its own first, so readers never see half a part
+        temp_path = "{}.{}.{}".format(path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO entries (key, size, used) VALUES (?, ?, ?)",
+                             (key, len(data), time.time()))
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            evicted = []
+            for old_key, size in self._db.execute("SELECT key, size FROM entries ORDER BY used"):
+                if total <= self.max_bytes:
+                    break
+                evicted.append(old_key)
+                total -= size
+            self._db.executemany("DELETE FROM entries WHERE key = ?", [(old_key,) for old_key in evicted])
+
+        for old_key in evicted:
+            self._unlink(old_key)
+
+    def _remove(self, key):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._unlink(key)
+
+    def _unlink(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
@@ -0,0 +1,83 @@
+import json
+import sqlite3
+import threading
+
+INDEX_PATH = "uds.db"
+
+
+class PartIndex(object):
+    """Local index of the part Docs already stored in Drive, by content
+
+    Parts are keyed on how they were stored (codec and compression) and the
+    SHA-256 of their raw bytes. A part that is already indexed can be copied
+    on the Drive side instead of being uploaded again.
+
+    Entries are only hints: a Doc may have been deleted since it was
+    indexed, so callers fall back to uploading when a copy fails.
+
+    Args:
+        path (str): SQLite database to keep the index in
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS parts (key TEXT PRIMARY KEY, pieces TEXT NOT NULL)")
+
+    @staticmethod
+    def key(codec, compressor, content_hash):
+        """Build the index key for a part
+
+        Args:
+            codec (str): name of the codec the part was encoded with
+            compressor (str): name of the compression used on the file, or None
+            content_hash (str): SHA-256 of the raw part
+        """
+        return "{}|{}|{}".format(codec, compressor or '', content_hash)
+
+    def get(self, key):
+        """Look up the Docs holding a part
+
+        Returns:
+            list: a dict per piece with the Doc id and its part properties,
+            in piece order, or None if the part is not indexed
+        """
+        with self._lock:
+            row = self._db.execute("SELECT pieces FROM parts WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add(self, key, pieces):
+        """Record the Docs holding a part, see get"""
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO parts (key, pieces) VALUES (?, ?)",
+                             (key, json.dumps(pieces)))
+
+    def discard(self, key):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM parts WHERE key = ?", (key,))
+
+    def add_folder_parts(self, properties, parts):
+        """Index the parts of a UDS file that has been listed anyway
+
+        Args:
+            properties (dict): properties of the media folder
+            parts (dict): part number mapped to its Docs, see file_parts.group_pieces
+        """
+        with self._lock, self._db:
+            for pieces in parts.values():
+                content_hash = pieces[0].get('properties', {}).get('hash')
+                if content_hash:
+                    key = self.key(properties.get('codec'), properties.get('compression'), content_hash)
+                    self._db.execute("INSERT OR IGNORE INTO parts (key, pieces) VALUES (?, ?)",
+                                     (key, json.dumps([piece_record(piece['id'], piece['properties'])
+                                                       for piece in pieces])))
+
+
+def piece_record(doc_id, properties):
+    """What the index keeps about one piece of a part
+
+    The part number is left out, since a copy takes the number of the part
+    it is standing in for.
+    """
+    return {'id': doc_id, 'properties': {key: value for key, value in properties.items() if key != 'part'}}
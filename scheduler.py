@@ -0,0 +1,182 @@
+import json
+import random
+import socket
+import ssl
+import threading
+import time
+
+# Drive allows 12,000 queries per minute per user
+DEFAULT_RATE = 200
+DEFAULT_BURST = 100
+
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 64
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'sharingRateLimitExceeded'}
+RETRYABLE_EXCEPTIONS = (socket.timeout, ConnectionError, ssl.SSLError)
+
+
+class TokenBucket(object):
+    """Spreads requests out to at most rate per second, after a burst
+
+    Args:
+        rate (float): tokens added per second, None for no limit
+        burst (int): most tokens that can be saved up
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Take a token, waiting for one if the bucket is empty"""
+        while self.rate:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class Scheduler(object):
+    """Central gate for every request sent to Drive
+
+    Requests are paced by a token bucket and limited to a number in flight
+    that adapts to throttling: it grows by one for every window of
+    successful requests and halves when Drive pushes back. Throttled and
+    transient failures are retried with exponential backoff and full
+    jitter, never sooner than Drive's Retry-After. Other errors are
+    returned at once for the caller to raise.
+
+    Args:
+        max_concurrency (int): most requests in flight at once
+        bucket (TokenBucket): pacing for new requests
+        stats (Stats): where retries and time spent backing off are recorded
+    """
+
+    def __init__(self, max_concurrency, bucket=None, stats=None):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.bucket = bucket or TokenBucket()
+        self.stats = stats
+        self.retries = 0
+        self.throttled = 0
+        self._in_flight = 0
+        self._epoch = 0
+        self._slots = threading.Condition()
+
+    def call(self, send):
+        """Send a request, retrying it for as long as that is worthwhile
+
+        Args:
+            send (callable): sends the request, returning an httplib2
+                (response, content) pair
+
+        Returns:
+            tuple: the last response and content
+        """
+        for attempt in range(MAX_ATTEMPTS):
+            last_attempt = attempt == MAX_ATTEMPTS - 1
+            self.bucket.take()
+            epoch = self._acquire()
+            try:
+                response, content = send()
+            except RETRYABLE_EXCEPTIONS:
+                self._release()
+                if last_attempt:
+                    raise
+                self._backoff(attempt)
+                continue
+            except BaseException:
+                # Whatever else went wrong, the slot is not lost with it
+                self._release()
+                raise
+
+            verdict = classify(response, content)
+            if verdict == 'throttled':
+                self._decrease(epoch)
+            self._release(success=verdict == 'ok')
+
+            if verdict == 'fatal' or verdict == 'ok' or last_attempt:
+                return response, content
+            self._backoff(attempt, retry_after(response))
+
+    def _acquire(self):
+        with self._slots:
+            while self._in_flight >= min(int(self.limit), self.max_concurrency):
+                self._slots.wait()
+            self._in_flight += 1
+            return self._epoch
+
+    def _release(self, success=False):
+        with self._slots:
+            self._in_flight -= 1
+            if success:
+                # Additive increase, about one more slot per window of successes
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._slots.notify_all()
+
+    def _decrease(self, epoch):
+        with self._slots:
+            self.throttled += 1
+            # Requests sent before the last cut were throttled by the old
+            # limit, so they do not cut it again
+            if epoch == self._epoch:
+                self.limit = max(1.0, self.limit / 2)
+                self._epoch += 1
+
+    def _backoff(self, attempt, at_least=0):
+        self.retries += 1
+        delay = max(at_least, random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+        if self.stats is None:
+            time.sleep(delay)
+            return
+
+        self.stats.add_retry()
+        with self.stats.stage('backoff'):
+            time.sleep(delay)
+
+
+def classify(response, content):
+    """Decide what to do about a response
+
+    Returns:
+        str: 'ok', 'throttled' if Drive asked for fewer requests, 'retry' for
+        a transient failure, or 'fatal' if retrying cannot help
+    """
+    status = response.status
+    if status < 400:
+        return 'ok'
+    if status == 429:
+        return 'throttled'
+    if status == 403:
+        return 'throttled' if error_reason(content) in RATE_LIMIT_REASONS else 'fatal'
+    if status in RETRYABLE_STATUSES:
+        return 'retry'
+    return 'fatal'
+
+
+def error_reason(content):
+    """The reason Drive gave for an error, or None"""
+    try:
+        return json.loads(content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def retry_after(response):
+    """Seconds Drive asked to wait before retrying, 0 if it did not say"""
+    try:
+        return max(0.0, float(response.get('retry-after', 0)))
+    except ValueError:
+        # An HTTP date rather than a number of seconds
+        return 0.0
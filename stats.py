@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Stages a push or pull spends its time in, see Stats.stage
+STAGES = ('read', 'hash', 'compress', 'encode', 'request', 'cache', 'decode', 'decompress', 'write', 'backoff', 'memory')
+
+
+class Stats(object):
+    """Where the time of a push or pull goes, and what it cost in API calls
+
+    Stage times are exclusive: when one stage runs inside another, such as
+    writing decoded data from within a download, its time is taken off the
+    outer stage. Summed over threads, stage times add up to the time spent
+    working.
+
+    Hooks are called with a dict for every event, so tracing can be plugged
+    in without changing UDS or GoogleAPI. Events are either
+    {'kind': 'stage', 'name', 'seconds', 'bytes'} or
+    {'kind': 'call', 'name', 'status', 'seconds', 'sent', 'received'}.
+    """
+
+    def __init__(self):
+        self.hooks = []
+        self.stages = {}
+        self.calls = {}
+        self.retries = 0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        """Time a block of work as one stage
+
+        Args:
+            name (str): one of STAGES
+            nbytes (int): bytes the work handled
+        """
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.add_stage(name, elapsed - nested, nbytes)
+
+    def add_stage(self, name, seconds, nbytes=0):
+        with self._lock:
+            totals = self.stages.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'count': 0})
+            totals['seconds'] += seconds
+            totals['bytes'] += nbytes
+            totals['count'] += 1
+        self._emit({'kind': 'stage', 'name': name, 'seconds': seconds, 'bytes': nbytes})
+
+    def timed(self, name, fn):
+        """Wrap a callable taking a block of data, such as a sink, in a stage"""
+        def call(data):
+            with self.stage(name, len(data)):
+                return fn(data)
+        return call
+
+    def add_call(self, name, status, seconds, sent=0, received=0):
+        """Record one round trip to Drive"""
+        with self._lock:
+            totals = self.calls.setdefault(name, {'count': 0, 'errors': 0, 'seconds': 0.0, 'sent': 0,
+                                                  'received': 0})
+            totals['count'] += 1
+            totals['errors'] += status >= 400
+            totals['seconds'] += seconds
+            totals['sent'] += sent
+            totals['received'] += received
+        self._emit({'kind': 'call', 'name': name, 'status': status, 'seconds': seconds, 'sent': sent,
+                    'received': received})
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def _emit(self, event):
+        for hook in self.hooks:
+            hook(event)
+
+    def summary(self):
+        """Everything recorded so far, as plain data"""
+        with self._lock:
+            return {
+                'elapsed': time.monotonic() - self._started,
+                'stages': {name: dict(totals) for name, totals in self.stages.items()},
+                'calls': {name: dict(totals) for name, totals in self.calls.items()},
+                'retries': self.retries,
+                'bytes_sent': sum(totals['sent'] for totals in self.calls.values()),
+                'bytes_received': sum(totals['received'] for totals in self.calls.values()),
+            }
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """The summary in the Prometheus text exposition format"""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(key, value) for key, value in labels)
+                lines.append("{}{} {}".format(name, "{%s}" % label_text if label_text else "", value))
+
+        stages = sorted(summary['stages'].items())
+        calls = sorted(summary['calls'].items())
+        metric('uds_stage_seconds_total', 'counter', "Time spent in each stage",
+               [((('stage', name),), totals['seconds']) for name, totals in stages])
+        metric('uds_stage_bytes_total', 'counter', "Bytes handled by each stage",
+               [((('stage', name),), totals['bytes']) for name, totals in stages])
+        metric('uds_api_calls_total', 'counter', "Round trips to Drive",
+               [((('method', name),), totals['count']) for name, totals in calls])
+        metric('uds_api_errors_total', 'counter', "Round trips to Drive that failed",
+               [((('method', name),), totals['errors']) for name, totals in calls])
+        metric('uds_api_seconds_total', 'counter', "Time spent waiting on Drive",
+               [((('method', name),), totals['seconds']) for name, totals in calls])
+        metric('uds_api_sent_bytes_total', 'counter', "Bytes sent to Drive", [((), summary['bytes_sent'])])
+        metric('uds_api_received_bytes_total', 'counter', "Bytes received from Drive",
+               [((), summary['bytes_received'])])
+        metric('uds_api_retries_total', 'counter', "Requests retried after throttling or a transient error",
+               [((), summary['retries'])])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write a textfile for the node exporter, replacing it atomically"""
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+
+class TimedFile(object):
+    """Writable that times its writes and close as one stage, see Stats.stage"""
+
+    def __init__(self, stats, name, fh):
+        self.stats = stats
+        self.name = name
+        self.fh = fh
+
+    def write(self, data):
+        with self.stats.stage(self.name, len(data)):
+            return self.fh.write(data)
+
+    def close(self):
+        with self.stats.stage(self.name):
+            self.fh.close()
+
+
+def call_name(method, uri):
+    """Name a Drive request after the API method it calls, as in drive.files.create"""
+    segments = [segment for segment in urlparse(uri).path.split('/') if segment]
+    if segments and segments[0] == 'batch':
+        return 'drive.batch'
+    if 'v3' not in segments:
+        return 'drive.' + method.lower()
+
+    resource = segments[segments.index('v3') + 1:]
+    if not resource:
+        return 'drive.' + method.lower()
+    if resource[0] == 'changes':
+        return 'drive.changes.' + ('getStartPageToken' if resource[1:] == ['startPageToken'] else 'list')
+    if resource[0] != 'files':
+        return 'drive.{}.{}'.format(resource[0], method.lower())
+
+    if len(resource) > 2:
+        action = resource[2]
+    elif len(resource) == 2:
+        action = {'GET': 'get', 'PATCH': 'update', 'DELETE': 'delete'}.get(method, method.lower())
+        if action == 'get' and 'alt=media' in uri:
+            action = 'get_media'
+    else:
+        action = 'create' if method == 'POST' else 'list'
+    return 'drive.files.' + action
@@ -0,0 +1,78 @@
+"""Keeping the local catalog in step with a fake Drive"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'benchmarks'))
+
+import catalog  # noqa: E402
+from api import GoogleAPI  # noqa: E402
+from fake_drive import FakeDrive  # noqa: E402
+from file_parts import UDSFile  # noqa: E402
+
+
+@pytest.fixture
+def drive():
+    drive = FakeDrive()
+    return drive, GoogleAPI(service=drive.service())
+
+
+def add_folder(service, name, finished=True):
+    properties = {'uds': 'true', 'size': '1 KB', 'size_numeric': 1000, 'fingerprint': 'f' + name}
+    if finished:
+        properties['md5'] = 'md5-' + name
+    body = {'name': name, 'mimeType': 'application/vnd.google-apps.folder', 'properties': properties}
+    return service.files().create(body=body).execute()['id']
+
+
+def names(cat):
+    return [f.name for f in cat.search()]
+
+
+def test_sync_lists_then_follows_changes(drive, tmp_path):
+    drive, api = drive
+    service = drive.service()
+    first = add_folder(service, 'a.bin')
+    add_folder(service, 'b.bin')
+    unfinished = add_folder(service, 'c.bin', finished=False)
+    cat = catalog.Catalog(str(tmp_path / 'catalog.db'))
+
+    cat.sync(api)
+
+    # Unfinished pushes are left out of the full listing
+    assert names(cat) == ['a.bin', 'b.bin']
+    token = cat.page_token
+    assert token is not None
+
+    service.files().delete(fileId=first).execute()
+    service.files().update(fileId=unfinished, body={'properties': {'md5': 'md5-c'}}).execute()
+    add_folder(service, 'd.bin', finished=False)
+    listed = drive.calls.get('drive.files.list', 0)
+
+    cat.sync(api)
+
+    # Changes are read from the feed, not a new listing
+    assert drive.calls.get('drive.files.list', 0) == listed
+    assert names(cat) == ['b.bin', 'c.bin']
+    assert cat.find('c.bin').md5 == 'md5-c'
+    assert cat.find('a.bin') is None
+    assert cat.page_token != token
+
+
+def test_apply_changes(tmp_path):
+    cat = catalog.Catalog(str(tmp_path / 'catalog.db'))
+    kept = UDSFile('kept.bin', None, None, '1 KB', '2 KB', id='1', size_numeric=1000, md5='x')
+    gone = UDSFile('gone.bin', None, None, '1 KB', '2 KB', id='2', size_numeric=1000, md5='y')
+    cat.replace([kept, gone], 'start')
+
+    renamed = UDSFile('renamed.bin', None, None, '1 KB', '2 KB', id='1', size_numeric=1000, md5='x')
+    # Removed, and no longer a UDS file (or not finished), both drop the row
+    cat.apply_changes([('1', False, renamed), ('2', True, None), ('3', False, None)], 'next')
+
+    assert names(cat) == ['renamed.bin']
+    assert cat.page_token == 'next'
+
+    # A catalog opened again carries on from the same token
+    assert catalog.Catalog(str(tmp_path / 'catalog.db')).page_token == 'next'
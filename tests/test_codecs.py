@@ -0,0 +1,183 @@
+"""Round trips of every codec, through the encoder and through a fake Drive"""
+import hashlib
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'benchmarks'))
+
+import compression  # noqa: E402
+import encoder  # noqa: E402
+import file_parts  # noqa: E402
+import uds  # noqa: E402
+from api import GoogleAPI  # noqa: E402
+from fake_drive import EXPORT_BOM, FakeDrive  # noqa: E402
+
+# Small Docs, so a file of a few hundred KB is split into several parts
+MAX_DOC_LENGTH = 40000
+
+
+def random_bytes(size, seed=0):
+    r = random.Random(seed)
+    return bytes(r.getrandbits(8) for _ in range(size))
+
+
+def text_bytes(size, seed=0):
+    """Text made of a few hundred words, which compresses well"""
+    r = random.Random(seed)
+    words = [''.join(r.choice('abcdefghij') for _ in range(r.randint(2, 9))) for _ in range(300)]
+    text = []
+    length = 0
+    while length < size:
+        line = ' '.join(r.choice(words) for _ in range(12)) + '\n'
+        text.append(line)
+        length += len(line)
+    return ''.join(text)[:size].encode('ascii')
+
+
+def decode(codec, text, step=None):
+    """Decode text with a codec's streaming decoder, written step bytes at a time"""
+    out = []
+    decoder = codec.decoder(out.append)
+    step = step or len(text) or 1
+    for start in range(0, len(text), step):
+        decoder.write(text[start:start + step])
+    decoder.close()
+    return b''.join(out)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(uds, 'MAX_DOC_LENGTH', MAX_DOC_LENGTH)
+    drive = FakeDrive()
+    return uds.UDS(api=GoogleAPI(service=drive.service())), drive
+
+
+def push_and_pull(client, drive, data, name='source.bin'):
+    with open(name, 'wb') as f:
+        f.write(data)
+    client.do_chunked_upload(name)
+    folder = next(f for f in drive.files.values()
+                  if f['name'] == name and f.get('properties', {}).get('uds') == 'true')
+    os.remove(name)
+    client.build_file(folder['id'])
+    with open(os.path.join(uds.DOWNLOADS_FOLDER, name), 'rb') as f:
+        return folder, f.read()
+
+
+@pytest.mark.parametrize('codec', sorted(encoder.CODECS))
+@pytest.mark.parametrize('spec', [None, 'zlib'])
+def test_drive_round_trip(client, monkeypatch, codec, spec):
+    client, drive = client
+    monkeypatch.setattr(uds, 'CODEC', codec)
+    monkeypatch.setattr(uds, 'COMPRESSION', spec)
+    data = text_bytes(600000) + random_bytes(50000)
+
+    folder, pulled = push_and_pull(client, drive, data)
+
+    assert pulled == data
+    assert folder['properties']['md5'] == hashlib.md5(data).hexdigest()
+    assert folder['properties']['codec'] == codec
+    assert folder['properties'].get('compression') == (spec and compression.parse(spec).name)
+    chunk_size = int(folder['properties']['chunk_size'])
+    assert -(-len(data) // chunk_size) > 1
+
+
+def test_drive_round_trip_with_pieces(client, monkeypatch):
+    """A part that compresses worse than the sample spills over into several Docs"""
+    client, drive = client
+    monkeypatch.setattr(uds, 'COMPRESSION', 'zlib')
+    monkeypatch.setattr(compression, 'SAMPLE_COUNT', 1)
+    data = text_bytes(300000) + random_bytes(200000) + text_bytes(100000, seed=1)
+
+    folder, pulled = push_and_pull(client, drive, data)
+
+    assert pulled == data
+    docs = [f for f in drive.files.values() if folder['id'] in f.get('parents', [])]
+    assert any(int(doc['properties'].get('pieces', 1)) > 1 for doc in docs)
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 4, 5, 1000, 65537])
+@pytest.mark.parametrize('codec', sorted(encoder.CODECS))
+def test_codec_round_trip(codec, size):
+    codec = encoder.get_codec(codec)
+    data = random_bytes(size, seed=size)
+    text = codec.encode(data)
+
+    # The last base85 group is not padded out, so it may come up short
+    assert len(text) <= codec.encoded_size(size)
+    for step in (None, 1, 7, 4096):
+        assert decode(codec, text, step) == data
+
+
+def test_base4096_table():
+    """Every pair of base64 characters, padding included, has an ideograph of its own"""
+    alphabet = encoder._BASE64_ALPHABET + b'='
+    chars = set()
+    for first in alphabet:
+        for second in alphabet:
+            pair = bytes([first, second])
+            char = encoder._BASE4096_ENCODE[int.from_bytes(pair, sys.byteorder)]
+            assert encoder._BASE4096_DECODE[ord(char)] == pair.decode('ascii')
+            assert len(char.encode('utf-8')) == 3
+            chars.add(char)
+    assert len(chars) == len(alphabet) ** 2
+
+
+def test_base4096_split_characters():
+    codec = encoder.get_codec('base4096')
+    data = random_bytes(3001)
+    text = codec.encode(data)
+    # Writes of two bytes split most three byte characters across writes
+    assert decode(codec, EXPORT_BOM + text, step=2) == data
+
+
+@pytest.mark.parametrize('tail', [0, 1, 2, 3])
+def test_base85_tails(tail):
+    codec = encoder.get_codec('base85')
+    data = random_bytes(400 + tail, seed=tail)
+    text = codec.encode(data)
+
+    # A partial last group of n bytes is n + 1 characters, with no padding
+    assert len(text) == 500 + (tail + 1 if tail else 0)
+    for step in (1, 3, 5, 64):
+        assert decode(codec, text, step) == data
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 57, 58, 100])
+def test_stream_decoder_padding_bom_crlf(size):
+    """Exported Docs carry a BOM and CRLF line endings, and may lose padding"""
+    data = random_bytes(size, seed=size)
+    text = encoder.encode(data).rstrip(b'\n').rstrip(b'=').replace(b'\n', b'\r\n')
+    exported = EXPORT_BOM + text + b'\r\n'
+
+    for step in (1, 2, 5, None):
+        assert decode(encoder.get_codec('base64-mime'), exported, step) == data
+
+
+def test_group_pieces():
+    def doc(id_, part, piece=None, pieces=None):
+        properties = {'part': str(part)}
+        if piece is not None:
+            properties.update(piece=str(piece), pieces=str(pieces))
+        return {'id': id_, 'properties': properties}
+
+    items = [
+        doc('a', 0),
+        doc('b1', 1, 1, 2), doc('b0', 1, 0, 2),
+        # A duplicate left behind by a retried upload
+        doc('b0-again', 1, 0, 2),
+        # A part with a piece missing counts as not uploaded
+        doc('c0', 2, 0, 3), doc('c2', 2, 2, 3),
+        {'id': 'index', 'properties': {}},
+    ]
+
+    parts = file_parts.group_pieces(items)
+
+    assert sorted(parts) == [0, 1]
+    assert [piece['id'] for piece in parts[0]] == ['a']
+    assert [piece['id'] for piece in parts[1]] == ['b0', 'b1']
@@ -0,0 +1,158 @@
+"""Reading UDS files by range and keeping track of their parts"""
+import io
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import file_parts  # noqa: E402
+import memory  # noqa: E402
+
+CHUNK_SIZE = 1000
+
+
+class Parts(object):
+    """Fetches parts of data, counting fetches and the most reserved at once"""
+
+    def __init__(self, data, budget=None):
+        self.data = data
+        self.budget = budget
+        self.fetched = []
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, part):
+        with self.lock:
+            self.fetched.append(part)
+            if self.budget is not None:
+                self.peak = max(self.peak, self.budget.in_use)
+        return self.data[part * CHUNK_SIZE:(part + 1) * CHUNK_SIZE]
+
+
+def reader(parts, read_ahead=2, budget=None, part_memory=None):
+    return file_parts.RangeReader(parts, len(parts.data), CHUNK_SIZE, read_ahead, budget, part_memory)
+
+
+DATA = bytes(range(256)) * 40 + b'tail'
+
+
+@pytest.mark.parametrize('limit', [CHUNK_SIZE, 3 * CHUNK_SIZE, 100 * CHUNK_SIZE])
+def test_range_reader_reserves_parts(limit):
+    budget = memory.MemoryBudget(limit)
+    parts = Parts(DATA, budget)
+
+    with reader(parts, read_ahead=4, budget=budget) as f:
+        assert f.read(1500) == DATA[:1500]
+        assert f.read() == DATA[1500:]
+        f.seek(5500)
+        assert f.read(10) == DATA[5500:5510]
+        assert budget.in_use <= max(limit, CHUNK_SIZE)
+
+    assert budget.in_use == 0
+    assert parts.peak <= max(limit, CHUNK_SIZE)
+
+
+def test_range_reader_keeps_only_part_size_reserved():
+    budget = memory.MemoryBudget(None)
+    parts = Parts(DATA, budget)
+
+    with reader(parts, read_ahead=0, budget=budget, part_memory=4 * CHUNK_SIZE) as f:
+        f.seek(len(DATA) - 2)
+        assert f.read() == b'il'
+        # The fetch reserved its peak, only the short last part is kept
+        assert parts.peak == 4 * CHUNK_SIZE
+        assert budget.in_use == len(DATA) % CHUNK_SIZE
+
+    assert budget.in_use == 0
+
+
+def test_range_reader_gives_back_failed_fetches():
+    budget = memory.MemoryBudget(10 * CHUNK_SIZE)
+
+    def fetch(part):
+        raise IOError("export failed")
+
+    with file_parts.RangeReader(fetch, len(DATA), CHUNK_SIZE, 2, budget) as f:
+        with pytest.raises(IOError):
+            f.read(10)
+        assert budget.in_use == 0
+
+
+@pytest.mark.parametrize('position, length', [
+    (0, 10), (990, 20), (999, 1), (1000, 1), (500, 2500), (0, len(DATA)), (len(DATA) - 3, 10), (len(DATA), 5),
+])
+def test_range_reader_reads_across_parts(position, length):
+    parts = Parts(DATA)
+    with reader(parts) as f:
+        f.seek(position)
+        buffer = bytearray(length)
+        filled = f.readinto(buffer)
+
+        expected = DATA[position:position + length]
+        assert filled == len(expected)
+        assert bytes(buffer[:filled]) == expected
+        assert f.tell() == position + filled
+        # Only the parts the range covers are fetched when reading from a seek
+        covered = set(range(position // CHUNK_SIZE, (position + filled - 1) // CHUNK_SIZE + 1)) if filled else set()
+        assert covered <= set(parts.fetched)
+
+
+def test_range_reader_seek():
+    with reader(Parts(DATA)) as f:
+        assert f.seek(-4, io.SEEK_END) == len(DATA) - 4
+        assert f.read() == b'tail'
+        assert f.seek(-1500, io.SEEK_CUR) == len(DATA) - 1500
+        assert f.read(3) == DATA[-1500:-1497]
+        with pytest.raises(ValueError):
+            f.seek(-1)
+        with pytest.raises(ValueError):
+            f.seek(0, 3)
+
+
+def test_range_reader_fetches_each_part_once():
+    parts = Parts(DATA)
+    with reader(parts, read_ahead=2) as f:
+        while f.read(300):
+            pass
+        f.seek(0)
+        f.read(10)
+
+    # Read straight through, each part is fetched once, and the first again after the seek back
+    assert sorted(parts.fetched) == sorted(list(range(len(DATA) // CHUNK_SIZE + 1)) + [0])
+
+
+def test_range_reader_short_part():
+    with file_parts.RangeReader(lambda part: b'short', len(DATA), CHUNK_SIZE) as f:
+        with pytest.raises(IOError):
+            f.read(CHUNK_SIZE + 1)
+
+
+def test_part_log_resume(tmp_path):
+    path = str(tmp_path / 'f.bin.uds-progress')
+    header = {'id': 'folder', 'size': 3000, 'md5': 'abc'}
+
+    log = file_parts.PartLog(path, header)
+    assert log.load() is None
+    log.open(fresh=True)
+    log.add(2)
+    log.add(0)
+    log.close()
+    # A line cut short by a crash does not count
+    with open(path, 'a') as f:
+        f.write('1')
+
+    resumed = file_parts.PartLog(path, header)
+    assert resumed.load() == {0, 2}
+    resumed.open(fresh=False)
+    resumed.add(3)
+    resumed.close()
+    assert file_parts.PartLog(path, header).load() == {0, 2, 3}
+
+    # The log of a different file, or a changed one, is not picked up
+    assert file_parts.PartLog(path, dict(header, md5='changed')).load() is None
+
+    resumed.remove()
+    assert not os.path.exists(path)
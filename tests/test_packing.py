@@ -0,0 +1,56 @@
+"""Packing small files together and cutting them out again"""
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import packing  # noqa: E402
+
+
+@pytest.mark.parametrize('name', ['a.txt', 'sub/b.txt', 'sub/../c.txt', './d.txt'])
+def test_member_path_inside(tmp_path, name):
+    folder = str(tmp_path / 'out')
+    path = packing.member_path(folder, name)
+
+    assert path == os.path.normpath(os.path.join(folder, name))
+    assert path.startswith(folder + os.sep)
+
+
+@pytest.mark.parametrize('name', ['../escape.txt', 'sub/../../escape.txt', '..', '.', '/etc/passwd',
+                                  os.path.join(os.sep, 'tmp', 'x')])
+def test_member_path_outside(tmp_path, name):
+    with pytest.raises(ValueError):
+        packing.member_path(str(tmp_path / 'out'), name)
+
+
+def test_member_path_sibling_prefix(tmp_path):
+    """A folder whose name only starts with the pack's is still outside it"""
+    with pytest.raises(ValueError):
+        packing.member_path(str(tmp_path / 'out'), '../out-other/x.txt')
+
+
+def test_write_pack_and_cut_members(tmp_path):
+    members = []
+    for i, size in enumerate([0, 10, 2500, 999]):
+        path = str(tmp_path / 'm{}'.format(i))
+        with open(path, 'wb') as f:
+            f.write(bytes([i]) * size)
+        members.append((path, 'dir/m{}'.format(i)))
+    pack_path = str(tmp_path / 'pack')
+
+    index = packing.load_index(packing.dump_index(packing.write_pack(members, pack_path)))
+
+    with open(pack_path, 'rb') as f:
+        data = f.read()
+    chunk_size = 1000
+    parts = {part: data[part * chunk_size:(part + 1) * chunk_size]
+             for part in range(-(-len(data) // chunk_size))}
+    for (path, name), member in zip(members, index):
+        with open(path, 'rb') as f:
+            expected = f.read()
+        assert member[0] == name
+        assert member[3] == hashlib.md5(expected).hexdigest()
+        assert packing.member_bytes(member, parts, chunk_size) == expected
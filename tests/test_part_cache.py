@@ -0,0 +1,73 @@
+"""Decoded parts kept on local disk"""
+import hashlib
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import part_cache  # noqa: E402
+
+
+def pieces(data):
+    """Docs of a part whose push recorded the hash of its data"""
+    return [{'id': 'doc-' + hashlib.md5(data).hexdigest(), 'properties': {'hash': hashlib.sha256(data).hexdigest()}}]
+
+
+def test_get_what_was_put(tmp_path):
+    cache = part_cache.PartCache(str(tmp_path / 'cache'))
+    data = b'part' * 100
+
+    assert cache.get(pieces(data)) is None
+    cache.put(pieces(data), data)
+
+    assert cache.get(pieces(data)) == data
+    # Shared with any other file that has the same part
+    assert cache.get([{'id': 'another-doc', 'properties': pieces(data)[0]['properties']}]) == data
+
+
+def test_docs_without_a_hash_are_keyed_on_their_versions(tmp_path):
+    cache = part_cache.PartCache(str(tmp_path / 'cache'))
+    docs = [{'id': 'a', 'version': '3'}, {'id': 'b', 'version': '1'}]
+    cache.put(docs, b'old part')
+
+    assert cache.get(docs) == b'old part'
+    assert cache.get([{'id': 'a', 'version': '4'}, {'id': 'b', 'version': '1'}]) is None
+
+
+def test_least_recently_used_are_evicted(tmp_path, monkeypatch):
+    clock = iter(range(1000))
+    monkeypatch.setattr(part_cache.time, 'time', lambda: next(clock))
+    cache = part_cache.PartCache(str(tmp_path / 'cache'), max_bytes=300)
+    a, b, c, d = (bytes([i]) * 100 for i in range(4))
+    for data in (a, b, c):
+        cache.put(pieces(data), data)
+
+    # Reading a makes b the least recently used
+    assert cache.get(pieces(a)) == a
+    cache.put(pieces(d), d)
+
+    assert cache.get(pieces(b)) is None
+    assert [cache.get(pieces(data)) for data in (a, c, d)] == [a, c, d]
+    assert len([name for name in os.listdir(cache.folder) if name != 'cache.db']) == 3
+
+
+def test_parts_larger_than_the_cache_are_not_kept(tmp_path):
+    cache = part_cache.PartCache(str(tmp_path / 'cache'), max_bytes=10)
+    data = b'x' * 11
+    cache.put(pieces(data), data)
+
+    assert cache.get(pieces(data)) is None
+
+
+def test_corrupt_entries_are_rejected(tmp_path):
+    cache = part_cache.PartCache(str(tmp_path / 'cache'))
+    data = b'good part' * 50
+    cache.put(pieces(data), data)
+    with open(cache._path(cache.key(pieces(data))), 'r+b') as f:
+        f.write(b'bad')
+
+    assert cache.get(pieces(data)) is None
+    # Dropped from the cache, rather than rejected on every read
+    assert not os.path.exists(cache._path(cache.key(pieces(data))))
+    cache.put(pieces(data), data)
+    assert cache.get(pieces(data)) == data
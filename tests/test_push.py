@@ -0,0 +1,135 @@
+"""Pushing and pulling batches of files through a fake Drive"""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'benchmarks'))
+
+import uds  # noqa: E402
+from api import GoogleAPI  # noqa: E402
+from fake_drive import FakeDrive  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(uds, 'MAX_DOC_LENGTH', 40000)
+    drive = FakeDrive()
+    return uds.UDS(api=GoogleAPI(service=drive.service())), drive
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def folders(drive):
+    return sorted(f['name'] for f in drive.files.values() if f.get('properties', {}).get('uds') == 'true')
+
+
+def test_push_directory_refuses_same_names(client):
+    client, drive = client
+    write('tree/a/x.txt', b'first')
+    write('tree/b/x.txt', b'second')
+    write('tree/y.txt', b'third')
+
+    with pytest.raises(ValueError, match='x.txt'):
+        client.push_directory('tree')
+
+    assert folders(drive) == []
+
+
+def test_push_directory_packs_same_names(client):
+    client, drive = client
+    write('tree/a/x.txt', b'first')
+    write('tree/b/x.txt', b'second')
+
+    client.push_directory('tree', pack=True)
+
+    assert folders(drive) == ['tree.0.udspack']
+
+
+def test_push_under_another_name(client):
+    client, drive = client
+    write('report.pdf', b'quarterly figures' * 1000)
+
+    client.do_chunked_upload('report.pdf', 'q3.pdf')
+
+    assert folders(drive) == ['q3.pdf']
+
+
+def uds_folder(drive, name):
+    return [f for f in drive.files.values()
+            if f['name'] == name and f.get('properties', {}).get('uds') == 'true']
+
+
+def fail_downloads(client, monkeypatch, drive, folder):
+    """Make every download of a file's Docs fail"""
+    docs = set(f['id'] for f in drive.files.values() if folder['id'] in f.get('parents', []))
+    download_part = client.download_part
+
+    def flaky(part_id, fh, api=None):
+        if part_id in docs:
+            raise IOError("export failed")
+        return download_part(part_id, fh, api)
+
+    monkeypatch.setattr(client, 'download_part', flaky)
+
+
+def test_push_many_isolates_failures(client):
+    client, drive = client
+    write('a.bin', b'a' * 100000)
+    write('c.bin', b'c' * 100000)
+
+    pushed, failures = client.push_many(['a.bin', 'missing.bin', 'c.bin'])
+
+    assert sorted(push.media.name for push in pushed) == ['a.bin', 'c.bin']
+    assert list(failures) == ['missing.bin']
+    assert all(push.media.md5 for push in pushed)
+
+
+def test_pull_many_isolates_failures(client, monkeypatch):
+    client, drive = client
+    for name in ('a.bin', 'b.bin', 'c.bin'):
+        write(name, name.encode() * 50000)
+        client.do_chunked_upload(name)
+    bad = uds_folder(drive, 'b.bin')[0]
+    fail_downloads(client, monkeypatch, drive, bad)
+
+    pulled, failures = client.pull_many(uds.uds_file(f) for name in ('a.bin', 'b.bin', 'c.bin')
+                                        for f in uds_folder(drive, name))
+
+    assert sorted(pull.folder['name'] for pull in pulled) == ['a.bin', 'c.bin']
+    assert list(failures) == [bad['id']]
+    for name in ('a.bin', 'c.bin'):
+        with open(os.path.join(uds.DOWNLOADS_FOLDER, name), 'rb') as f:
+            assert f.read() == name.encode() * 50000
+
+
+def test_pull_many_same_name_after_failure(client, monkeypatch):
+    """A file waiting on a pull of the same name goes ahead once that one fails"""
+    client, drive = client
+    write('same.bin', b'first' * 20000)
+    client.do_chunked_upload('same.bin')
+    write('same.bin', b'second' * 20000)
+    client.do_chunked_upload('same.bin')
+    first, second = sorted(uds_folder(drive, 'same.bin'), key=lambda f: f['id'])
+    fail_downloads(client, monkeypatch, drive, first)
+    order = [first['id'], second['id']]
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        client.pull_many([uds.uds_file(first), uds.uds_file(second)], key=lambda item: order.index(item.id_))))
+    thread.start()
+    thread.join(30)
+
+    assert not thread.is_alive()
+    pulled, failures = result[0]
+    assert [pull.folder['id'] for pull in pulled] == [second['id']]
+    assert list(failures) == [first['id']]
+    with open(os.path.join(uds.DOWNLOADS_FOLDER, 'same.bin'), 'rb') as f:
+        assert f.read() == b'second' * 20000
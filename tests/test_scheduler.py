@@ -0,0 +1,163 @@
+"""Retry classification, backoff and concurrency limits of the Scheduler"""
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'benchmarks'))
+
+import scheduler  # noqa: E402
+from fake_drive import FakeResponse  # noqa: E402
+
+
+def error(status, reason=None, headers=None):
+    errors = [{'reason': reason}] if reason else []
+    return FakeResponse(status, headers), json.dumps({'error': {'code': status, 'errors': errors}}).encode('utf-8')
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Delays the scheduler backed off for, without waiting for them"""
+    delays = []
+    monkeypatch.setattr(scheduler.time, 'sleep', delays.append)
+    return delays
+
+
+def unlimited(max_concurrency=2):
+    return scheduler.Scheduler(max_concurrency, scheduler.TokenBucket(rate=None))
+
+
+@pytest.mark.parametrize('status, reason, verdict', [
+    (200, None, 'ok'),
+    (308, None, 'ok'),
+    (429, None, 'throttled'),
+    (403, 'userRateLimitExceeded', 'throttled'),
+    (403, 'rateLimitExceeded', 'throttled'),
+    (403, 'insufficientPermissions', 'fatal'),
+    (403, None, 'fatal'),
+    (500, None, 'retry'),
+    (503, 'backendError', 'retry'),
+    (408, None, 'retry'),
+    (404, 'notFound', 'fatal'),
+    (400, None, 'fatal'),
+])
+def test_classify(status, reason, verdict):
+    assert scheduler.classify(*error(status, reason)) == verdict
+
+
+def test_retry_after(sleeps):
+    responses = [error(429, headers={'retry-after': '30'}), (FakeResponse(200), b'ok')]
+    response, content = unlimited().call(lambda: responses.pop(0))
+
+    assert content == b'ok'
+    assert len(sleeps) == 1 and sleeps[0] >= 30
+    assert scheduler.retry_after(FakeResponse(429, {'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0.0
+
+
+def test_retries_then_gives_up(sleeps):
+    calls = []
+
+    def send():
+        calls.append(1)
+        return error(503, 'backendError')
+
+    response, _ = unlimited().call(send)
+
+    assert response.status == 503
+    assert len(calls) == scheduler.MAX_ATTEMPTS
+    assert len(sleeps) == scheduler.MAX_ATTEMPTS - 1
+
+
+def test_fatal_is_not_retried(sleeps):
+    calls = []
+    response, _ = unlimited().call(lambda: calls.append(1) or error(404, 'notFound'))
+
+    assert response.status == 404
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+def test_throttling_halves_the_limit_and_successes_grow_it(sleeps):
+    gate = scheduler.Scheduler(8, scheduler.TokenBucket(rate=None))
+    responses = [error(429), (FakeResponse(200), b'')]
+    gate.call(lambda: responses.pop(0))
+
+    # Halved by the 429, then a quarter of a slot back for the retry that worked
+    assert gate.limit == 4.25
+    assert gate.throttled == 1
+
+    # About one more slot per window of successes, never past the maximum
+    for _ in range(4):
+        gate.call(lambda: (FakeResponse(200), b''))
+    assert 5.0 < gate.limit < 5.5
+    for _ in range(200):
+        gate.call(lambda: (FakeResponse(200), b''))
+    assert gate.limit == 8
+
+
+def test_one_cut_per_epoch(sleeps):
+    gate = scheduler.Scheduler(8, scheduler.TokenBucket(rate=None))
+    epoch = gate._acquire()
+    other = gate._acquire()
+    # Both requests went out under the same limit, only the first cut counts
+    gate._decrease(epoch)
+    gate._decrease(other)
+    gate._release()
+    gate._release()
+
+    assert gate.limit == 4.0
+    assert gate.throttled == 2
+
+
+@pytest.mark.parametrize('failure', [
+    ConnectionResetError('reset'),
+    OSError('not retryable'),
+    RuntimeError('token refresh failed'),
+    KeyboardInterrupt(),
+])
+def test_slots_are_released_on_every_exit(sleeps, failure):
+    gate = unlimited(max_concurrency=2)
+
+    def send():
+        raise failure
+
+    for _ in range(3):
+        with pytest.raises(type(failure)):
+            gate.call(send)
+        assert gate._in_flight == 0
+
+    for response in (error(429), error(503), error(404), (FakeResponse(200), b'')):
+        gate.call(lambda: response)
+        assert gate._in_flight == 0
+
+
+def test_concurrency_is_limited(sleeps):
+    gate = unlimited(max_concurrency=2)
+    running = []
+    peak = []
+    release = threading.Event()
+    lock = threading.Lock()
+
+    def send():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        release.wait(5)
+        with lock:
+            running.pop()
+        return FakeResponse(200), b''
+
+    threads = [threading.Thread(target=gate.call, args=(send,)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while gate._in_flight < 2:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == 2
+    assert gate._in_flight == 0
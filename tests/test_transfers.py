@@ -0,0 +1,117 @@
+"""Running many transfers on one pool of workers"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import transfers  # noqa: E402
+
+
+class Job(object):
+    def __init__(self, name, parts):
+        self.name = name
+        self.parts = parts
+        self.resumed_bytes = 0
+        self.done = []
+        self.finished = False
+        self.closed = False
+
+
+class Recorder(object):
+    """Tasks for run_transfers that record what ran, and how much at once"""
+
+    def __init__(self, fail_start=(), fail_part=(), fail_finish=(), delay=0):
+        self.fail_start = fail_start
+        self.fail_part = fail_part
+        self.fail_finish = fail_finish
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.order = []
+
+    def _task(self, event):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.order.append(event)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+
+    def start(self, item):
+        name, parts = item
+        self._task(('start', name))
+        if name in self.fail_start:
+            raise IOError("cannot start " + name)
+        job = Job(name, parts)
+        return job, list(range(parts))
+
+    def run_part(self, job, part):
+        self._task(('part', job.name, part))
+        if (job.name, part) in self.fail_part:
+            raise IOError("part {} of {} failed".format(part, job.name))
+        job.done.append(part)
+        return 10
+
+    def finish(self, job):
+        self._task(('finish', job.name))
+        if job.name in self.fail_finish:
+            raise IOError("cannot finish " + job.name)
+        job.finished = True
+
+    def close(self, job):
+        job.closed = True
+
+    def run(self, items, workers=3, key=None):
+        return transfers.run_transfers(items, self.start, self.run_part, self.finish, self.close, workers, key=key)
+
+
+def test_every_part_runs():
+    recorder = Recorder()
+    done, failures = recorder.run([('a', 3), ('b', 0), ('c', 5)])
+
+    assert sorted(job.name for job in done) == ['a', 'b', 'c']
+    assert failures == []
+    for job in done:
+        assert sorted(job.done) == list(range(job.parts))
+        assert job.finished and job.closed
+
+
+@pytest.mark.parametrize('failing', [
+    {'fail_start': ('b',)},
+    {'fail_part': (('b', 1),)},
+    {'fail_finish': ('b',)},
+])
+def test_one_failure_does_not_stop_the_rest(failing):
+    recorder = Recorder(**failing)
+    done, failures = recorder.run([('a', 4), ('b', 4), ('c', 4)])
+
+    assert sorted(job.name for job in done) == ['a', 'c']
+    assert [item for item, _ in failures] == [('b', 4)]
+    assert isinstance(failures[0][1], IOError)
+    assert all(job.finished for job in done)
+
+
+def test_workers_are_the_limit():
+    recorder = Recorder(delay=0.01)
+    recorder.run([(name, 4) for name in 'abcdef'], workers=2)
+
+    assert recorder.peak == 2
+
+
+def test_same_key_waits_its_turn():
+    recorder = Recorder(delay=0.005, fail_part=(('x1', 0),))
+    items = [('x1', 2), ('y', 2), ('x2', 2), ('x3', 1)]
+    done, failures = recorder.run(items, workers=4, key=lambda item: item[0][0])
+
+    assert sorted(job.name for job in done) == ['x2', 'x3', 'y']
+    assert [item for item, _ in failures] == [('x1', 2)]
+    # Each x starts only once the one before it is done with
+    events = recorder.order
+    assert events.index(('start', 'x2')) > max(i for i, e in enumerate(events) if e[:2] == ('part', 'x1'))
+    assert events.index(('start', 'x3')) > events.index(('finish', 'x2'))
@@ -0,0 +1,108 @@
+"""Pooled HTTPS connections of the Transport, against a local TLS server"""
+import datetime
+import http.server
+import os
+import socket
+import ssl
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import api  # noqa: E402
+import httplib2  # noqa: E402
+
+x509 = pytest.importorskip('cryptography.x509')
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from cryptography.x509.oid import NameOID  # noqa: E402
+
+
+class Credentials(object):
+    def authorize(self, pooled):
+        return pooled
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def certificate(tmp_path_factory):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName('localhost')]), critical=False)
+            .sign(key, hashes.SHA256()))
+    folder = tmp_path_factory.mktemp('tls')
+    cert_path, key_path = str(folder / 'cert.pem'), str(folder / 'key.pem')
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+@pytest.fixture(scope='module')
+def server(certificate):
+    httpd = http.server.ThreadingHTTPServer(('localhost', 0), Handler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*certificate)
+    httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield 'https://localhost:%d/' % httpd.server_address[1]
+    httpd.shutdown()
+
+
+def test_connections_share_one_context(certificate, server, monkeypatch):
+    built = []
+    build = httplib2._build_ssl_context
+    monkeypatch.setattr(httplib2, '_build_ssl_context', lambda *args, **kwargs: built.append(1) or build(*args, **kwargs))
+    transport = api.Transport(Credentials(), size=3, socket_buffer=1 << 20)
+    transport.ssl_context.load_verify_locations(certificate[0])
+
+    for _ in range(3):
+        pooled = api._PooledHttp(transport._connection_type)
+        response, content = pooled.request(server)
+        connection = next(iter(pooled.connections.values()))
+        assert (response.status, content) == (200, b'ok')
+        # Linux doubles the size asked for, to allow for bookkeeping
+        assert connection.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 1 << 20
+        connection.close()
+
+    assert len(built) == 1
+    assert 'localhost' in transport.tls_sessions
+
+
+def test_requests_go_through_the_pool(certificate, server):
+    transport = api.Transport(Credentials(), size=2)
+    transport.ssl_context.load_verify_locations(certificate[0])
+
+    for _ in range(4):
+        response, content = transport.request(server)
+        assert (response.status, content) == (200, b'ok')
+    assert len(transport._idle) == 1
+    transport.close()
+
+
+def test_falls_back_to_plain_http(monkeypatch):
+    monkeypatch.setattr(api, 'SHARED_SSL_CONTEXT', False)
+    transport = api.Transport(Credentials())
+
+    with transport.connection() as pooled:
+        assert type(pooled) is httplib2.Http
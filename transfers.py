@@ -0,0 +1,164 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class _Transfer(object):
+    """Where one item stands in run_transfers"""
+
+    def __init__(self, item, key):
+        self.item = item
+        self.key = key
+        self.transfer = None
+        self.remaining = 0
+        self.in_flight = 0
+        self.error = None
+        self.finished = False
+
+
+def run_transfers(items, start, run_part, finish, close, workers, key=None, progress=None):
+    """Run many transfers, each split into parts, on one pool of workers
+
+    Getting a transfer ready, running its parts and finishing it are all
+    tasks for the same workers, so one transfer's setup overlaps with the
+    parts of others instead of leaving the pipe idle. Parts of transfers
+    already under way go first, and no more transfers are under way than
+    there are workers, so open files and half-done folders do not pile up.
+    A transfer that fails is given up on, its parts not yet started are
+    skipped, and the rest carry on. Items with the same key are taken one
+    at a time, in order, each waiting for the one before it to be done.
+
+    Args:
+        items (iterable): what to transfer, only taken as workers come free
+        start (callable): gets an item ready, returning its transfer and the
+            parts of it still to run. The transfer's resumed_bytes are the
+            bytes an earlier attempt already moved.
+        run_part (callable): runs one part, given the transfer and the part,
+            returning the bytes it moved
+        finish (callable): completes a transfer once all its parts are done
+        close (callable): closes a transfer that finished or failed
+        workers (int): most tasks in flight at once
+        key (callable): items it maps to the same key, other than None, are
+            taken one at a time
+        progress (callable): called with the transfers and bytes done as
+            they are
+
+    Returns:
+        tuple: the transfer of each item that made it, and a list of each
+        item that failed with its error
+    """
+    pool = _Pool(items, start, run_part, finish, close, workers, key, progress)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pool.run(executor)
+    return pool.done, pool.failures
+
+
+class _Pool(object):
+    """The state of one run_transfers"""
+
+    def __init__(self, items, start, run_part, finish, close, workers, key, progress):
+        self.items = iter(items)
+        self.start = start
+        self.run_part = run_part
+        self.finish = finish
+        self.close = close
+        self.workers = workers
+        self.key = key
+        self.progress = progress
+        self.ready = collections.deque()
+        # Keys under way, each with the items held back behind it, and the
+        # items whose turn has come
+        self.busy = set()
+        self.waiting = {}
+        self.unblocked = collections.deque()
+        self.under_way = 0
+        self.running = {}
+        self.done = []
+        self.failures = []
+
+    def run(self, executor):
+        while True:
+            self._fill(executor)
+            if not self.running:
+                return
+            finished, _ = wait(self.running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                state, task = self.running.pop(future)
+                state.in_flight -= 1
+                self._record(state, task, future)
+                if state.in_flight:
+                    continue
+                if state.error is None and state.remaining == 0 and not state.finished:
+                    self._submit(executor, state, self.finish, state.transfer)
+                elif state.error is not None or state.finished:
+                    self._settle(state)
+
+    def _fill(self, executor):
+        """Give every idle worker a part, or else a new transfer to start"""
+        while len(self.running) < self.workers:
+            if self.ready:
+                state, part = self.ready.popleft()
+                if state.error is None:
+                    self._submit(executor, state, self.run_part, state.transfer, part)
+                continue
+            state = self._next_item() if self.under_way < self.workers else None
+            if state is None:
+                return
+            self.under_way += 1
+            self._submit(executor, state, self.start, state.item)
+
+    def _submit(self, executor, state, task, *args):
+        state.in_flight += 1
+        self.running[executor.submit(task, *args)] = state, task
+
+    def _record(self, state, task, future):
+        """Note what a finished task did for its transfer"""
+        error = future.exception()
+        if error is not None:
+            state.error = state.error or error
+        elif task is self.start:
+            state.transfer, parts = future.result()
+            state.remaining = len(parts)
+            self._report(0, state.transfer.resumed_bytes)
+            self.ready.extend((state, part) for part in parts)
+        elif task is self.finish:
+            state.finished = True
+        else:
+            state.remaining -= 1
+            self._report(0, future.result())
+
+    def _next_item(self):
+        """The next item whose key is free, None once there are no more"""
+        while True:
+            if self.unblocked:
+                return self.unblocked.popleft()
+            item = next(self.items, None)
+            if item is None:
+                return None
+            state = _Transfer(item, self.key(item) if self.key is not None else None)
+            if state.key is None:
+                return state
+            if state.key not in self.busy:
+                self.busy.add(state.key)
+                return state
+            self.waiting.setdefault(state.key, collections.deque()).append(state)
+
+    def _settle(self, state):
+        self.under_way -= 1
+        if state.transfer is not None:
+            self.close(state.transfer)
+        if state.error is None:
+            self.done.append(state.transfer)
+        else:
+            self.failures.append((state.item, state.error))
+        # The key passes straight to the next item held back on it
+        queued = self.waiting.get(state.key)
+        if queued:
+            self.unblocked.append(queued.popleft())
+        elif state.key is not None:
+            self.waiting.pop(state.key, None)
+            self.busy.discard(state.key)
+        self._report(1, 0)
+
+    def _report(self, transfers, nbytes):
+        if self.progress is not None:
+            self.progress(transfers, nbytes)
@@ -1,35 +1,45 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import argparse
+import atexit
+import collections
 import hashlib
 import io
-import json
+import itertools
 import math
-import mmap
 import ntpath
 import os
 import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from mimetypes import MimeTypes
 
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 from googleapiclient.http import MediaIoBaseUpload
 from size_formatting import formatter
 from tabulate import tabulate
 from tqdm import tqdm
 
+import catalog
+import compression
 import encoder
 import file_parts
+import memory
+import packing
+import part_cache
+import part_index
+import scheduler
+import stats
+import transfers
 from api import *
-from api import GoogleAPI
-from custom_exceptions import PythonVersionError, NoClientSecretError, Error
+from api import BATCH_LIMIT, GoogleAPI
+from custom_exceptions import PythonVersionError, NoClientSecretError, Error, FileNotUDSError, IncompleteFileError
 try:
     from urllib.request import pathname2url
 except ImportError:
     Error.formatter(PythonVersionError, ".".join(str(v) for v in sys.version_info[:2]))
 
-if not os.path.exists(os.path.join(os.getcwd() + "/client_secret.json")):
-    Error.formatter(NoClientSecretError)
-
 DOWNLOADS_FOLDER = "downloads"
 TEMP_FOLDER = "tmp"
 
@@ -38,12 +48,39 @@ USE_MULTITHREADED_UPLOADS = True
 MAX_DOC_LENGTH = 1000000
 MAX_RAM_MB = 1024
 MAX_WORKERS_ALLOWED = 10
+# Part size of files uploaded before it was recorded on their folder
 CHUNK_READ_LENGTH_BYTES = 750000
+CODEC = encoder.DEFAULT_CODEC
+COMPRESSION = None
+DELETE_FILE_AFTER_CONVERT = False
+# Parts fetched ahead of a sequential read through UDS.open
+READ_AHEAD_PARTS = 4
 
 
 class UDS:
-    def __init__(self):
-        self.api = GoogleAPI()
+    def __init__(self, api=None):
+        self.api = api or GoogleAPI()
+        # Shared with the API client, so calls and stages land in one place
+        self.stats = self.api.stats
+        self._part_index = None
+        self._catalog = None
+        # Decoded parts kept on disk between pulls, see part_cache.PartCache
+        self.cache = None
+        self.memory = memory.MemoryBudget(MAX_RAM_MB * 2 ** 20, self.stats)
+
+    @property
+    def catalog(self):
+        """Local catalog of UDS files, opened on first use"""
+        if self._catalog is None:
+            self._catalog = catalog.Catalog()
+        return self._catalog
+
+    @property
+    def part_index(self):
+        """Local index of the parts already in Drive, opened on first use"""
+        if self._part_index is None:
+            self._part_index = part_index.PartIndex()
+        return self._part_index
 
     def delete_file(self, id, name=None, mode_=None):
         """Deletes a given file
@@ -69,12 +106,42 @@ class UDS:
             if mode_ != "quiet":
                 print("File \"%s\" was not a UDS file" % GoogleAPI.ERROR_OUTPUT)
 
+    def delete_files(self, items, mode_=None):
+        """Delete many UDS files with batched requests
+
+        Args:
+            items (iterable): the UDSFile of each file to delete
+            mode_ (str): "quiet" to say nothing of files that are not UDS ones
+        """
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, BATCH_LIMIT))
+            if not batch:
+                break
+
+            outcome = self.api.delete_files([item.id_ for item in batch])
+            for item in batch:
+                error = outcome[item.id_]
+                if error is None:
+                    self.catalog.remove(item.id_)
+                    print("Deleted %s" % item.name)
+                elif isinstance(error, FileNotUDSError):
+                    if mode_ != "quiet":
+                        print("File \"%s\" was not a UDS file" % item.name)
+                else:
+                    print("%s Could not delete %s: %s" % (GoogleAPI.ERROR_OUTPUT, item.name, error))
+
     def build_file(self, parent_id):
         """Download a uds file
 
-        This will fetch the Docs one by one, concatenating them
-        to a local base64 file. The file will then be converted
-        from base64 to the appropriate mime-type.
+        This will fetch the Docs concurrently, decoding each one and
+        writing it straight to its own offset in a preallocated local
+        file. Parts are fixed size, so the offset of every part is known
+        from its part number alone.
+
+        Completed parts are recorded next to the file as they land, so
+        running the pull again after an interruption only fetches the
+        parts that are missing.
 
         Args:
             parent_id (str): The ID of the containing folder
@@ -85,261 +152,1148 @@ class UDS:
 
         folder = self.api.get_file(parent_id)
 
-        if not items:
+        # Empty files have no parts, but they are still pulled
+        if not items and folder.get('properties', {}).get('size_numeric') != '0':
             print('No parts found.')
             return
 
-        # Fix part as int
-        for item in items:
-            item['properties']['part'] = int(item['properties']['part'])
-
-        items.sort(key=lambda x: x['properties']['part'], reverse=False)
+        try:
+            pull = self.start_pull(folder, items)
+        except IncompleteFileError as e:
+            print("%s %s" % (GoogleAPI.ERROR_OUTPUT, e))
+            return
 
-        f = open("%s/%s" % (get_downloads_folder(), folder['name']), "a+b")
-        progress_bar_chunks = tqdm(total=len(items),
+        progress_bar_chunks = tqdm(total=len(pull.parts),
                                    unit='chunks', dynamic_ncols=True, position=0)
-        progress_bar_speed = tqdm(total=len(items) * CHUNK_READ_LENGTH_BYTES, unit_scale=1,
+        progress_bar_speed = tqdm(total=pull.size, unit_scale=1,
                                   unit='B', dynamic_ncols=True, position=1)
+        progress_bar_chunks.update(len(pull.parts) - len(pull.to_fetch))
+        progress_bar_speed.update(pull.resumed_bytes)
 
-        for item in items:
-            encoded_part = self.download_part(item['id'])
-            # Decode
-            decoded_part = encoder.decode(encoded_part)
+        def fetch_part(part):
+            return self.pull_part(pull, part)
 
-            progress_bar_chunks.update(1)
-            progress_bar_speed.update(CHUNK_READ_LENGTH_BYTES)
+        if USE_MULTITHREADED_UPLOADS and MAX_WORKERS_ALLOWED > 1:
+            fetched_parts = bounded_map(fetch_part, pull.to_fetch, MAX_WORKERS_ALLOWED)
+        else:
+            fetched_parts = map(fetch_part, pull.to_fetch)
 
-            # Append decoded part to file
-            f.write(decoded_part)
+        try:
+            for fetched in fetched_parts:
+                progress_bar_chunks.update(1)
+                progress_bar_speed.update(fetched)
+        finally:
+            pull.close()
 
         print()
 
-        file_hash = self.hash_file(f.name)
+        self.finish_pull(pull)
+
+    def start_pull(self, folder, items):
+        """Get a file ready to pull
 
-        f.close()
+        Opens the local file, keeping the parts an interrupted pull of the
+        same file already wrote, and works out which parts are still to go.
 
-        original_hash = folder.get("md5Checksum")
-        if original_hash is not None and file_hash != original_hash:
+        Args:
+            folder (dict): the media folder, with its properties
+            items (list): the Docs in the media folder
+
+        Returns:
+            Pull: the file, ready for its parts to be fetched with pull_part
+
+        Raises:
+            IncompleteFileError: if the file's push never finished or a part is missing
+        """
+        parts = file_parts.group_pieces(items)
+        properties = folder.get('properties', {})
+        codec, chunk_size, file_compression, size = file_layout(properties, parts)
+        check_complete(folder, parts, chunk_size, size)
+
+        # Remember these parts, so pushing identical data later can reuse them
+        self.part_index.add_folder_parts(properties, parts)
+
+        # Parts already on disk from an interrupted pull of the same file are kept
+        path = "%s/%s" % (get_downloads_folder(), folder['name'])
+        part_log = file_parts.PartLog(path + ".uds-progress",
+                                      {'id': folder['id'], 'size': size, 'md5': properties.get('md5')})
+        completed = part_log.load() if os.path.exists(path) else None
+        resuming = completed is not None
+
+        f = open(path, "r+b" if resuming else "w+b")
+        pull = file_parts.Pull(folder, parts, f, part_log, size, chunk_size, codec, file_compression)
+        try:
+            f.truncate(size)
+            part_log.open(fresh=not resuming)
+            pull.to_fetch = sorted(parts)
+
+            if resuming:
+                print("Resuming {}: {} of {} parts already downloaded".format(folder['name'], len(completed),
+                                                                              len(parts)))
+                for part in pull.to_fetch:
+                    if part in completed:
+                        start = part * chunk_size
+                        end = min(start + chunk_size, size)
+                        pull.hasher.add(part, file_parts.read_blocks(path, start, end))
+                        pull.resumed_bytes += end - start
+                pull.to_fetch = [part for part in pull.to_fetch if part not in completed]
+        except Exception:
+            pull.close()
+            raise
+
+        return pull
+
+    def pull_part(self, pull, part, api=None):
+        """Fetch one part of a pull, write it to its offset and hash it
+
+        Returns:
+            int: bytes of the file the part held
+        """
+        with self.memory.hold(memory.part_memory(pull.chunk_size, pull.codec)):
+            writer = file_parts.PartWriter(pull.f, part * pull.chunk_size, pull.write_lock)
+            self.receive_part(pull.parts[part], pull.codec, pull.compression, self.stats.timed('write', writer),
+                              api=api)
+            pull.part_log.add(part)
+            fetched = writer.offset - part * pull.chunk_size
+            blocks = writer.blocks
+            if pull.hasher.parts_hashed != part:
+                # Not hashed until the parts ahead of it are. It is kept in
+                # memory till then if the budget has room besides what this
+                # part holds now, so the part those are waiting on can still
+                # get memory, and is read back from disk then otherwise
+                if self.memory.try_reserve(fetched):
+                    blocks = memory.HeldBlocks(self.memory, fetched, blocks)
+                else:
+                    blocks = file_parts.read_blocks(pull.f.name, part * pull.chunk_size, writer.offset)
+        with self.stats.stage('hash', fetched):
+            pull.hasher.add(part, blocks)
+        return fetched
+
+    def finish_pull(self, pull):
+        """Check a pull against the md5 recorded when it was pushed
+
+        The file is removed if it does not match.
+
+        Returns:
+            bool: whether the file matched, True if no md5 was recorded
+        """
+        pull.close()
+        file_hash = pull.hasher.hexdigest()
+
+        pull.part_log.remove()
+
+        original_hash = pull.folder.get('properties', {}).get('md5')
+        if original_hash and file_hash != original_hash:
             print("Failed to verify hash\nDownloaded file had hash {} compared to original {}".format(
                 file_hash, original_hash))
-            os.remove(f.name)
+            os.remove(pull.f.name)
+            return False
+        return True
+
+    def pull_many(self, files, key=None):
+        """Pull several files through one pool of workers
+
+        Each file is looked up and listed once, however often it was asked
+        for, a batch of files per round trip. Parts of every file share the
+        same workers, so no more than MAX_WORKERS_ALLOWED parts are in
+        flight at once whichever files they belong to, see
+        transfers.run_transfers. A file that fails is given up on while the
+        rest carry on. Files with the same name are pulled to the same path,
+        so each waits for the one before it to finish.
+
+        Args:
+            files (iterable): UDSFile of each file to pull
+            key (callable): orders the files, smallest first if not given
 
-    def download_part(self, part_id):
+        Returns:
+            tuple: the Pull of each file that made it, and a dict of the ID of
+            each file that failed mapped to its name and error
         """
+        unique = collections.OrderedDict((item.id_, item) for item in files)
+        ordered = sorted(unique.values(), key=key or (lambda item: int(item.size_numeric or 0)))
+        workers = MAX_WORKERS_ALLOWED if USE_MULTITHREADED_UPLOADS else 1
+
+        progress_bar_files = tqdm(total=len(ordered), unit='files', dynamic_ncols=True, position=0)
+        progress_bar_speed = tqdm(total=sum(int(item.size_numeric or 0) for item in ordered),
+                                  unit_scale=1, unit='B', dynamic_ncols=True, position=1)
+
+        def start(plan):
+            item, folder, items, error = plan
+            if error is not None:
+                raise error
+            # Empty files have no parts, but they are still pulled
+            if not items and folder.get('properties', {}).get('size_numeric') != '0':
+                raise IOError("No parts found")
+            pull = self.start_pull(folder, items)
+            return pull, pull.to_fetch
+
+        def finish(pull):
+            if not self.finish_pull(pull):
+                raise IOError("Downloaded file did not match its md5")
+
+        def progress(files_done, nbytes):
+            progress_bar_files.update(files_done)
+            progress_bar_speed.update(nbytes)
+
+        pulled, failed = transfers.run_transfers(
+            self.plan_pulls(ordered), start, self.pull_part, finish, file_parts.Pull.close, workers,
+            key=lambda plan: plan[1] and plan[1]['name'], progress=progress)
+        return pulled, {plan[0].id_: (plan[0].name, error) for plan, error in failed}
+
+    def plan_pulls(self, files):
+        """Look up and list the media folders of files to pull, a batch at a time
+
+        Yields:
+            tuple: each file, its media folder, the Docs in it and None, or
+            the file, None, None and the error it could not be looked up with
+        """
+        for start in range(0, len(files), BATCH_LIMIT):
+            batch = files[start:start + BATCH_LIMIT]
+            found = self.api.get_files([item.id_ for item in batch])
+            listed = self.api.list_folders([folder['id'] for folder, error in found if error is None])
+            for item, (folder, error) in zip(batch, found):
+                if error is not None:
+                    yield item, None, None, error
+                else:
+                    yield item, folder, listed[folder['id']], None
+
+    def pull_all(self, files):
+        """Pull files with pull_many and print how it went"""
+        pulled, failures = self.pull_many(files)
+        print()
+        if pulled:
+            table = [[pull.folder['name'], formatter(pull.size), pull.folder['id']] for pull in pulled]
+            print("\n" + tabulate(table, headers=['Name', 'Size', 'ID']))
+        for name, error in failures.values():
+            print("{} Could not pull {}: {}".format(GoogleAPI.ERROR_OUTPUT, name, error))
+
+    def open(self, parent_id, read_ahead=READ_AHEAD_PARTS):
+        """Open a UDS file for reading without downloading it
+
+        Only the parts covering what is read are fetched, see
+        file_parts.RangeReader, so a member of a large archive or a stretch
+        of a video can be read on its own.
+
+        Args:
+            parent_id (str): The ID of the containing folder
+            read_ahead (int): most parts fetched ahead of a sequential read
+
+        Returns:
+            RangeReader: a seekable, read-only file
+
+        Raises:
+            IncompleteFileError: if the file's push never finished or a part is missing
+        """
+        folder = self.api.get_file(parent_id)
+        parts = file_parts.group_pieces(self.api.recursive_list_folder(parent_id))
+
+        codec, chunk_size, file_compression, size = file_layout(folder.get('properties', {}), parts)
+        check_complete(folder, parts, chunk_size, size)
+
+        def fetch(part):
+            # Reserved by the reader, which keeps the part once it is in
+            data = bytearray()
+            self.receive_part(parts[part], codec, file_compression, data.extend)
+            return bytes(data)
 
-        :param part_id: 
-        :return: 
+        return file_parts.RangeReader(fetch, size, chunk_size, read_ahead, self.memory,
+                                      memory.part_memory(chunk_size, codec))
+
+    def download_part(self, part_id, fh, api=None):
+        """Export a single part Doc as text
+
+        The text is streamed into fh as it arrives, it is never buffered
+        here.
+
+        Args:
+            part_id (str): ID of the part Doc
+            fh (file): writable to stream the encoded part into, usually a
+                decoder from the file's codec
+            api (GoogleAPI): client to download with, defaults to self.api
         """
-        request = self.api.export_media(part_id)
-        fh = io.BytesIO()
+        if not api:
+            api = self.api
+
+        request = api.export_media(part_id)
         downloader = MediaIoBaseDownload(fh, request)
         done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-        return fh.getvalue()
+        # Decoding and writing happen inside the download, they are timed as stages of their own
+        with self.stats.stage('request'):
+            while done is False:
+                status, done = downloader.next_chunk()
+        fh.close()
 
-    def upload_chunked_part(self, chunk, api=None):
+    def upload_chunked_part(self, chunk, api=None, codec=None, compressor=None):
         """Upload a chunked part to drive and return the size of the chunk
-        :param chunk: 
-        :param api: 
-        :return: 
+
+        A part that does not fit in one Doc once encoded, which can happen
+        when it is compressed, is split over as many Docs as it needs.
+
+        :param chunk:
+        :param api:
+        :param codec:
+        :param compressor:
+        :return:
         """
         if not api:
             api = self.api
+        if not codec:
+            codec = encoder.get_codec(CODEC)
 
-        with open(chunk.path) as fd:
-            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
-            chunk_bytes = mm[chunk.range_start:chunk.range_end]
+        with self.stats.stage('read'):
+            chunk_bytes = chunk.read()
+        try:
+            # The part is mapped, so this is also where it is first read from disk
+            with self.stats.stage('hash', len(chunk_bytes)):
+                content_hash = hashlib.sha256(chunk_bytes).hexdigest()
+            index_key = self.part_index.key(codec.name, compressor.name if compressor else None, content_hash)
+            with self.stats.stage('request'):
+                copied = self.copy_indexed_part(chunk, index_key, api)
+            if copied:
+                return len(chunk_bytes)
+
+            properties = {'part': str(chunk.part), 'hash': content_hash}
+            payload = chunk_bytes
+            if compressor is not None:
+                with self.stats.stage('compress', len(chunk_bytes)):
+                    compressed = compressor.compress(chunk_bytes)
+                if len(compressed) < len(chunk_bytes):
+                    payload = memoryview(compressed)
+                else:
+                    properties['compressed'] = 'false'
+
+            doc_capacity = codec.chunk_size(MAX_DOC_LENGTH)
+            pieces = compression.pieces_needed(len(payload), doc_capacity)
+            uploaded = []
+            for piece in range(pieces):
+                with self.stats.stage('encode', min(doc_capacity, len(payload) - piece * doc_capacity)):
+                    encoded_chunk = codec.encode(payload[piece * doc_capacity:(piece + 1) * doc_capacity])
+
+                file_metadata = {
+                    'name': chunk.media.name + str(chunk.part),
+                    'mimeType': 'application/vnd.google-apps.document',
+                    'parents': [chunk.parent],
+                    'properties': dict(properties)
+                }
+                if pieces > 1:
+                    file_metadata['name'] += '.%d' % piece
+                    file_metadata['properties'].update({'piece': str(piece), 'pieces': str(pieces)})
+
+                # BytesIO shares the encoded buffer rather than copying it
+                mediaio_file = MediaIoBaseUpload(io.BytesIO(encoded_chunk),
+                                                 mimetype='text/plain')
+
+                with self.stats.stage('request', len(encoded_chunk)):
+                    _file, _ = api.upload_single_file(mediaio_file, file_metadata)
+                uploaded.append(part_index.piece_record(_file['id'], file_metadata['properties']))
+
+            self.part_index.add(index_key, uploaded)
+
+            return len(chunk_bytes)
+        finally:
+            chunk_bytes.release()
+
+    def copy_indexed_part(self, chunk, index_key, api):
+        """Store a part by copying Docs that already hold the same data
 
-        encoded_chunk = encoder.encode(chunk_bytes)
+        Args:
+            chunk (Chunk): the part to store
+            index_key (str): key of the part in the part index
+            api (GoogleAPI): client to make the copies with
 
-        file_metadata = {
-            'name': chunk.media.name + str(chunk.part),
-            'mimeType': 'application/vnd.google-apps.document',
-            'parents': [chunk.parent],
-            'properties': {
-                'part': str(chunk.part)
-            }
-        }
+        Returns:
+            bool: True if the part was copied, False if it still has to be uploaded
+        """
+        pieces = self.part_index.get(index_key)
+        if not pieces:
+            return False
 
-        mediaio_file = MediaIoBaseUpload(io.StringIO(encoded_chunk),
-                                         mimetype='text/plain')
+        try:
+            for piece in pieces:
+                file_metadata = {
+                    'name': chunk.media.name + str(chunk.part),
+                    'parents': [chunk.parent],
+                    'properties': dict(piece['properties'], part=str(chunk.part))
+                }
+                if 'piece' in piece['properties']:
+                    file_metadata['name'] += '.%s' % piece['properties']['piece']
+                api.copy_file(piece['id'], file_metadata)
+        except HttpError:
+            # The indexed Doc has gone, so the part is uploaded after all
+            self.part_index.discard(index_key)
+            return False
+
+        return True
+
+    def do_chunked_upload(self, path, name=None):
+        """
+        :rtype: object
+        :param path:
+        :param name: name to push the file under, its file name if not given
+        """
+        push = self.start_push(path, name=name)
+        self.upload_push(push)
+        print_pushed([(push.media, push.parent['id'])])
+
+    def push_stream(self, stream, name):
+        """Push data from a pipe or other stream that cannot be seeked
+
+        Parts are cut as the data arrives and uploaded while the next ones
+        are read, and the data is hashed as it is read. Its size is only
+        known at the end, when it is recorded on the media folder along with
+        the md5 that marks the push complete. Reading stops while as many
+        parts as there are workers are in flight or the memory budget is
+        spent, so the producer is slowed down rather than buffered.
+
+        Streams cannot be resumed, and their parts are not compressed since
+        that is decided from a sample of the whole file. A stream that fails
+        part way has its media folder deleted, and one left behind by a
+        process that was killed is never given an md5, so it is refused by
+        pulls like any other unfinished push.
 
-        self.api.upload_single_file(mediaio_file, file_metadata)
+        Args:
+            stream (file): binary stream to read until it ends
+            name (str): name to give the UDS file
+        """
+        codec = encoder.get_codec(CODEC)
+        chunk_size = codec.chunk_size(MAX_DOC_LENGTH)
+        part_memory = memory.part_memory(chunk_size, codec)
+        workers = MAX_WORKERS_ALLOWED if USE_MULTITHREADED_UPLOADS else 1
+
+        media = file_parts.UDSFile(name, None, MimeTypes().guess_type(pathname2url(name))[0],
+                                   formatter(0), formatter(0), parents=[self.api.get_base_folder()['id']],
+                                   size_numeric=0)
+        # Never matched by find_partial_upload, whose fingerprints are hashes of local files
+        parent = self.api.create_media_folder(media, {'fingerprint': 'stream', 'codec': codec.name,
+                                                      'chunk_size': str(chunk_size)})
+
+        md5 = hashlib.md5()
+        size = 0
+        progress_bar_speed = tqdm(unit_scale=1, unit='B', dynamic_ncols=True)
+
+        def upload(chunk):
+            try:
+                return self.upload_chunked_part(chunk, codec=codec)
+            finally:
+                self.memory.release(part_memory)
 
-        return len(chunk_bytes)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = set()
+                for part in itertools.count():
+                    if len(pending) >= workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            progress_bar_speed.update(future.result())
+
+                    data = self.read_stream_part(stream, chunk_size, part_memory, md5)
+                    if data is None:
+                        break
+                    chunk = file_parts.RangeChunk(lambda start, end, data=data: data, part, size + len(data), media,
+                                                  parent['id'], chunk_size)
+                    size += len(data)
+                    pending.add(executor.submit(upload, chunk))
+                    del chunk, data
+
+                for future in pending:
+                    progress_bar_speed.update(future.result())
+        except BaseException:
+            # A stream cannot be read again to resume, so the parts that made it are of no use
+            self.api.delete_file(parent['id'])
+            raise
+
+        media.size_numeric = size
+        media.size = formatter(size)
+        media.encoded_size = formatter(codec.encoded_size(size))
+        media.md5 = md5.hexdigest()
+        self.api.update_properties(parent['id'], {
+            'size': media.size,
+            'size_numeric': str(size),
+            'encoded_size': media.encoded_size,
+            'md5': media.md5
+        })
+        print_pushed([(media, parent['id'])])
+
+    def read_stream_part(self, stream, chunk_size, part_memory, md5):
+        """Read and hash the next part of a stream, see push_stream
+
+        Memory for the part is reserved before it is read, and kept for its
+        upload to release.
+
+        Returns:
+            bytes: the part, or None once the stream has ended
+        """
+        self.memory.reserve(part_memory)
+        try:
+            with self.stats.stage('read'):
+                data = file_parts.read_exactly(stream, chunk_size)
+        except BaseException:
+            self.memory.release(part_memory)
+            raise
+        if not data:
+            self.memory.release(part_memory)
+            return None
+        with self.stats.stage('hash', len(data)):
+            md5.update(data)
+        return data
+
+    def upload_push(self, push):
+        """Upload the parts of a push still to go and finish it
 
-    def do_chunked_upload(self, path):
+        Args:
+            push (Push): the file, from start_push
         """
-        :rtype: object
-        :param path: 
+        progress_bar_chunks = tqdm(total=push.total_parts,
+                                   unit='chunks', dynamic_ncols=True, position=0)
+        progress_bar_speed = tqdm(total=push.media.size_numeric, unit_scale=1,
+                                  unit='B', dynamic_ncols=True, position=1)
+        progress_bar_chunks.update(push.total_parts - len(push.chunks))
+        progress_bar_speed.update(push.resumed_bytes)
+
+        def upload_part(chunk):
+            return self.push_part(push, chunk)
+
+        # Parts are independent Docs, so they can go up in any order
+        if USE_MULTITHREADED_UPLOADS and MAX_WORKERS_ALLOWED > 1:
+            uploaded_parts = bounded_map(upload_part, push.chunks, MAX_WORKERS_ALLOWED)
+        else:
+            uploaded_parts = map(upload_part, push.chunks)
+
+        try:
+            for uploaded in uploaded_parts:
+                progress_bar_speed.update(uploaded)
+                progress_bar_chunks.update(1)
+        finally:
+            if push.source is not None:
+                push.source.close()
+
+        self.finish_push(push)
+
+    def start_push(self, path, root=None, properties=None, name=None):
+        """Get a file ready to push
+
+        Maps the file, plans its parts and finds or creates its media
+        folder. Parts already uploaded by an interrupted push are hashed
+        and left out of the parts still to go.
+
+        Args:
+            path (str): the file to push
+            root (str): ID of the UDS root folder, looked up if not given
+            properties (dict): extra properties to store on the media folder
+            name (str): name to push the file under, its file name if not given
+
+        Returns:
+            Push: the file, ready for its parts to be uploaded with push_part
         """
         # Prepare media file
         size = os.stat(path).st_size
-        file_hash = self.hash_file(path)
 
-        encoded_size = size * (4 / 3)
+        # Map the file once, every chunk reads a view of it
+        source = file_parts.MappedFile(path)
+        try:
+            # Fill every Doc as far as the codec allows. Parts that will be
+            # compressed are grown so they still about fill one once shrunk.
+            codec = encoder.get_codec(CODEC)
+            chunk_size = codec.chunk_size(MAX_DOC_LENGTH)
+            compressor, ratio = compression.choose(COMPRESSION, source)
+            if compressor is not None:
+                chunk_size = compressor.part_size(chunk_size, ratio)
+            elif COMPRESSION:
+                print("{} does not compress well, uploading it uncompressed".format(ntpath.basename(path)))
+            encoded_size = codec.encoded_size(size * ratio)
+
+            root = root or self.api.get_base_folder()['id']
+
+            media = file_parts.UDSFile(name or ntpath.basename(path), None,
+                                       MimeTypes().guess_type(pathname2url(path))[0],
+                                       formatter(size), formatter(encoded_size), parents=[root], size_numeric=size)
+
+            no_docs = math.ceil(size / chunk_size)
+
+            layout = {
+                'fingerprint': file_parts.fingerprint(source, chunk_size),
+                'codec': codec.name,
+                'chunk_size': str(chunk_size)
+            }
+            if compressor is not None:
+                layout['compression'] = compressor.name
+            layout.update(properties or {})
+
+            # Pick up where an interrupted push of the same file left off
+            parent, uploaded_before = self.find_partial_upload(media, layout)
+            if parent is None:
+                parent = self.api.create_media_folder(media, layout)
+            else:
+                print("Resuming {}: {} of {} parts already uploaded".format(media.name, len(uploaded_before), no_docs))
+
+            # Append all chunks to chunk list
+            chunk_list = [file_parts.Chunk(path, i, size, media=media, parent=parent['id'], source=source,
+                                           chunk_size=chunk_size)
+                          for i in range(no_docs)]
+
+            # The file is hashed as its parts go up instead of being read twice
+            push = file_parts.Push(source, media, parent, codec, compressor, no_docs)
+            for chunk in chunk_list:
+                if chunk.part in uploaded_before:
+                    push.hasher.add(chunk.part, chunk.blocks())
+                    push.resumed_bytes += chunk.range_end - chunk.range_start
+                else:
+                    push.chunks.append(chunk)
+        except Exception:
+            source.close()
+            raise
+
+        return push
+
+    def push_part(self, push, chunk):
+        """Upload one part of a push and hash it
+
+        Returns:
+            int: bytes of the file the part held
+        """
+        hashing = push.md5 is None
+        if hashing and push.window is not None:
+            # Parts held until their turn to be hashed are kept within the memory budget
+            push.hasher.wait_for(chunk.part, push.window)
+        with self.memory.hold(memory.part_memory(chunk.range_end - chunk.range_start, push.codec)):
+            uploaded = self.upload_chunked_part(chunk, codec=push.codec, compressor=push.compressor)
+        if hashing:
+            with self.stats.stage('hash', uploaded):
+                push.hasher.add(chunk.part, chunk.blocks())
+        return uploaded
+
+    def finish_push(self, push):
+        """Mark a push complete once all its parts are up, by setting its md5"""
+        push.media.md5 = push.md5 or push.hasher.hexdigest()
+        self.api.update_properties(push.parent['id'], {'md5': push.media.md5})
+
+    def push_many(self, paths, root=None):
+        """Push several files through one pool of workers
+
+        Getting files ready, uploading their parts and finishing them are
+        all tasks for the same workers, see transfers.run_transfers, so one
+        file's setup overlaps with other files' parts and mapped files and
+        half-done folders do not pile up. A file that fails is given up on
+        and the rest carry on.
+
+        Args:
+            paths (list): the files to push
+            root (str): ID of the UDS root folder, looked up if not given
+
+        Returns:
+            tuple: the Push of each file that made it, and a dict of each path
+            that failed mapped to its error
+        """
+        root = root or self.api.get_base_folder()['id']
+        workers = MAX_WORKERS_ALLOWED if USE_MULTITHREADED_UPLOADS else 1
+
+        progress_bar_files = tqdm(total=len(paths), unit='files', dynamic_ncols=True, position=0)
+        progress_bar_speed = tqdm(total=sum(os.path.getsize(path) for path in paths if os.path.isfile(path)),
+                                  unit_scale=1, unit='B', dynamic_ncols=True, position=1)
+
+        def start(path):
+            push = self.start_push(path, root)
+            return push, push.chunks
+
+        def progress(files_done, nbytes):
+            progress_bar_files.update(files_done)
+            progress_bar_speed.update(nbytes)
+
+        pushed, failed = transfers.run_transfers(
+            paths, start, self.push_part, self.finish_push, lambda push: push.source.close(), workers,
+            progress=progress)
+        return pushed, dict(failed)
+
+    def find_partial_upload(self, media, layout):
+        """Find an unfinished push of a file
+
+        A push only sets the md5 of its folder once every part is up, so a
+        folder for the same name and size without one was interrupted. It is
+        only picked up again if it was split, compressed and encoded the
+        same way.
+
+        Args:
+            media (UDSFile): the file being pushed
+            layout (dict): fingerprint, codec, chunk size and compression of this push
+
+        Returns:
+            tuple: the folder and the set of part numbers already uploaded to it,
+            or None and an empty set
+        """
+        for folder in self.api.find_media_folders(media.name, media.size_numeric):
+            properties = folder.get('properties', {})
+            if properties.get('md5'):
+                continue
+            if all(properties.get(key) == layout.get(key)
+                   for key in ('fingerprint', 'codec', 'chunk_size', 'compression')):
+                parts = file_parts.group_pieces(self.api.recursive_list_folder(folder['id']))
+                return folder, set(parts)
+
+        return None, set()
+
+    def push_paths(self, files, pack=False, pack_base='pack'):
+        """Push files, packing the small ones together if asked
+
+        Files that are not packed are named in Drive by their file name
+        alone, so two of them with the same file name are refused before
+        anything is uploaded.
+
+        Args:
+            files (list): (path, name in a pack) for each file
+            pack (bool): push files smaller than packing.PACK_MEMBER_LIMIT in packs
+            pack_base (str): packs are named after this, numbered from 0
+
+        Raises:
+            ValueError: if two files that are not packed have the same file name
+        """
+        small = [(path, name) for path, name in files if pack and packing.is_small(path)]
+        packed = set(path for path, _ in small)
+        files = [(path, name) for path, name in files if path not in packed]
+
+        clashes = collections.defaultdict(list)
+        for path, name in files:
+            clashes[ntpath.basename(path)].append(name)
+        clashes = [names for names in clashes.values() if len(names) > 1]
+        if clashes:
+            raise ValueError("Files would be pushed under the same name: {}{}".format(
+                "; ".join(", ".join(names) for names in clashes),
+                "" if pack else ". Push with --pack to keep their paths"))
 
         root = self.api.get_base_folder()['id']
+        pushed = []
+        failures = {}
+        if small:
+            for number, members in enumerate(packing.plan(small)):
+                name = packing.pack_name(pack_base, number)
+                try:
+                    pushed.append(self.push_pack(members, name, root))
+                except Exception as e:
+                    failures[name] = e
+
+        # All the other files share one pool of workers, see push_many
+        pushed_files, file_failures = self.push_many([path for path, _ in files], root)
+        pushed += pushed_files
+        failures.update(file_failures)
+        print_pushed([(push.media, push.parent['id']) for push in pushed], failures)
+
+    def push_directory(self, path, pack=False):
+        """Push every file under a directory
 
-        media = file_parts.UDSFile(ntpath.basename(path), None,
-                                   MimeTypes().guess_type(pathname2url(path))[0],
-                                   formatter(size), formatter(encoded_size), parents=[root], size_numeric=size,
-                                   md5=file_hash)
+        Args:
+            path (str): the directory
+            pack (bool): push small files in packs, named in them by their
+                path relative to the directory
 
-        parent = self.api.create_media_folder(media)
+        Raises:
+            ValueError: if files in different folders would be pushed under the same name, see push_paths
+        """
+        files = []
+        for folder, _, names in os.walk(path):
+            for name in sorted(names):
+                file_path = os.path.join(folder, name)
+                files.append((file_path, os.path.relpath(file_path, path)))
+        self.push_paths(files, pack, os.path.basename(os.path.abspath(path)))
+        self.update(mode=1)
+
+    def push_pack(self, members, name, root=None):
+        """Push small files together as one pack
+
+        The files are concatenated into a single UDS file, so they share its
+        parts rather than each costing a media folder and Docs of their own.
+        The offset, length and md5 of every member are kept in an index Doc
+        in the pack's folder, see extract.
 
-        # Should be the same
-        no_docs = math.ceil(encoded_size / MAX_DOC_LENGTH)
+        Args:
+            members (list): (path, name in the pack) for each file, see packing.plan
+            name (str): name of the pack
+            root (str): ID of the UDS root folder, looked up if not given
 
-        # Append all chunks to chunk list
-        chunk_list = [file_parts.Chunk(path, i, size, media=media, parent=parent['id']) for i in range(no_docs)]
+        Returns:
+            Push: the pushed pack
+        """
+        path = os.path.join(get_temp_folder(), name)
+        index = packing.write_pack(members, path)
+        try:
+            push = self.start_push(path, root, properties={'pack': 'true'})
+            try:
+                # The index goes up before the md5 marks the pack complete
+                if self.find_pack_index(self.api.recursive_list_folder(push.parent['id'])) is None:
+                    self.upload_pack_index(push, index)
+            except Exception:
+                push.source.close()
+                raise
+            self.upload_push(push)
+        finally:
+            os.remove(path)
+        return push
+
+    def upload_pack_index(self, push, index):
+        """Store the index of a pack as a Doc in its folder"""
+        encoded = push.codec.encode(packing.dump_index(index))
+        if len(encoded) > MAX_DOC_LENGTH:
+            raise ValueError("The index of {} does not fit in a Doc".format(push.media.name))
 
-        total = 0
-        total_chunks = no_docs
-        progress_bar_chunks = tqdm(total=total_chunks,
-                                   unit='chunks', dynamic_ncols=True, position=0)
-        progress_bar_speed = tqdm(total=total_chunks * CHUNK_READ_LENGTH_BYTES, unit_scale=1,
-                                  unit='B', dynamic_ncols=True, position=1)
+        file_metadata = {
+            'name': push.media.name + '.index',
+            'mimeType': 'application/vnd.google-apps.document',
+            'parents': [push.parent['id']],
+            'properties': {'pack_index': 'true'}
+        }
+        media = MediaIoBaseUpload(io.BytesIO(encoded), mimetype='text/plain')
+        with self.stats.stage('request', len(encoded)):
+            self.api.upload_single_file(media, file_metadata)
 
-        for chunk in chunk_list:
-            total += 1
-            self.upload_chunked_part(chunk)
-            progress_bar_speed.update(CHUNK_READ_LENGTH_BYTES)
-            progress_bar_chunks.update(1)
-        # 
-        # Concurrently execute chunk upload and report back when done.
-        # with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS_ALLOWED) as executor:
-        #     for file in executor.map(ext_upload_chunked_part, chunk_list):
-        #         total = total + file
-        #         elapsed_time = round(time.time() - start_time, 2)
-        #         current_speed = round(
-        #             (total) / (elapsed_time * 1024 * 1024), 2)
-        #         progress_bar("Uploading %s at %sMB/s" %
-        #                   (media.name, current_speed), total, size)
-        #
-        # Print new file output
-        table = [[media.name, media.size, media.encoded_size, parent['id']]]
-        print()
-        print("\n" + tabulate(table, headers=[
-            'Name', 'Size', 'Encoded', 'ID', ]))
+    @staticmethod
+    def find_pack_index(items):
+        """Pick the index Doc out of the contents of a pack's folder, or None"""
+        return next((item for item in items if item.get('properties', {}).get('pack_index') == 'true'), None)
+
+    def read_pack_index(self, index_id, codec):
+        """Download the index of a pack
+
+        Returns:
+            list: a [name, offset, length, md5] entry per member
+        """
+        data = bytearray()
+        self.download_part(index_id, codec.decoder(data.extend))
+        return packing.load_index(bytes(data))
+
+    def read_part(self, pieces, codec, file_compression, chunk_size):
+        """Download one part of a file into memory
+
+        Args:
+            pieces (list): the part's Docs in piece order
+            codec (Codec): how the file was encoded
+            file_compression (Compression): how the file was compressed, or None
+            chunk_size (int): bytes in every part of the file but the last
+
+        Returns:
+            bytes: the part, decoded and decompressed
+        """
+        with self.memory.hold(memory.part_memory(chunk_size, codec)):
+            data = bytearray()
+            self.receive_part(pieces, codec, file_compression, data.extend)
+            return bytes(data)
+
+    def receive_part(self, pieces, codec, file_compression, sink, api=None):
+        """Get one part of a file, from the local cache or else from Drive
+
+        Parts from Drive are decoded and decompressed as they stream in, and
+        cached once they are whole.
+
+        Args:
+            pieces (list): the part's Docs in piece order
+            codec (Codec): how the file was encoded
+            file_compression (Compression): how the file was compressed, or None
+            sink (callable): called with each block of the part, in order
+            api (GoogleAPI): client to download with, defaults to self.api
+        """
+        cached = self.cached_part(pieces)
+        if cached is not None:
+            sink(cached)
+            return
+
+        received = []
+        if self.cache is not None:
+            def target(block):
+                received.append(block)
+                sink(block)
+        else:
+            target = sink
+
+        decompressor = None
+        if file_compression is not None and pieces[0]['properties'].get('compressed') != 'false':
+            decompressor = compression.DecompressingSink(file_compression.decompressor(), target)
+            target = self.stats.timed('decompress', decompressor)
+
+        for piece in pieces:
+            self.download_part(piece['id'], stats.TimedFile(self.stats, 'decode', codec.decoder(target)), api=api)
+        if decompressor is not None:
+            with self.stats.stage('decompress'):
+                decompressor.close()
+        if self.cache is not None:
+            self.cache.put(pieces, b''.join(received))
+
+    def cached_part(self, pieces):
+        """A part from the local cache, or None if it has to be downloaded"""
+        if self.cache is None:
+            return None
+        start = time.perf_counter()
+        data = self.cache.get(pieces)
+        if data is not None:
+            self.stats.add_stage('cache', time.perf_counter() - start, len(data))
+        return data
+
+    def extract(self, pack_id, names=None):
+        """Pull members out of a pack
+
+        With no names the whole pack is pulled and split up. Otherwise only
+        the parts holding the named members are fetched, so a few members of
+        a large pack cost a few Docs rather than all of them.
+
+        Members are written to a folder named after the pack in the
+        downloads folder, and each is checked against its md5.
+
+        Args:
+            pack_id (str): ID of the pack's media folder
+            names (list): names of the members to pull, all of them if not given
+        """
+        folder = self.api.get_file(pack_id)
+        properties = folder.get('properties', {})
+        items = self.api.recursive_list_folder(pack_id)
+        index_doc = self.find_pack_index(items)
+        if properties.get('pack') != 'true' or index_doc is None:
+            print("%s %s is not a pack" % (GoogleAPI.ERROR_OUTPUT, folder['name']))
+            return
+
+        parts = file_parts.group_pieces(items)
+        codec, chunk_size, file_compression, size = file_layout(properties, parts)
+        try:
+            check_complete(folder, parts, chunk_size, size)
+        except IncompleteFileError as e:
+            print("%s %s" % (GoogleAPI.ERROR_OUTPUT, e))
+            return
+        index = self.read_pack_index(index_doc['id'], codec)
+        members = index
+        if names:
+            wanted = set(names)
+            members = [member for member in index if member[0] in wanted]
+            for missing in sorted(wanted - set(member[0] for member in members)):
+                print("%s %s is not in %s" % (GoogleAPI.ERROR_OUTPUT, missing, folder['name']))
+
+        out_folder = os.path.join(get_downloads_folder(), packing.unpacked_name(folder['name']))
+        if not names:
+            self.extract_all(folder, members, out_folder)
+            return
+
+        needed = sorted(set(part for member in members for part in packing.parts_for(member, chunk_size)))
+
+        def fetch_part(part):
+            return part, self.read_part(parts[part], codec, file_compression, chunk_size)
+
+        if USE_MULTITHREADED_UPLOADS and MAX_WORKERS_ALLOWED > 1:
+            fetched = dict(bounded_map(fetch_part, needed, MAX_WORKERS_ALLOWED))
+        else:
+            fetched = dict(map(fetch_part, needed))
+
+        for member in members:
+            self.write_member(out_folder, member, packing.member_bytes(member, fetched, chunk_size))
+
+    def extract_all(self, folder, members, out_folder):
+        """Pull a whole pack and split it up into its members, see extract"""
+        self.build_file(folder['id'])
+        pack_path = os.path.join(get_downloads_folder(), folder['name'])
+        if not os.path.exists(pack_path):
+            return
+        with open(pack_path, 'rb') as pack:
+            for name, offset, length, md5 in members:
+                pack.seek(offset)
+                self.write_member(out_folder, [name, offset, length, md5], pack.read(length))
+        os.remove(pack_path)
+
+    def write_member(self, folder, member, data):
+        """Write an extracted member, unless it fails to match its md5"""
+        name, _, _, md5 = member
+        try:
+            path = packing.member_path(folder, name)
+        except ValueError as e:
+            print("%s %s" % (GoogleAPI.ERROR_OUTPUT, e))
+            return
+        if hashlib.md5(data).hexdigest() != md5:
+            print("Failed to verify hash of {}, it was not written".format(name))
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.stats.stage('write', len(data)):
+            with open(path, 'wb') as f:
+                f.write(data)
+        print("Extracted {}".format(path))
 
     def convert_file(self, file_id):
-        # Get file metadata
-        metadata = service.files().get(fileId=file_id, fields="name").execute()
+        """Convert a file already in Drive into a UDS file
 
-        # Download the file and then call do_upload() on it
-        request = service.files().get_media(fileId=file_id)
-        path = "%s/%s" % (get_downloads_folder(), metadata['name'])
-        fh = io.FileIO(path, "wb")
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            _, done = downloader.next_chunk()
+        The file is read a part at a time with Range requests, and each part
+        is encoded and uploaded as soon as it arrives, so nothing is staged
+        on local disk and downloads overlap uploads. An interrupted
+        conversion of the same file is picked up where it left off.
+
+        Parts are not compressed, since that is decided from a sample of
+        the whole file.
 
-        print("Downloaded %s" % metadata['name'])
-        do_upload(path, service)
+        If DELETE_FILE_AFTER_CONVERT is set, the original is moved to the
+        trash once the converted file matches its md5.
 
-        # An alternative method would be to use partial download headers
-        # and convert and upload the parts individually. Perhaps a
-        # future release will implement this.
+        Args:
+            file_id (str): ID of the file in Drive
+        """
+        metadata = self.api.get_file(file_id)
+        if metadata.get('mimeType', '').startswith('application/vnd.google-apps.'):
+            print("{} {} is a Google Docs file, only binary files can be converted".format(
+                GoogleAPI.ERROR_OUTPUT, metadata['name']))
+            return
+
+        size = int(metadata.get('size', 0))
+        codec = encoder.get_codec(CODEC)
+        chunk_size = codec.chunk_size(MAX_DOC_LENGTH)
+        root = self.api.get_base_folder()['id']
+        media = file_parts.UDSFile(metadata['name'], None, metadata.get('mimeType'), formatter(size),
+                                   formatter(codec.encoded_size(size)), parents=[root], size_numeric=size)
+        no_docs = math.ceil(size / chunk_size)
+
+        layout = {
+            # The source cannot be sampled like a local file, but it has an ID and a checksum
+            'fingerprint': "drive:{}:{}".format(file_id, metadata.get('md5Checksum', '')),
+            'codec': codec.name,
+            'chunk_size': str(chunk_size)
+        }
+        parent, uploaded_before = self.find_partial_upload(media, layout)
+        if parent is None:
+            parent = self.api.create_media_folder(media, layout)
+        else:
+            print("Resuming {}: {} of {} parts already uploaded".format(media.name, len(uploaded_before), no_docs))
+
+        def fetch(start, end):
+            with self.stats.stage('request', end - start):
+                return self.api.download_range(file_id, start, end)
+
+        push = file_parts.Push(None, media, parent, codec, None, no_docs)
+        # Fetched parts are held until they are hashed in order
+        push.window = self.memory.window(memory.part_memory(chunk_size, codec))
+        resumed = []
+        for part in range(no_docs):
+            chunk = file_parts.RangeChunk(fetch, part, size, media, parent['id'], chunk_size)
+            if part in uploaded_before:
+                resumed.append(chunk)
+                push.resumed_bytes += chunk.range_end - chunk.range_start
+            else:
+                push.chunks.append(chunk)
+
+        if resumed and metadata.get('md5Checksum'):
+            # The folder was only picked up because its fingerprint holds this
+            # checksum, so the parts already up are of the same data. The
+            # checksum is recorded as it is, rather than fetching those parts
+            # again to hash them, and pulls still verify against it.
+            push.md5 = metadata['md5Checksum']
+        elif resumed:
+            # Hashed in order like the rest, which means fetching them once more
+            def rehash(chunk):
+                if push.window is not None:
+                    push.hasher.wait_for(chunk.part, push.window)
+                data = fetch(chunk.range_start, chunk.range_end)
+                with self.stats.stage('hash', len(data)):
+                    push.hasher.add(chunk.part, [data])
+
+            workers = MAX_WORKERS_ALLOWED if USE_MULTITHREADED_UPLOADS else 1
+            for _ in bounded_map(rehash, resumed, workers):
+                pass
+
+        self.upload_push(push)
+        print_pushed([(push.media, push.parent['id'])])
+
+        original_hash = metadata.get('md5Checksum')
+        if original_hash and push.media.md5 != original_hash:
+            print("Failed to verify hash\nConverted file had hash {} compared to original {}".format(
+                push.media.md5, original_hash))
+        elif DELETE_FILE_AFTER_CONVERT:
+            self.api.trash_file(file_id)
+            print("Moved {} to the trash".format(metadata['name']))
 
     # Mode sets the mode of updating 0 > Verbose, 1 > Notification, 2 > silent
     def update(self, mode=0, opts=None):
-        items = self.api.list_files(opts)
-        if not items:
+        """Bring the local catalog of UDS files up to date
+
+        Only the changes since the last update are fetched from Drive.
+
+        Args:
+            mode (int): 0 prints the catalog, 1 prints a notice, 2 is silent
+            opts (str): only print files with this in their name
+        """
+        self.catalog.sync(self.api)
+        if next(self.catalog.search(opts), None) is None:
             print('No UDS files were found.')
-        elif mode != 2:  # Duplicate silent...
-            table = []
-            with open("data.txt", 'w') as init:  # Create data.txt if it does not exist
-                init.write("{")
-                init.write("}")
-            for item in items:  # Show online data in form Encoded >> Size to show drive size and on disk size in order
-                record = [item.name, item.encoded_size, item.size, item.id_]
-                with open("data.txt", 'r') as data3:  # Read data stored offline
-                    user_data = json.load(data3)
-                temp_name = str(item.name)
-                user_data[temp_name] = item.id_
-                with open("data.txt", 'w') as data4:  # Write data to data.txt
-                    json.dump(user_data, data4, indent=3)
-                table.append(record)
-                with open("User.txt", 'w') as user:
-                    user.write(tabulate(table, headers=[
-                        'Name', 'Encoded', 'Size', 'ID']))
-            if mode == 0:  # Verbose
-                print(tabulate(table, headers=[
-                    'Name', 'Encoded', 'Size', 'ID']))
-            elif mode == 1:  # Notify
-                print("Data Updated!\n")
+        elif mode == 0:  # Verbose
+            table = [[item.name, item.encoded_size, item.size, item.id_] for item in self.catalog.search(opts)]
+            print(tabulate(table, headers=[
+                'Name', 'Encoded', 'Size', 'ID']))
+        elif mode == 1:  # Notify
+            print("Data Updated!\n")
+
+    def resolve(self, name):
+        """Find the ID of a UDS file by name
+
+        Returns:
+            str: the ID, or None if there is no such file
+        """
+        self.catalog.sync(self.api)
+        item = self.catalog.find(name)
+        if item is None:
+            print("No UDS file named \"%s\" was found" % name)
+            return None
+        return item.id_
 
     def list(self, opts=None):
         """List UDS files
 
         Prints a list of all UDS files. If a query is given, only the files
-        that match that query will be printed.
+        that match that query will be printed. Files whose push never
+        finished are marked as incomplete, since they cannot be pulled until
+        they are pushed again.
 
         Args:
             opts (str): Command line arguments
         """
-        items = self.api.list_files(opts)
-
-        if not items:
+        headers = ['Name', 'Size', 'Encoded', 'ID']
+        for page in self.api.list_file_pages(opts):
+            # Each page is printed as it arrives, only the first with headers
+            table = [[f.get('name') + (" (incomplete)" if file_parts.is_unfinished(f.get('properties', {})) else ""),
+                      f.get('properties', {}).get('size'), f.get('properties', {}).get('encoded_size'), f.get('id')]
+                     for f in page]
+            if table:
+                print(tabulate(table, headers=headers) if headers else tabulate(table, tablefmt='plain'))
+                headers = None
+
+        if headers is not None:
             print('No UDS files were found.')
-        else:
-            # print('\nUDS Files in Drive:')
-            table = [[item.name, item.size, item.encoded_size, item.id_] for item in items]
-
-            print(tabulate(table, headers=[
-                'Name', 'Size', 'Encoded', 'ID', ]))
 
     # Alpha command to erase file via name
     def erase(self, name, default=1, mode_=None, fallback=None):
-        if fallback is not None:
-            self.delete_file(fallback, name=name, mode_=mode_)
-        else:
-            with open("data.txt", 'r') as list_:
-                data_pull = json.load(list_)
-                list_.close()
-            id_ = data_pull[name]
-            self.delete_file(id_, name=name, mode_=mode_)
+        id_ = fallback if fallback is not None else self.resolve(name)
+        if id_ is None:
+            return
+        self.delete_file(id_, name=name, mode_=mode_)
+        self.catalog.remove(id_)
         self.update(mode=default)  # Updates files in data after being altered
 
     def grab(self, name, default=1, fallback=None):  # Alpha command to pull files via name
         self.update(mode=default)  # Sets update mode
-        if fallback is not None:
-            self.build_file(parent_id=fallback)
-            print()
-        else:
-            with open("data.txt", 'r') as list_:  # Load ID values based on file name
-                data_pull = json.load(list_)
-            parent_id = data_pull[name]  # Loads ID based on name
-            self.build_file(parent_id)
-            print()
+        parent_id = fallback if fallback is not None else self.catalog.find(name)
+        if parent_id is None:
+            print("No UDS file named \"%s\" was found" % name)
+            return
+        if fallback is None:
+            parent_id = parent_id.id_
+        self.build_file(parent_id)
+        print()
+
+    def grab_many(self, names):
+        """Pull UDS files by name, all through one pool of workers, see pull_many"""
+        self.update(mode=1)
+        files = []
+        for name in names:
+            item = self.catalog.find(name)
+            if item is None:
+                print("No UDS file named \"%s\" was found" % name)
+            else:
+                files.append(item)
+        if files:
+            self.pull_all(files)
 
     def batch(self, part, opts=None):  # Alpha command to bulk download based on part of a file name
         self.update(mode=1)  # Sets update mode
-        items = self.api.list_files(opts)
-        name_space = []  # List of names based on user part
-        id_space = []
-        check = 0
-        for item in items:  # Checks if part is in the name of any UDS file and adds them to queue
-            if str(part) != "?":
-                if str(part) in str(item.name):  # The name check
-                    name_space.append(item.name)
-                    id_space.append(item.id_)
-                    check += 1
-            elif str(part) == "?":
-                name_space.append(item.name)
-                id_space.append(item.id_)
-        for i in range(check):
-            self.grab(fallback=id_space[i], name=name_space[i], default=2)
-        # Downloads the bulk using data and names
-        for names in range(len(name_space)):
-            # Update data, not necessary
-            self.grab(name_space[names], default=2)
+        self.pull_all(self.catalog.search(part))
 
     # Alpha command to bulk upload files based on file name part
-    def bunch(self, file_part, path='.'):
+    def bunch(self, file_part, path='.', pack=False):
         files = os.listdir(path)  # Make list of all files in directory
         files_upload = []
         for name in files:  # Cycles through all files
@@ -348,44 +1302,15 @@ class UDS:
                     files_upload.append(name)
             elif file_part == "?":
                 files_upload.append(name)
-        for name_data in range(len(files_upload)):  # Upload all files put in list
-            full_path = str(path) + "/" + str(files_upload[name_data])
-            self.do_chunked_upload(full_path)
-        print()
+
+        self.push_paths([(str(path) + "/" + str(name), name) for name in files_upload], pack,
+                        os.path.basename(os.path.abspath(path)))
         self.update(mode=1)  # Necessary update to data
 
     def wipe(self, part, opts=None):  # Alpha command to bulk delete files based on file name part
         self.update(mode=2)  # Sets update mode
-        items = self.api.list_files(opts)
-        name_space = []
-        id_space = []
-        check = 0
-        for item in items:  # Add names to list
-            if str(part) != "?":
-                if str(part) in str(item.name):  # add names if they have part in them
-                    name_space.append(item.name)
-                    check += 1
-                    id_space.append(item.id_)
-            elif str(part) == "?":
-                name_space.append(item.name)
-                check += 1
-                id_space.append(item.id_)
-            else:
-                print()
-        for i in range(check):
-            self.erase(fallback=id_space[i], name=name_space[i], default=2)
-
-    def hash_file(self, path):
-        sha = hashlib.md5()
-
-        with open(path, 'rb') as f:
-            while True:
-                data = f.read(CHUNK_READ_LENGTH_BYTES)
-                if not data:
-                    break
-                sha.update(data)
-
-        return sha.hexdigest()
+        self.delete_files(self.catalog.search(part))
+        self.update(mode=1)  # Updates files in data after being altered
 
     def actions(self, action, args):
         switcher = {
@@ -398,12 +1323,117 @@ class UDS:
         switcher.get(action)(args)
 
 
+def print_pushed(pushed, failures=None):
+    """Print a table of the files pushed, then any that could not be
+
+    Args:
+        pushed (list): (UDSFile, ID of its media folder) for each file pushed
+        failures (dict): each file that could not be pushed mapped to its error
+    """
+    print()
+    if pushed:
+        table = [[media.name, media.size, media.encoded_size, folder_id] for media, folder_id in pushed]
+        print("\n" + tabulate(table, headers=['Name', 'Size', 'Encoded', 'ID']))
+    for name, error in (failures or {}).items():
+        print("{} Could not push {}: {}".format(GoogleAPI.ERROR_OUTPUT, name, error))
+
+
+def write_stats(stats, json_path=None, prometheus_path=None):
+    """Export what was recorded during this run
+
+    Args:
+        stats (Stats): the figures to export
+        json_path (str): where to write the JSON summary, "-" for stdout
+        prometheus_path (str): where to write a Prometheus textfile
+    """
+    if json_path == '-':
+        print(stats.to_json())
+    elif json_path:
+        with open(json_path, 'w') as f:
+            f.write(stats.to_json())
+    if prometheus_path:
+        stats.write_prometheus(prometheus_path)
+
+
+def file_layout(properties, parts):
+    """How a UDS file was stored, from the properties of its media folder
+
+    Args:
+        properties (dict): properties of the media folder
+        parts (dict): part number mapped to its Docs, for files that predate
+            recording their size
+
+    Returns:
+        tuple: the codec, chunk size, compression (None if uncompressed) and
+        size in bytes of the file
+    """
+    codec = encoder.get_codec(properties.get('codec'))
+    chunk_size = int(properties.get('chunk_size') or CHUNK_READ_LENGTH_BYTES)
+    file_compression = compression.parse(properties.get('compression'))
+    size = int(properties.get('size_numeric') or len(parts) * chunk_size)
+    return codec, chunk_size, file_compression, size
+
+
+def check_complete(folder, parts, chunk_size, size):
+    """Make sure every part of a UDS file is in Drive before reading it
+
+    Args:
+        folder (dict): the media folder, with its properties
+        parts (dict): part number mapped to its Docs
+        chunk_size (int): bytes in every part but the last
+        size (int): size of the file in bytes
+
+    Raises:
+        IncompleteFileError: if its push never finished or a part is missing
+    """
+    if file_parts.is_unfinished(folder.get('properties', {})):
+        raise IncompleteFileError(folder['name'], "its push never finished")
+    for part in range(-(-size // chunk_size)):
+        if part not in parts:
+            raise IncompleteFileError(folder['name'], "part {} is missing".format(part))
+
+
 def get_downloads_folder():
     if not os.path.exists(DOWNLOADS_FOLDER):
         os.makedirs(DOWNLOADS_FOLDER)
     return DOWNLOADS_FOLDER
 
 
+def get_temp_folder():
+    if not os.path.exists(TEMP_FOLDER):
+        os.makedirs(TEMP_FOLDER)
+    return TEMP_FOLDER
+
+
+def bounded_map(fn, items, workers):
+    """Apply fn to every item on a pool of worker threads
+
+    At most `workers` calls are in flight at once, so long item lists are not
+    all queued up front. Results are yielded in the order they complete.
+
+    Args:
+        fn (callable): function to call with each item
+        items (iterable): items to process
+        workers (int): maximum number of concurrent calls
+
+    Yields:
+        the return value of each call
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(fn, item))
+            if len(pending) >= workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
 def characters_to_bytes(chars):
     return round((3 / 4) * chars)
 
@@ -416,14 +1446,19 @@ def _parse_args(empty=False):
     """Parse command line arguments"""
     formatter = lambda prog: argparse.HelpFormatter(prog, max_help_position=52)
     parser = argparse.ArgumentParser(formatter_class=formatter)
-    parser.add_argument("--push", metavar='path_to_file', nargs=1,
-                        help="Uploads a file from this computer")
+    parser.add_argument("--push", metavar=('path_to_file', 'name'), nargs='+',
+                        help="Uploads a file from this computer, or from stdin with -, under name if given")
     parser.add_argument("--bunch", metavar=('word_in_file', 'path_to_file'),
                         nargs='+', help="Uploads files from this computer")
+    parser.add_argument("--pack", action='store_true',
+                        help="With --push of a directory or --bunch, push files under 1MB "
+                             "together in packs")
     parser.add_argument("--pull", metavar='id', nargs=1,
                         help="Downloads a UDS file")
-    parser.add_argument("-g", "--grab", metavar='name', nargs=1
-                        ,help="Downloads a UDS file")
+    parser.add_argument("-x", "--extract", metavar=('id', 'member'), nargs='+',
+                        help="Downloads members of a pack, or all of them")
+    parser.add_argument("-g", "--grab", metavar='name', nargs='+',
+                        help="Downloads UDS files by name")
     parser.add_argument("-b", "--batch", metavar='word_in_file', nargs=1,
                         help="Downloads UDS files")
     parser.add_argument("-l", "--list", metavar='query', const='', nargs='?',
@@ -442,13 +1477,40 @@ def _parse_args(empty=False):
                         help="Clear file after conversion")
     parser.add_argument("-D", "--disable-multi", action='store_false',
                         help="Disable multithreading")
+    parser.add_argument("--codec", choices=sorted(encoder.CODECS), default=encoder.DEFAULT_CODEC,
+                        help="How pushed files are encoded. base4096 needs half the Docs of "
+                             "base64 but sends half as many bytes again")
+    parser.add_argument("-z", "--compress", metavar='algorithm[:level]',
+                        help="Compress pushed files with zlib, bz2 or lzma, unless they "
+                             "turn out to be incompressible")
+    parser.add_argument("-W", "--workers", metavar='n', type=int, default=MAX_WORKERS_ALLOWED,
+                        help="Maximum number of parts in flight at once")
+    parser.add_argument("--max-ram", metavar='MB', type=int, default=MAX_RAM_MB,
+                        help="Most memory parts in flight may hold, new parts wait while it is spent")
+    parser.add_argument("--rate", metavar='n', type=float, default=scheduler.DEFAULT_RATE,
+                        help="Most requests sent to Drive per second")
+    parser.add_argument("--stats", metavar='path', nargs='?', const='-',
+                        help="Write timings, API calls and bytes transferred as JSON when done, "
+                             "to stdout unless a path is given")
+    parser.add_argument("--prometheus", metavar='path',
+                        help="Write the same figures as a Prometheus textfile")
+    parser.add_argument("--cache", metavar='path', nargs='?', const=part_cache.CACHE_FOLDER,
+                        help="Keep pulled parts in a local cache, so pulling them again skips Drive")
+    parser.add_argument("--cache-size", metavar='MB', type=int, default=part_cache.DEFAULT_MAX_BYTES // 2 ** 20,
+                        help="Most MB of parts to keep in the cache")
+    parser.add_argument("--socket-buffer", metavar='bytes', type=int,
+                        help="Send and receive buffer size for connections to Drive")
     if empty:
         parser.print_help()
         return None
     return parser.parse_args()
     
 def main():
-    global BASE_FOLDER, USE_MULTITHREADED_UPLOADS, DELETE_FILE_AFTER_CONVERT
+    global BASE_FOLDER, USE_MULTITHREADED_UPLOADS, MAX_WORKERS_ALLOWED, MAX_RAM_MB, CODEC, COMPRESSION, \
+        DELETE_FILE_AFTER_CONVERT
+    if not os.path.exists(os.path.join(os.getcwd() + "/client_secret.json")):
+        Error.formatter(NoClientSecretError)
+
     uds = UDS()
 
     # Initial look for folder and first time setup if not
@@ -463,21 +1525,54 @@ def main():
     args = _parse_args()
 
     USE_MULTITHREADED_UPLOADS = args.disable_multi
+    MAX_WORKERS_ALLOWED = max(1, args.workers)
+    # One connection for each worker, connections are shared by every command
+    uds.api.transport.size = MAX_WORKERS_ALLOWED
+    uds.api.transport.socket_buffer = args.socket_buffer
+    uds.api.transport.scheduler.bucket.rate = args.rate
+    MAX_RAM_MB = args.max_ram
+    uds.memory.limit = MAX_RAM_MB * 2 ** 20
+    if args.cache:
+        uds.cache = part_cache.PartCache(args.cache, args.cache_size * 2 ** 20)
+    # Reported even when a command fails part way
+    atexit.register(write_stats, uds.stats, args.stats, args.prometheus)
+    CODEC = args.codec
+    COMPRESSION = args.compress
+    try:
+        compression.parse(COMPRESSION)
+    except ValueError as e:
+        sys.exit("{!s} {!s}".format(GoogleAPI.ERROR_OUTPUT, e))
 
     if args.push:
-        uds.do_chunked_upload(args.push[0])
+        if args.push[0] == '-':
+            if len(args.push) < 2:
+                sys.exit("{!s} Pushing from stdin needs a name, as in --push - name".format(GoogleAPI.ERROR_OUTPUT))
+            uds.push_stream(sys.stdin.buffer, args.push[1])
+        elif os.path.isdir(args.push[0]):
+            if len(args.push) > 1:
+                sys.exit("{!s} A directory is pushed under the names of its files, "
+                         "--push takes no name for it".format(GoogleAPI.ERROR_OUTPUT))
+            try:
+                uds.push_directory(args.push[0], args.pack)
+            except ValueError as e:
+                sys.exit("{!s} {!s}".format(GoogleAPI.ERROR_OUTPUT, e))
+        else:
+            uds.do_chunked_upload(args.push[0], args.push[1] if len(args.push) > 1 else None)
 
     if args.bunch:
         if len(args.bunch) > 1:
-            uds.bunch(args.bunch[0], args.bunch[1])
+            uds.bunch(args.bunch[0], args.bunch[1], pack=args.pack)
         else:
-            uds.bunch(args.bunch[0])
+            uds.bunch(args.bunch[0], pack=args.pack)
 
     if args.pull:
         uds.build_file(args.pull[0])
 
+    if args.extract:
+        uds.extract(args.extract[0], args.extract[1:])
+
     if args.grab:
-        uds.grab(args.grab[0])
+        uds.grab_many(args.grab)
 
     if args.batch:
         uds.batch(args.batch[0])
@@ -500,35 +1595,7 @@ def main():
     
     if args.convert:
         DELETE_FILE_AFTER_CONVERT = args.clear
-        convert_file(args.convert[0])
-
-
-def ext_upload_chunked_part(chunk):
-    """Upload a chunked part to drive and return the size of the chunk"""
-    _api = GoogleAPI()
-    # print("Chunk %s, bytes %s to %s" % (chunk.part, chunk.range_start, chunk.range_end))
-
-    with open(chunk.path) as fd:
-        mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
-        chunk_bytes = mm[chunk.range_start:chunk.range_end]
-
-    encoded_chunk = encoder.encode(chunk_bytes)
-
-    file_metadata = {
-        'name': chunk.media.name + str(chunk.part),
-        'mimeType': 'application/vnd.google-apps.document',
-        'parents': [chunk.parent],
-        'properties': {
-            'part': str(chunk.part)
-        }
-    }
-
-    mediaio_file = MediaIoBaseUpload(io.StringIO(encoded_chunk),
-                                     mimetype='text/plain')
-
-    _api.upload_single_file(mediaio_file, file_metadata)
-
-    return len(chunk_bytes)
+        uds.convert_file(args.convert[0])
 
 
 if __name__ == '__main__':